@@ -15,7 +15,15 @@ DEFAULT_CONFIG = {
     'mongo_user': None,
     'mongo_pwd': None,
     'localserver_port': 24680,
-    'mongo_db': 'fable'
+    'mongo_db': 'fable',
+    'mem_cache_bytes': 512*1024*1024, # In-process crawl/wayback cache size
+    'mem_cache_ttl': 3600,
+    'negative_cache_ttl': {}, # {failure class: seconds} to override tools.NEGATIVE_TTL
+    'wayback_raw': True, # Fetch original captures (id_) of wayback pages
+    'tfidf_model_path': None, # Prebuilt TFIDF model dir (tools.build_tfidf_model) loaded by Similar
+    'site_context_bytes': 256*1024*1024, # Memory for Similar's warm per-site title indexes
+    'site_context_ttl': 3600, # Seconds a warm title index is reused before being rebuilt from db. None: never expire
+    'cdx_store_ttl': 7*24*3600 # Seconds a CDX dump in cdx_store answers queries before being pruned and refetched. None: never expire
 }
 
 def config(key):
@@ -313,10 +313,10 @@ class AliasFinder:
         if len(urls) < 10:
             neighbor_urls, neighbor_cands = self.get_neighbors(urls)
         
-        all_urls = set(urls + neighbor_urls)
+        all_urls = list(set(urls + neighbor_urls))
         url_archived = {}
-        for url in all_urls:
-            wi = db.wayback_index.find_one({'url': url})
+        wis = self.memo.wayback_index_records(all_urls, fetch_missing=False)
+        for url, wi in zip(all_urls, wis):
             url_archived[url] = wi and len(wi.get('ts', []))
         url_warchive = [u for u in all_urls if url_archived[u]]
         url_woarchive = [u for u in all_urls if not url_archived[u]]
@@ -10,9 +10,11 @@ import re, json
 import requests
 from dateutil import parser as dparser
 import datetime
+import threading
+from concurrent import futures
 
 from . import config, tools, tracer
-from .utils import crawl, url_utils, sic_transit, text_utils
+from .utils import crawl, url_utils, sic_transit, text_utils, cdx_store, site_resolver
 
 import logging
 logging.setLoggerClass(tracer.tracer)
@@ -21,11 +23,83 @@ logging.setLoggerClass(logging.Logger)
 
 he = url_utils.HostExtractor()
 
-def _safe_dparse(ts):
-    try:
-        return dparser.parse(ts)
-    except:
-        return datetime.datetime.now()
+_safe_dparse = url_utils._safe_dparse
+
+SNAPSHOT_SPACING = datetime.timedelta(days=90) # * Min distance between 2 checked snapshots in wayback_alias_history
+PROBE_CONCURRENCY = 4 # * #snapshots fetched ahead in wayback_alias_history. 1 means sequential
+PROBE_WORKERS = 16 # * Threads fetching snapshots ahead, shared by all wayback_alias_history calls in the process
+
+_probe_executor = None
+_probe_executor_lock = threading.Lock()
+
+def get_probe_executor():
+    """Process-wide bounded executor of SnapshotProbers"""
+    global _probe_executor
+    with _probe_executor_lock:
+        if _probe_executor is None:
+            _probe_executor = futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+        return _probe_executor
+
+
+class SnapshotProber:
+    """
+    Fetch upcoming snapshots of wayback_alias_history ahead, concurrently
+    Only fetching is speculative: results are still consumed one by one in the scan order,
+    so the answer is the same as the sequential scan
+    Snapshots with the same key (captured content digest) are fetched once, and share the result
+    Probes run on the process-wide executor, so concurrent scans never exceed PROBE_WORKERS threads
+    """
+    def __init__(self, probe, ts_urls, concurrency=PROBE_CONCURRENCY, keys=None):
+        """
+        probe: func(wayback_url) fetching one snapshot
+        ts_urls: [(ts, wayback_url)] scanned from the end
+        keys: [key] of each snapshot in ts_urls. Snapshots with same (not None) key are identical captures
+        """
+        self.probe = probe
+        self.ts_urls = ts_urls
+        self.concurrency = concurrency
+        self.keys = keys if keys is not None else [None] * len(ts_urls)
+        self.executor = get_probe_executor() if concurrency > 1 else None
+        self.pending = {} # * {key: future}
+        self.results = {} # * {key: probe result} of sequential probes
+        self.closed = False
+
+    def _key(self, idx):
+        key = self.keys[idx]
+        return ('idx', idx) if key is None else key
+
+    def _prefetch(self, idx, last_ts):
+        """
+        Schedule the next (up to) concurrency snapshots from idx down that pass the spacing filter with current last_ts.
+        last_ts only moves earlier during the scan, so these are a superset of the ones actually checked
+        """
+        j, ahead = idx, 0
+        while j >= 0 and ahead < self.concurrency:
+            ts, wayback_url = self.ts_urls[j]
+            key = self._key(j)
+            if ts + SNAPSHOT_SPACING <= last_ts and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.probe, wayback_url)
+                ahead += 1
+            j -= 1
+
+    def get(self, idx, last_ts):
+        """Probe result of snapshot idx"""
+        key = self._key(idx)
+        if self.executor is not None and not self.closed:
+            self._prefetch(idx, last_ts)
+        if key in self.pending:
+            return self.pending[key].result()
+        if key not in self.results:
+            self.results[key] = self.probe(self.ts_urls[idx][1])
+        return self.results[key]
+
+    def close(self):
+        """Stop prefetching: cancel snapshots not started yet, and wait for running ones, so none outlives the scan"""
+        self.closed = True
+        running = [future for future in self.pending.values() if not future.cancel()]
+        futures.wait(running)
+        self.pending, self.results = {}, {}
+
 
 class HistRedirector:
     def __init__(self, corpus=[], proxies={}, memo=None):
@@ -44,6 +118,30 @@ class HistRedirector:
             self.crawl_cache[url] = resp
             return resp
     
+    def _index_prefix(self, urls):
+        """
+        Query all archives (all status) under urls' common directory once into wayback_index_cache
+        The prefix dump is kept in cdx_store, so later batches (in any process) under the same directory are answered locally
+        Once expired, it is pruned and the next batch's fresh dump replaces the stored records under the directory
+        """
+        if len(self.wayback_index_cache):
+            return
+        cur_prefix = max(urls, key=lambda x: len(x))
+        param_dict = {
+            'filter': ['mimetype:text/html'],
+            'output': 'json'
+        }
+        for url in urls:
+            url_prefix = url_utils.netloc_dir(url, exclude_index=True)
+            if len(url_prefix) < len(cur_prefix):
+                cur_prefix = url_prefix
+        cur_prefix = cur_prefix[0] + cur_prefix[1]
+        tracer.debug(f"batch_history: wayback index with prefix: {cur_prefix + '/*'}")
+        waybacks, _ = cdx_store.wayback_index(cur_prefix + '/*', param_dict=param_dict, total_link=True)
+        for wayback in waybacks:
+            target_url = url_utils.filter_wayback(wayback[1])
+            self.wayback_index_cache[url_utils.url_norm(target_url)].append(wayback)
+
     def _wayback_index(self, url, non_400=True):
         url = url_utils.url_norm(url)
         if len(self.wayback_index_cache):
@@ -55,11 +153,11 @@ class HistRedirector:
             if non_400: # * Case for [23][00]
                 waybacks = self.memo.wayback_index(url, policy='all', all_none_400=True)
                 return waybacks
-            else: # * Live crawl
+            else: # * Answered by cdx_store if a prefix dump covers url, otherwise live crawl
                 param_dict = {
                     'filter': ['mimetype:text/html', 'statuscode:[4][0-9]*']
                 }
-                waybacks, _ = crawl.wayback_index(url, param_dict=param_dict)
+                waybacks, _ = cdx_store.wayback_index(url, param_dict=param_dict)
                 return waybacks
 
     def _order_neighbors(self, target_url, neighbors, ts):
@@ -99,13 +197,9 @@ class HistRedirector:
         new_url = new_urls[-1]
 
         # * If new url is in the same site
-        orig_host = he.extract(url)
-        host_url = f'http://{orig_host}'
-        new_host = he.extract(new_url)
-        new_host_url = f'http://{new_host}'
-        _, orig_host = self.memo.crawl(host_url, final_url=True)
-        _, new_host = self.memo.crawl(new_host_url, final_url=True)
-        if orig_host is None or new_host is None or he.extract(new_host) != he.extract(orig_host):
+        orig_site = site_resolver.resolve(he.extract(url))
+        new_site = site_resolver.resolve(he.extract(new_url))
+        if orig_site is None or new_site is None or new_site.site != orig_site.site:
             tracer.debug('verify_alias: redirected URL not in the same site')
             return False
 
@@ -207,8 +301,51 @@ class HistRedirector:
             return False
         return True
 
+    @staticmethod
+    def _snapshot_keys(url, wayback_ts):
+        """
+        Dedup key of each snapshot of url from locally stored CDX records (no CDX query is made)
+        Only 2xx captures are keyed: digest covers the body but not Location,
+            so 3xx captures with the same (stock) body may still redirect to different targets
+        wayback_ts: [timestamp str]
+        Return: [(statuscode, digest)] aligned with wayback_ts. None if not 2xx or digest is unknown
+        """
+        try:
+            records = cdx_store.get_store().query(url, {'filter': ['mimetype:text/html']})
+        except Exception as e:
+            tracer.debug(f'_snapshot_keys: {url} {str(e)}')
+            return [None] * len(wayback_ts)
+        ts_digest = {}
+        for r in records:
+            if r[4].startswith('2') and r[5] not in ['', '-']:
+                ts_digest[r[1]] = (r[4], r[5])
+        return [ts_digest.get(str(ts)) for ts in wayback_ts]
+
+    def _probe_snapshot(self, url, wayback_url):
+        """
+        Resolve a snapshot of url's redirections (including wayback's html redirection page)
+        Only redirect chain is fetched, and a prefix of the body only if the snapshot is not redirected
+        Return: (redirect chain, final wayback_url, whether final url matches url), None if crawl failed
+        """
+        response = crawl.resolve_redirects(wayback_url)
+        if response is None:
+            return
+        try:
+            wayback_url = response.url
+            # * First match check
+            match = url_utils.url_match(url, url_utils.filter_wayback(wayback_url))
+            if match:
+                redir_url = text_utils.parse_wayback_redir(response.text)
+                wayback_url = redir_url if redir_url else wayback_url
+                match =  url_utils.url_match(url, url_utils.filter_wayback(wayback_url))
+        except:
+            return
+        finally:
+            response.close()
+        return response, wayback_url, match
+
     def wayback_alias_history(self, url, require_neighbor=False, homepage_redir=True, 
-                                live_working=True, strict_filter=False):
+                                live_working=True, strict_filter=False, probe_concurrency=PROBE_CONCURRENCY):
         """
         Utilize wayback's archived redirections to find the alias/reorg of the page
         Not consider non-homepage to homepage
@@ -217,6 +354,7 @@ class HistRedirector:
         homepage_redir: Whether redirection to homepage (from non-homepage) is considered valid
         live_working: Require the live version of the "alias" to be working. Default set to true
         strict_filter: Not consider case where: redirected URL's path is a substring of the original one
+        probe_concurrency: #snapshots fetched ahead concurrently. Same result as sequential scan (1)
 
         Returns: List of all redirection history to live version of alias, else None
         """
@@ -230,12 +368,14 @@ class HistRedirector:
         if not wayback_ts_urls or len(wayback_ts_urls) == 0:
             return
 
+        snapshot_keys = self._snapshot_keys(url, [c[0] for c in wayback_ts_urls])
         wayback_ts_urls = [(_safe_dparse(c[0]), c[1]) for c in wayback_ts_urls]
 
         # * Check for 400 snapshots, any redirections after it will not be counted
         broken_archives = self._wayback_index(url, non_400=False)
         if len(broken_archives):
             broken_ts = _safe_dparse(broken_archives[0][0])
+            snapshot_keys = [k for w, k in zip(wayback_ts_urls, snapshot_keys) if w[0] < broken_ts]
             wayback_ts_urls = [w for w in wayback_ts_urls if w[0] < broken_ts]
             if len(wayback_ts_urls) == 0:
                 return
@@ -244,81 +384,79 @@ class HistRedirector:
         # * Count for unmatched wayback final url, and wayback_alias to same redirected fake alias
         url_match_count, same_redir = 0, 0
         it = len(wayback_ts_urls) - 1
-        last_ts = wayback_ts_urls[-1][0] + datetime.timedelta(days=90)
+        last_ts = wayback_ts_urls[-1][0] + SNAPSHOT_SPACING
         seen_redir_url = set()
-        while url_match_count < 3 and same_redir < 5 and it >= 0:
-            ts, wayback_url = wayback_ts_urls[it]
-            tracer.debug(f'wayback_alias iteration: ts: {ts} it: {it}')
-            it -= 1
-            if ts + datetime.timedelta(days=90) > last_ts: # 2 snapshots too close
-                continue
-            try:
-                response = crawl.requests_crawl(wayback_url, raw=True)
-                wayback_url = response.url
-                # * First match check
-                match = url_utils.url_match(url, url_utils.filter_wayback(wayback_url))
-                if match:
-                    redir_url = text_utils.parse_wayback_redir(response.text)
-                    tracer.debug(f"wayback alias: redir URL after parsing HTML: {redir_url}")
-                    wayback_url = redir_url if redir_url else wayback_url
-                    match =  url_utils.url_match(url, url_utils.filter_wayback(wayback_url))
-                    tracer.debug(f"url {url} match with redir {url_utils.filter_wayback(wayback_url)}: {match}")
-            except:
-                continue
-
-            # *Not match means redirections, the page could have a temporary redirections to the new page
-            if match:
-                url_match_count += 1
-                continue
-            last_ts = ts
-            new_url = url_utils.filter_wayback(wayback_url)
-            inter_urls = [url_utils.filter_wayback(wu.url) for wu in response.history] # Check for multiple redirections
-            inter_urls.append(new_url)
-            inredir = False
-            for inter_url in inter_urls[1:]:
-                if inter_url in seen_redir_url:
-                    inredir = True
-            if inredir:
-                same_redir += 1
-                continue
-            else:
-                seen_redir_url.add(new_url)
-            inter_uss = [urlsplit(inter_url) for inter_url in inter_urls]
-            tracer.info(f'Wayback_alias: {ts}, {inter_urls}')
+        # * Identical 2xx captures (same CDX digest) are fetched once. Scan still visits every snapshot, so counts & ts are unchanged
+        prober = SnapshotProber(lambda wu: self._probe_snapshot(url, wu), wayback_ts_urls, probe_concurrency, keys=snapshot_keys)
+        try:
+            while url_match_count < 3 and same_redir < 5 and it >= 0:
+                ts, wayback_url = wayback_ts_urls[it]
+                tracer.debug(f'wayback_alias iteration: ts: {ts} it: {it}')
+                idx = it
+                it -= 1
+                if ts + SNAPSHOT_SPACING > last_ts: # 2 snapshots too close
+                    continue
+                probe = prober.get(idx, last_ts)
+                if probe is None:
+                    continue
+                response, wayback_url, match = probe
+                tracer.debug(f"url {url} match with {url_utils.filter_wayback(wayback_url)}: {match}")
 
-            # *If non-home URL is redirected to homepage, it should not be a valid redirection
-            new_is_homepage = True in [inter_us.path in ['/', ''] and not inter_us.query for inter_us in inter_uss]
-            if not homepage_redir and new_is_homepage and (not is_homepage): 
-                continue
+                # *Not match means redirections, the page could have a temporary redirections to the new page
+                if match:
+                    url_match_count += 1
+                    continue
+                last_ts = ts
+                new_url = url_utils.filter_wayback(wayback_url)
+                inter_urls = [url_utils.filter_wayback(wu.url) for wu in response.history] # Check for multiple redirections
+                inter_urls.append(new_url)
+                inredir = False
+                for inter_url in inter_urls[1:]:
+                    if inter_url in seen_redir_url:
+                        inredir = True
+                if inredir:
+                    same_redir += 1
+                    continue
+                else:
+                    seen_redir_url.add(new_url)
+                inter_uss = [urlsplit(inter_url) for inter_url in inter_urls]
+                tracer.info(f'Wayback_alias: {ts}, {inter_urls}')
+
+                # *If non-home URL is redirected to homepage, it should not be a valid redirection
+                new_is_homepage = True in [inter_us.path in ['/', ''] and not inter_us.query for inter_us in inter_uss]
+                if not homepage_redir and new_is_homepage and (not is_homepage): 
+                    continue
             
-            live_new_url = inter_urls[-1]
-            live_new_url = self.na_alias(live_new_url, live_working)
-            if live_new_url is None or url_utils.suspicious_alias(url, live_new_url):
-                continue
-            inter_urls.append(live_new_url)
-            # //pass_check, reason = sic_transit.broken(new_url, html=True, ignore_soft_404=is_homepage and new_is_homepage)
-            # //ass_check = not pass_check
-            if len(inter_urls) > 1:
-                inter_urls = inter_urls[1:]
-            pass_check = self._verify_alias(url, inter_urls, ts, homepage_redir=is_homepage and new_is_homepage, \
-                                            strict_filter=strict_filter, require_neighbor=require_neighbor, \
-                                            live_working=live_working, seen_redir_url=seen_redir_url)
-            if pass_check:
-                # * Select all historical redirected URLs that are still working
-                tracer.debug(f'found: {live_new_url}')
-                inter_urls = list(dict.fromkeys([url_utils.url_norm(iu, ignore_scheme=True) for iu in inter_urls]))
-                working_inter_urls = inter_urls.copy()
-                # ? If live_working == False, no need to crawl the liveweb
-                if live_working:
-                    for iu in inter_urls:
-                        r = crawl.requests_crawl(iu, raw=True)
-                        if isinstance(r, requests.Response) and \
-                            (url_utils.url_match(r.url, inter_urls[-1]) or url_utils.url_match(r.url, live_new_url)):
-                            break
-                        working_inter_urls.pop(0)
-                # ? End of live_working
-                return working_inter_urls
-        return
+                live_new_url = inter_urls[-1]
+                live_new_url = self.na_alias(live_new_url, live_working)
+                if live_new_url is None or url_utils.suspicious_alias(url, live_new_url):
+                    continue
+                inter_urls.append(live_new_url)
+                # //pass_check, reason = sic_transit.broken(new_url, html=True, ignore_soft_404=is_homepage and new_is_homepage)
+                # //ass_check = not pass_check
+                if len(inter_urls) > 1:
+                    inter_urls = inter_urls[1:]
+                pass_check = self._verify_alias(url, inter_urls, ts, homepage_redir=is_homepage and new_is_homepage, \
+                                                strict_filter=strict_filter, require_neighbor=require_neighbor, \
+                                                live_working=live_working, seen_redir_url=seen_redir_url)
+                if pass_check:
+                    # * Select all historical redirected URLs that are still working
+                    tracer.debug(f'found: {live_new_url}')
+                    inter_urls = list(dict.fromkeys([url_utils.url_norm(iu, ignore_scheme=True) for iu in inter_urls]))
+                    working_inter_urls = inter_urls.copy()
+                    # ? If live_working == False, no need to crawl the liveweb
+                    if live_working:
+                        for iu in inter_urls:
+                            r = crawl.requests_crawl(iu, raw=True)
+                            if isinstance(r, requests.Response) and \
+                                (url_utils.url_match(r.url, inter_urls[-1]) or url_utils.url_match(r.url, live_new_url)):
+                                break
+                            working_inter_urls.pop(0)
+                    # ? End of live_working
+                    return working_inter_urls
+            return
+        finally:
+            prober.close()
 
     def wayback_alias(self, url, require_neighbor=False, homepage_redir=True, strict_filter=False):
         """
@@ -341,24 +479,7 @@ class HistRedirector:
         """
         self.prefix_wayback_300s = {}
         self.crawl_cache = {}
-
-        # * Query all 300 archives once
-        if len(self.wayback_index_cache) == 0:
-            cur_prefix = max(urls, key=lambda x: len(x))
-            param_dict = {
-                'filter': ['mimetype:text/html'],
-                'output': 'json'
-            }
-            for url in urls:
-                url_prefix = url_utils.netloc_dir(url, exclude_index=True)
-                if len(url_prefix) < len(cur_prefix):
-                    cur_prefix = url_prefix
-            cur_prefix = cur_prefix[0] + cur_prefix[1]
-            tracer.debug(f"batch_history: wayback index with prefix: {cur_prefix + '/*'}")
-            waybacks, _ = crawl.wayback_index(cur_prefix + '/*', param_dict=param_dict, total_link=True)
-            for wayback in waybacks:
-                target_url = url_utils.filter_wayback(wayback[1])
-                self.wayback_index_cache[url_utils.url_norm(target_url)].append(wayback)
+        self._index_prefix(urls)
 
         url_history = {}
         for url in urls:
@@ -393,24 +514,7 @@ class HistRedirector:
         """
         self.prefix_wayback_300s = {}
         self.crawl_cache = {}
-
-        # * Query all 300 archives once
-        if len(self.wayback_index_cache) == 0:
-            cur_prefix = max(urls, key=lambda x: len(x))
-            param_dict = {
-                'filter': ['mimetype:text/html'],
-                'output': 'json'
-            }
-            for url in urls:
-                url_prefix = url_utils.netloc_dir(url, exclude_index=True)
-                if len(url_prefix) < len(cur_prefix):
-                    cur_prefix = url_prefix
-            cur_prefix = cur_prefix[0] + cur_prefix[1]
-            tracer.debug(f"batch_history: wayback index with prefix: {cur_prefix + '/*'}")
-            waybacks, _ = crawl.wayback_index(cur_prefix + '/*', param_dict=param_dict, total_link=True)
-            for wayback in waybacks:
-                target_url = url_utils.filter_wayback(wayback[1])
-                self.wayback_index_cache[url_utils.url_norm(target_url)].append(wayback)
+        self._index_prefix(urls)
 
         url_any_history = {}
         for url in urls:
@@ -423,10 +527,8 @@ class HistRedirector:
         """Check whether found alias are N/A"""
         # * If today's url is not in the same site, not a valid redirection
         new_host = he.extract(alias)
-        new_host_url = f'http://{new_host}'
-        _, new_host_url = self.memo.crawl(new_host_url, final_url=True)
-        if new_host_url is None:
-            new_host_url = f'http://{new_host}'
+        site_info = site_resolver.resolve(new_host)
+        new_host_url = site_info.final_url if site_info is not None else f'http://{new_host}'
         # ? If live_working == False, no need to crawl liveweb
         if live_working:
             html, alias = self.memo.crawl(alias, final_url=True)
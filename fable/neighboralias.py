@@ -14,7 +14,7 @@ import threading
 from statistics import median
 
 from . import config, tools, searcher, histredirector, inferer, tracer
-from fable.utils import url_utils, crawl, sic_transit
+from fable.utils import url_utils, crawl, sic_transit, cdx_store
 
 he = url_utils.HostExtractor()
 
@@ -100,7 +100,7 @@ class NeighborAlias:
                 # 'collapse': ['urlkey'],
                 'output': 'json',
             }
-            w, _ = crawl.wayback_index(q, param_dict=param_dict)
+            w, _ = cdx_store.wayback_index(q, param_dict=param_dict)
             print(f"First query {q}: {len(w)}")
             same_w = [ww for ww in w if self._same_pattern(url, ww[1])]
             print(f"Second pattern: {len(same_w)}")
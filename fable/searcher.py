@@ -5,7 +5,7 @@ import re, regex, os
 from urllib.parse import urlsplit, urlunsplit
 
 from . import  tools, tracer
-from .utils import search, crawl, url_utils, sic_transit
+from .utils import search, crawl, url_utils, sic_transit, site_resolver
 
 import logging
 logging.setLoggerClass(tracer.tracer)
@@ -123,10 +123,9 @@ class Searcher:
 
         site = he.extract(url)
         if not site: return None, {'reason': "Fail to get site of URL (non http URL)"}
-        if '://' not in site: site = f'http://{site}'
-        _, final_url = self.memo.crawl(site, final_url=True)
-        if final_url is not None:
-            site = he.extract(final_url)
+        site_info = site_resolver.resolve(site)
+        if site_info is not None:
+            site = site_info.site
         try:
             wayback_url = self.memo.wayback_index(url)
             html = self.memo.crawl(wayback_url, proxies=self.PS.select())
@@ -347,10 +346,9 @@ class Searcher:
         site = he.extract(url)
         if not site: 
             return [(None, {'reason': "Fail to get site of URL (non http URL)"})]
-        if '://' not in site: site = f'http://{site}'
-        _, final_url = self.memo.crawl(site, final_url=True)
-        if final_url is not None:
-            site = he.extract(final_url)
+        site_info = site_resolver.resolve(site)
+        if site_info is not None:
+            site = site_info.site
         try:
             wayback_url = self.memo.wayback_index(url)
             html = self.memo.crawl(wayback_url, proxies=self.PS.select())
@@ -5,7 +5,7 @@ Methodologies: Content Match / Parital Match
 import pymongo
 from pymongo import MongoClient
 import brotli
-import re, os
+import re, os, sys
 import regex
 import time
 from collections import defaultdict
@@ -15,10 +15,12 @@ from dateutil import parser as dparser
 import datetime
 from urllib.parse import urlsplit, urlunsplit, parse_qsl
 import bisect
+from array import array
 from bs4 import BeautifulSoup
+from sortedcontainers import SortedDict, SortedKeyList
 
 from . import config, tracer
-from .utils import text_utils, crawl, url_utils, search
+from .utils import text_utils, crawl, url_utils, search, cache, cdx_store, minhash, site_resolver
 from .utils.url_utils import url_norm
 from .utils.sic_transit import text_norm
 
@@ -33,8 +35,31 @@ COMMON_TITLE_SIZE = 5 # Common prefix/suffix extraction's sample number of title
 
 VERTICAL_BAR_SET = '\u007C\u00A6\u2016\uFF5C\u2225\u01C0\u01C1\u2223\u2502\u0964\u0965'
 OTHER_DELIMITER_SET = '::'
+TITLE_DELIMITER_RE = regex.compile(rf'_| [{VERTICAL_BAR_SET}] |[{VERTICAL_BAR_SET}]| \p{{Pd}} |\p{{Pd}}| (?:{OTHER_DELIMITER_SET}) |(?:{OTHER_DELIMITER_SET})')
+# * Title template: segments shared by >= TEMPLATE_MIN_SHARE of >= TEMPLATE_MIN_TITLES distinct titles are boilerplate
+TEMPLATE_MIN_TITLES = 3
+TEMPLATE_MIN_SHARE = 0.5
+
+# * Seconds a failed crawl is cached for, by failure class. Can be overridden by "negative_cache_ttl" in config
+NEGATIVE_TTL = {
+    'http_404': 3600*24*7,
+    'http_4xx': 3600*24,
+    'http_transient': 600,
+    'http_5xx': 3600,
+    'not_html': 3600*24*7,
+    'dns': 3600*24,
+    'timeout': 3600,
+    'connection': 3600,
+    'robots': 3600*24,
+    'filtered_ext': 3600*24*30,
+    'error': 3600
+}
+NEGATIVE_TTL.update(config.NEGATIVE_CACHE_TTL or {})
+BLOCKED_FAILURES = {'robots', 'filtered_ext'}
 
 he = url_utils.HostExtractor()
+# * In-process tier in front of db, shared by all Memoizers in the process
+MEM_CACHE = cache.LRUCache(max_bytes=config.MEM_CACHE_BYTES, default_ttl=config.MEM_CACHE_TTL)
 
 def update_sites(collection):
     global he
@@ -56,17 +81,103 @@ def title_common(titles):
     return common
 
 
+class CrawlRecord:
+    """
+    Compact crawl entry of Similar's title index: no html/content is kept, only the content signature
+    html/content are loaded lazily by key (the crawled url) with load_html/load_content
+    Also readable as a dict (crawl['title'], crawl.get('ts')) like the crawl documents it replaces
+    """
+    __slots__ = ['key', 'url', 'title', 'ts', 'netloc_dir', 'minhash']
+
+    def __init__(self, key, url, title, netloc_dir, ts=None, minhash=None):
+        self.key = key
+        self.url = url
+        self.title = title
+        self.netloc_dir = netloc_dir
+        self.ts = ts
+        self.minhash = minhash
+
+    @classmethod
+    def from_crawl(cls, crawl, memo=None):
+        """
+        crawl: crawl document / dict with url, title and (minhash / content / html)
+        Content signature is computed here if not persisted, extracting content from html if required
+        """
+        if isinstance(crawl, CrawlRecord):
+            return crawl
+        key = crawl['url']
+        url, ts = key, crawl.get('ts')
+        if 'web.archive.org/web' in key:
+            url, ts = url_utils.filter_wayback(key), url_utils.get_ts(key)
+        ts = int(ts) if ts is not None else None
+        sig = crawl.get('minhash')
+        if sig is None and crawl.get('content') is None and crawl.get('html'):
+            try:
+                memo = memo if memo else Memoizer()
+                html = brotli.decompress(crawl['html']).decode()
+                crawl['content'] = memo.extract_content(html, version='boilerpipe', handle_exception=False)
+            except: pass
+        record = cls(sys.intern(key), sys.intern(url), sys.intern(crawl.get('title') or ''), \
+                     crawl.get('netloc_dir') or url_utils.netloc_dir(url), ts=ts, minhash=sig)
+        if sig is None:
+            record.minhash = minhash.signature(crawl.get('content', '') or '')
+        return record
+
+    def load_html(self, memo=None):
+        memo = memo if memo else Memoizer()
+        return memo.crawl(self.key)
+
+    def load_content(self, memo=None):
+        memo = memo if memo else Memoizer()
+        return memo.extract_content(self.load_html(memo))
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    @property
+    def nbytes(self):
+        """Approximate footprint, for cache.sizeof"""
+        return 3 * 56 + len(self.key) + len(self.url) + len(self.title) + 4 * minhash.NUM_PERM
+
+
+def crawl_signature(crawl):
+    """
+    MinHash signature of crawl's content
+    Use the signature persisted with the crawl/extraction record if there is one, and keep it in crawl
+    """
+    sig = crawl.get('minhash')
+    if isinstance(sig, (bytes, bytearray)):
+        sig = minhash.from_bytes(sig)
+    elif sig is None:
+        sig = minhash.signature(crawl.get('content', '') or '')
+    crawl['minhash'] = sig
+    return sig
+
+
 def different_page(url, meta, content, crawls, wayback=False):
     """
     Return pages with differnt content in crawls, that has closest title to it
     meta: metadata to identify index, title if not wayback, ts otherwise
     wayback: Whether to consider ts
     """
-    if not wayback:
-        crawl_meta = [c['title'] for c in crawls]
+    content_sig = minhash.signature(content or '')
+    if isinstance(crawls, SortedKeyList):
+        left_idx = crawls.bisect_key_right(int(meta) if wayback else meta)
     else:
-        crawl_meta = [c['ts'] for c in crawls]
-    left_idx = bisect.bisect(crawl_meta, meta)
+        crawl_meta = [c['ts'] for c in crawls] if wayback else [c['title'] for c in crawls]
+        left_idx = bisect.bisect(crawl_meta, meta)
     if left_idx >= len(crawls): left_idx -= 1
     right_idx = left_idx + 1
     left, right = left_idx >= 0, right_idx < len(crawls)
@@ -74,8 +185,7 @@ def different_page(url, meta, content, crawls, wayback=False):
     while left or right:
         if left:
             crawl_left = crawls[left_idx]
-            # TODO: Content comparison slows the process a lot
-            content_simi = text_utils.k_shingling(content, crawl_left.get('content', ''))
+            content_simi = minhash.similarity(content_sig, crawl_signature(crawl_left))
             if not url_utils.url_match(url, crawl_left['url']) \
               and (content_simi < 0.9 or max_content_simi >= 0.9): # * If three pages all have similar content, something wrong
                 return crawl_left
@@ -84,7 +194,7 @@ def different_page(url, meta, content, crawls, wayback=False):
             left = left_idx >= 0
         if right:
             crawl_right = crawls[right_idx]
-            content_simi = text_utils.k_shingling(content, crawl_right.get('content', ''))
+            content_simi = minhash.similarity(content_sig, crawl_signature(crawl_right))
             if not url_utils.url_match(url, crawl_right['url']) \
               and (content_simi < 0.9 or max_content_simi >= 0.9): # * If three pages all have similar content, something wrong
                 return crawl_right
@@ -93,39 +203,115 @@ def different_page(url, meta, content, crawls, wayback=False):
             right = right_idx < len(crawls)
     
 
+class SiteMeta:
+    """
+    Crawls of a site indexed by netloc_dir, for unique_title's neighbour walking
+    Buckets are sorted by title (liveweb) or int ts (wayback), all insertions are O(log n)
+    Also a sequence of [netloc_dir, bucket] in netloc_dir order, so that index i is a neighbour of i-1 and i+1
+    """
+    def __init__(self, wayback=False):
+        self.wayback = wayback
+        self._dirs = SortedDict() # * {netloc_dir: SortedKeyList(crawls)}
+        # * Title segment counts of netloc_dir / host, updated on add so templates are never relearned from scratch
+        self._titles = defaultdict(set) # * {netloc_dir or host: distinct titles}
+        self._seg_counts = defaultdict(lambda: defaultdict(int)) # * {netloc_dir or host: {segment: #titles having it}}
+        self._shared_segs = defaultdict(set) # * {netloc_dir or host: segments of >= 2 titles}, the only template candidates
+        self._multi_titles = defaultdict(int) # * {netloc_dir or host: #titles with >= 2 segments}
+        self._templates = {} # * {netloc_dir or host: template}, dropped when a new title is counted
+
+    def _crawl_key(self, crawl):
+        return int(crawl['ts']) if self.wayback else crawl['title']
+
+    def add(self, nd, crawl):
+        """Equal keys are kept in insertion order"""
+        bucket = self._dirs.get(nd)
+        if bucket is None:
+            bucket = SortedKeyList(key=self._crawl_key)
+            self._dirs[nd] = bucket
+        bucket.add(crawl)
+        title = crawl.get('title')
+        if title:
+            self._count_title(nd, title)
+            self._count_title(nd[0], title)
+
+    def _count_title(self, key, title):
+        """Count segments of title under key if not seen, in O(#segments)"""
+        if title in self._titles[key]:
+            return
+        self._titles[key].add(title)
+        segs = title_segments(title)
+        if len(segs) < 2:
+            return
+        self._multi_titles[key] += 1
+        seg_counts = self._seg_counts[key]
+        for seg in set(segs):
+            seg_counts[seg] += 1
+            if seg_counts[seg] == 2:
+                self._shared_segs[key].add(seg)
+        self._templates.pop(key, None)
+
+    def _learn_template(self, key):
+        """Boilerplate segments of titles under key, from the counted segments"""
+        if key in self._templates:
+            return self._templates[key]
+        multi_titles = self._multi_titles.get(key, 0)
+        template = None
+        if multi_titles >= TEMPLATE_MIN_TITLES:
+            seg_counts = self._seg_counts[key]
+            template = frozenset(seg for seg in self._shared_segs[key] \
+                                 if seg_counts[seg] >= TEMPLATE_MIN_SHARE * multi_titles)
+        self._templates[key] = template
+        return template
+
+    def title_template(self, nd):
+        """
+        Boilerplate title segments (e.g. site name) of netloc_dir, falling back to its whole host
+        Return: frozenset of segments, None if there are not enough titles to learn from
+        """
+        template = self._learn_template(nd)
+        if not template:
+            template = self._learn_template(nd[0])
+        return template or None
+
+    def bisect_left(self, nd):
+        return self._dirs.bisect_left(nd)
+
+    def get(self, nd, default=None):
+        return self._dirs.get(nd, default)
+
+    def __getitem__(self, idx):
+        nd, bucket = self._dirs.peekitem(idx)
+        return [nd, bucket]
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def __iter__(self):
+        for nd, bucket in self._dirs.items():
+            yield [nd, bucket]
+
+
+def title_segments(title):
+    """Split title into segments on delimiters (e.g. |, -, ::)"""
+    return [t.strip() for t in TITLE_DELIMITER_RE.split(title)]
+
+
 def title_prepare(crawls, wayback=False):
     """
     Prepapre required data structures for unique_title
-    crawls: URLs' crawls with title, HTML, content (if applicable)
+    crawls: URLs' crawls (CrawlRecord, or dict with title, HTML, content (if applicable))
     wayback: whether the common prefix/suffix extraction is for wayback urls. If set to False, mean liveweb pages.
     
-    Returns: site_meta
+    Returns: site_meta (SiteMeta of CrawlRecord)
         
     """
-    netloc_dir = defaultdict(list)
+    site_meta = SiteMeta(wayback=wayback)
     memo = Memoizer()
     for ut in crawls:
-        if 'content' not in ut:
-            try:
-                html = brotli.decompress(ut['html']).decode()
-                ut['content'] = memo.extract_content(html, version='boilerpipe', handle_exception=False)
-            except: pass
-        if wayback:
-            ut.update({
-                'url': url_utils.filter_wayback(ut['url']),
-                'ts': url_utils.get_ts(ut['url'])
-            })
-        nd = url_utils.netloc_dir(ut['url'])
-        netloc_dir[nd].append(ut)
-    url_meta = [[k, v] for k, v in netloc_dir.items()]
-    url_meta.sort(key=lambda x: x[0])
-    # * Sort the crawls in the same netloc_dir by title, so that same title are put together
-    for i in range(len(url_meta)):
-        if not wayback:
-            url_meta[i][1] = sorted(url_meta[i][1], key=lambda x: x['title'])
-        else:
-            url_meta[i][1] = sorted(url_meta[i][1], key=lambda x: int(x['ts']))
-    return url_meta
+        record = CrawlRecord.from_crawl(ut, memo=memo)
+        # * Crawls in the same netloc_dir are sorted by title, so that same title are put together
+        site_meta.add(record.netloc_dir, record)
+    return site_meta
 
 
 def token_intersect(title1_token, title2_token):
@@ -145,16 +331,28 @@ def unique_title(url, title, content, site_url_meta, wayback=False, return_commo
     """
     Eliminate common suffix/prefix of certain site for liveweb
     url: full url (if wayback, url including web.archive.org)
-    site_url_meta: [[netloc_dir, [crawls]]] sorted in netloc_dir
+    site_url_meta: SiteMeta, [[netloc_dir, [crawls]]] sorted in netloc_dir
     
     Returns: prefix/suffix filtered title, prefix/suffix if return_common_part is True
     """
-    title_tokens = regex.split(f'_| [{VERTICAL_BAR_SET}] |[{VERTICAL_BAR_SET}]| \p{{Pd}} |\p{{Pd}}| (?:{OTHER_DELIMITER_SET}) |(?:{OTHER_DELIMITER_SET})', title)
-    title_tokens = [t.strip() for t in title_tokens]
+    title_tokens = title_segments(title)
     if wayback:
         url, ts = url_utils.filter_wayback(url), url_utils.get_ts(url)
     nd = url_utils.netloc_dir(url)
-    close_idx = bisect.bisect_left(site_url_meta, [nd, []])
+    if len(title_tokens) <= 1: # * token_intersect never finds common part of title without separator
+        tracer.debug(f'unique_title: {url} --> "{title.strip()}"')
+        return title.strip()
+    # * Fast path: strip segments of the learned title template
+    if isinstance(site_url_meta, SiteMeta):
+        template = site_url_meta.title_template(nd)
+        utitle = ' '.join([tt for tt in title_tokens if tt not in template]).strip() if template else ''
+        if utitle:
+            tracer.debug(f'unique_title (template): {url} --> "{utitle}"')
+            return utitle
+    if isinstance(site_url_meta, SiteMeta):
+        close_idx = site_url_meta.bisect_left(nd)
+    else:
+        close_idx = bisect.bisect_left(site_url_meta, [nd, []])
     if close_idx == len(site_url_meta):
         close_idx -= 1 # * In case close_idx is the out of bound
     upidx, downidx = close_idx, close_idx + 1
@@ -195,8 +393,7 @@ def unique_title(url, title, content, site_url_meta, wayback=False, return_commo
             tocheck[0], tocheck[1] = min(tocheck, key=lambda x:x[0]), max(tocheck, key=lambda x:x[0])
         for td, cand_url, cand_title in tocheck:
             diffs.add(td)
-            cand_title_tokens = regex.split(f'_| [{VERTICAL_BAR_SET}] |[{VERTICAL_BAR_SET}]| \p{{Pd}} |\p{{Pd}}| (?:{OTHER_DELIMITER_SET}) |(?:{OTHER_DELIMITER_SET})', cand_title)
-            cand_title_tokens = [t.strip() for t in cand_title_tokens]
+            cand_title_tokens = title_segments(cand_title)
             itsts = token_intersect(title_tokens, cand_title_tokens)
             if len(itsts) > 0:
                 break
@@ -232,6 +429,9 @@ def norm_path(url):
 
 def date_parse(date):
     """Wrapper around dparser.parse to handle exceptions"""
+    d = url_utils.ts_to_datetime(date)
+    if d is not None:
+        return d
     trim = [len(date), 8, 4]
     for t in trim:
         try:
@@ -241,19 +441,165 @@ def date_parse(date):
             pass
     return datetime.datetime.now()
 
+def _ts_array(tss):
+    """Sorted int64 array of wayback timestamps"""
+    if isinstance(tss, array):
+        return tss
+    return array('q', sorted(int(t) for t in tss))
+
+def _compact_index(record):
+    """wayback_index record with ts stored in int arrays, for keeping in memory"""
+    if isinstance(record.get('ts_nb'), array):
+        return record
+    ts_nb = record.get('ts_nb', [])
+    compact = {'url': record['url'], 'ts': _ts_array(record.get('ts', [])), 'ts_nb': _ts_array(ts_nb)}
+    # * CDX metadata aligned with ts_nb, only available for records indexed with it
+    if len(record.get('digest', [])) == len(ts_nb) and len(record.get('length', [])) == len(ts_nb):
+        order = sorted(range(len(ts_nb)), key=lambda i: int(ts_nb[i]))
+        compact['digest'] = [record['digest'][i] for i in order]
+        compact['length'] = array('q', [int(record['length'][i]) for i in order])
+    return compact
+
+def _snapshot_meta(record, ts):
+    """(digest, length) of snapshot ts in compact index record. None if not available"""
+    if 'digest' not in record:
+        return None
+    tss = record['ts_nb']
+    i = bisect.bisect_left(tss, int(ts))
+    if i < len(tss) and tss[i] == int(ts) and record['length'][i] > 0 and record['digest'][i] not in ['', '-']:
+        return record['digest'][i], record['length'][i]
+    return None
+
 class Memoizer:
     """
     Class for reducing crawl and wayback indexing
     """
-    def __init__(self, use_db=True, db=None, proxies={}):
+    def __init__(self, use_db=True, db=None, proxies={}, mem_cache=None):
         """
+        mem_cache: cache.LRUCache in front of db. If None, use the process-wide MEM_CACHE
         # TODO: Implement non-db version. (In mem version)
         """
         self.use_db = use_db
         if use_db:
             self.db = config.new_db() if not db else db
         self.PS = crawl.ProxySelector(proxies)
+        self.mem_cache = mem_cache if mem_cache is not None else MEM_CACHE
     
+    def cache_stats(self):
+        """Hit/miss counters of the in-process tier"""
+        return self.mem_cache.stats()
+
+    def _cache_crawl(self, url, html, fu, ttl, is_wayback, html_digest=None):
+        """
+        Put decompressed crawl into mem_cache. Liveweb crawls never outlive their db ttl
+        Also remember which urls have this html, so that extractions (keyed by html digest) can reach site_titles
+        """
+        mem_ttl = None if is_wayback else min(ttl - time.time(), self.mem_cache.default_ttl or float('inf'))
+        self.mem_cache.set(('crawl', url), {'html': html, 'final_url': fu}, ttl=mem_ttl)
+        html_digest = html_digest or cache.digest(html)
+        digest_urls = self.mem_cache.get(('digest_urls', html_digest)) or ()
+        if url not in digest_urls:
+            self.mem_cache.set(('digest_urls', html_digest), digest_urls + (url,), ttl=mem_ttl)
+
+    def _backfill_digest(self, doc, html):
+        """
+        Crawls saved before extraction was keyed by html digest carry title/content themselves
+        Seed extraction with them and set the crawl's html_digest, so they are only read once
+        Return: html digest
+        """
+        html_digest = doc.get('html_digest')
+        if html_digest:
+            return html_digest
+        html_digest = cache.digest(html)
+        fields = {k: doc[k] for k in ['title', 'content'] if k in doc}
+        try:
+            if len(fields) > 0:
+                self.db.extraction.update_one({'_id': html_digest}, {'$setOnInsert': fields}, upsert=True)
+            self.db.crawl.update_one({'_id': doc['_id']}, {'$set': {'html_digest': html_digest}})
+        except Exception as e: tracer.warn(f'backfill digest: {doc["_id"]} {str(e)}')
+        return html_digest
+
+    def _crawl_ttl(self, resp):
+        """Calculate cache expire date from the response's cache-control header"""
+        headers = {k.lower(): v.lower() for k, v in resp.headers.items()}
+        cache_age = DEFAULT_CACHE
+        if 'cache-control' in headers:
+            v = headers['cache-control']
+            pp_in = 'public' in v or 'private' in v
+            maxage_in = 'max-age' in v
+            v = v.split(',')
+            if maxage_in:
+                try:
+                    age = [int(vv.split('=')[1]) for vv in v if 'max-age' in vv][0]
+                    cache_age = max(cache_age, age)
+                except:
+                    cache_age = DEFAULT_CACHE
+            elif pp_in:
+                cache_age = DEFAULT_CACHE
+        return time.time() + cache_age
+
+    def _crawl_record(self, url, html, ttl, fu=None, html_digest=None):
+        """Build the db.crawl document of a fresh crawl"""
+        obj = {
+            "_id": url,
+            "url": url,
+            "site": he.extract(url, wayback='web.archive.org/web' in url),
+            "html": brotli.compress(html.encode()),
+            "html_digest": html_digest or cache.digest(html),
+            "ttl": ttl
+        }
+        if fu is not None: obj.update({'final_url': fu})
+        return obj
+
+    def _get_negative(self, urls):
+        """
+        Look up cached crawl failures of urls
+        Return: {url: failure class} for urls that recently failed
+        """
+        negatives = {}
+        misses = []
+        for url in urls:
+            failure = self.mem_cache.get(('crawl_negative', url))
+            if failure:
+                negatives[url] = failure
+            else:
+                misses.append(url)
+        if len(misses) == 0:
+            return negatives
+        try:
+            docs = self.db.crawl_negative.find({'_id': {'$in': misses}, 'ttl': {'$gt': time.time()}})
+            for doc in docs:
+                negatives[doc['_id']] = doc['failure']
+                self.mem_cache.set(('crawl_negative', doc['_id']), doc['failure'], ttl=doc['ttl'] - time.time())
+        except Exception as e: tracer.warn(f'get_negative: {str(e)}')
+        return negatives
+
+    def _set_negative(self, url_failures):
+        """Cache crawl failures {url: failure class} with ttl based on the class"""
+        ops = []
+        for url, failure in url_failures.items():
+            ttl = NEGATIVE_TTL.get(failure, NEGATIVE_TTL['error'])
+            self.mem_cache.set(('crawl_negative', url), failure, ttl=ttl)
+            obj = {'url': url, 'failure': failure, 'ttl': time.time() + ttl}
+            ops.append(pymongo.UpdateOne({'_id': url}, {'$set': obj}, upsert=True))
+        if len(ops) > 0:
+            try:
+                self.db.crawl_negative.bulk_write(ops, ordered=False)
+            except Exception as e: tracer.warn(f'set_negative: {str(e)}')
+
+    def _fetch(self, url, **kwargs):
+        """
+        crawl.requests_crawl_status of url
+        If wayback_raw is set, wayback pages are fetched as original captures (id_) without toolbar and rewritten links,
+            and the final url is turned back into canonical wayback form
+        """
+        if not (config.WAYBACK_RAW and 'web.archive.org/web' in url):
+            return crawl.requests_crawl_status(url, raw=True, **kwargs)
+        resp, failure = crawl.requests_crawl_status(url_utils.wayback_raw(url), raw=True, **kwargs)
+        if resp is not None:
+            resp.url = url_utils.wayback_canonical(resp.url)
+        return resp, failure
+
     def crawl(self, url, final_url=False, max_retry=0, **kwargs):
         """
         final_url: Whether also return final redirected URLS
@@ -261,24 +607,43 @@ class Memoizer:
         TODO: non-db version
         """
         is_wayback = 'web.archive.org/web' in url
+        cached = self.mem_cache.get(('crawl', url))
+        if cached and (not final_url or cached['final_url']):
+            if not final_url:
+                return cached['html']
+            else:
+                return cached['html'], cached['final_url']
         if not final_url:
             html = self.db.crawl.find_one({'_id': url})
         else:
             html = self.db.crawl.find_one({'_id': url, 'final_url': {"$exists": True}})
         if html and (html['ttl'] > time.time() or is_wayback):
             tracer.debug(f'memo.crawl: db has the valid crawl')
+            decompressed = brotli.decompress(html['html']).decode()
+            html_digest = self._backfill_digest(html, decompressed)
+            self._cache_crawl(url, decompressed, html.get('final_url'), html['ttl'], is_wayback, html_digest=html_digest)
             if not final_url:
-                return brotli.decompress(html['html']).decode()
+                return decompressed
             else:
-                return brotli.decompress(html['html']).decode(), html['final_url']  
+                return decompressed, html['final_url']  
         elif html:
             try:
                 self.db.crawl.update_one({'_id': url}, {'$unset': {'title': '', 'content': ''}}) 
+                self.db.site_titles.delete_one({'_id': url}) # * Expired title must not feed Similar's title index
+                self.mem_cache.delete(('site_title', url))
             except: pass
+        negative = self._get_negative([url])
+        if url in negative:
+            tracer.debug(f'memo.crawl: {url} recently failed with {negative[url]}')
+            if not final_url:
+                return None
+            else:
+                return None, None
         retry = 0
-        resp = crawl.requests_crawl(url, raw=True, **kwargs)
-        if isinstance(resp, tuple) and resp[0] is None:
-            tracer.info(f'requests_crawl: Blocked url {url}, {resp[1]}')
+        resp, failure = self._fetch(url, **kwargs)
+        if failure in BLOCKED_FAILURES:
+            tracer.info(f'requests_crawl: Blocked url {url}, {failure}')
+            self._set_negative({url: failure})
             if not final_url:
                 return None
             else:
@@ -288,9 +653,10 @@ class Memoizer:
         while retry < max_retry and resp is None:
             retry += 1
             time.sleep(5)
-            resp = crawl.requests_crawl(url, raw=True, **kwargs)
+            resp, failure = self._fetch(url, **kwargs)
         if resp is None:
             tracer.info(f'requests_crawl: Unable to get HTML of {url}')
+            self._set_negative({url: failure})
             if not final_url:
                 return None
             else:
@@ -298,42 +664,170 @@ class Memoizer:
         html = resp.text
         if final_url:
             fu = resp.url
+        ttl = self._crawl_ttl(resp)
 
-        # Calculate cache expire date
-        headers = {k.lower(): v.lower() for k, v in resp.headers.items()}
-        cache_age = DEFAULT_CACHE
-        if 'cache-control' in headers:
-            v = headers['cache-control']
-            pp_in = 'public' in v or 'private' in v
-            maxage_in = 'max-age' in v
-            v = v.split(',')
-            if maxage_in:
-                try:
-                    age = [int(vv.split('=')[1]) for vv in v if 'max-age' in vv][0]
-                    cache_age = max(cache_age, age)
-                except:
-                    cache_age = DEFAULT_CACHE
-            elif pp_in:
-                cache_age = DEFAULT_CACHE
-        ttl = time.time() + cache_age
-
+        html_digest = cache.digest(html)
         try:
-            obj = {
-                "_id": url,
-                "url": url,
-                "site": he.extract(url, wayback=is_wayback),
-                "html": brotli.compress(html.encode()),
-                "ttl": ttl
-            }
-            if final_url: obj.update({'final_url': fu})
+            obj = self._crawl_record(url, html, ttl, fu=fu if final_url else None, html_digest=html_digest)
             self.db.crawl.update_one({'_id': url}, {"$set": obj}, upsert=True)
         except Exception as e: tracer.warn(f'crawl: {url} {str(e)}')
         tracer.debug(f'memo.crawl: upsert crawl {url}')
+        self._cache_crawl(url, html, resp.url, ttl, is_wayback, html_digest=html_digest)
         if not final_url:
             return html
         else:
             return html, fu
-    
+
+    def crawl_many(self, urls, final_url=False, max_retry=0, **kwargs):
+        """
+        Batch version of crawl
+        Cached crawls are looked up with one db query, the rest are crawled concurrently
+            and written back with one bulk write
+        kwargs: Arguments for crawl.requests_crawl
+
+        Return: [crawl(url)] in the same order of urls
+        """
+        results = {}
+        misses = []
+        for url in dict.fromkeys(urls):
+            cached = self.mem_cache.get(('crawl', url))
+            if cached and (not final_url or cached['final_url']):
+                results[url] = (cached['html'], cached['final_url'])
+            else:
+                misses.append(url)
+        
+        stales = []
+        if len(misses) > 0:
+            q = {'_id': {'$in': misses}}
+            if final_url: q.update({'final_url': {"$exists": True}})
+            projection = {'html': True, 'ttl': True, 'final_url': True, 'html_digest': True, 'title': True, 'content': True}
+            for doc in self.db.crawl.find(q, projection):
+                url = doc['_id']
+                is_wayback = 'web.archive.org/web' in url
+                if doc['ttl'] > time.time() or is_wayback:
+                    html = brotli.decompress(doc['html']).decode()
+                    html_digest = self._backfill_digest(doc, html)
+                    self._cache_crawl(url, html, doc.get('final_url'), doc['ttl'], is_wayback, html_digest=html_digest)
+                    results[url] = (html, doc.get('final_url'))
+                else:
+                    stales.append(url)
+            misses = [u for u in misses if u not in results]
+            negative = self._get_negative(misses)
+            for url in negative:
+                results[url] = (None, None)
+            misses = [u for u in misses if u not in results]
+            tracer.debug(f'memo.crawl_many: {len(results)} cached, {len(misses)} to crawl')
+
+        retry = 0
+        to_crawl = misses
+        resps, failures = {}, {}
+        while len(to_crawl) > 0:
+            crawled = crawl.map_concurrent(lambda u: self._fetch(u, **kwargs), to_crawl)
+            for url, (resp, failure) in zip(to_crawl, crawled):
+                resps[url] = resp
+                if failure in BLOCKED_FAILURES:
+                    tracer.info(f'requests_crawl: Blocked url {url}, {failure}')
+                if failure:
+                    failures[url] = failure
+                else:
+                    failures.pop(url, None)
+            to_crawl = [u for u in to_crawl if u in failures and failures[u] not in BLOCKED_FAILURES]
+            if retry >= max_retry:
+                break
+            retry += 1
+            time.sleep(5)
+        self._set_negative(failures)
+        
+        ops = [pymongo.UpdateOne({'_id': url}, {'$unset': {'title': '', 'content': ''}}) for url in stales]
+        for url, resp in resps.items():
+            if resp is None:
+                tracer.info(f'requests_crawl: Unable to get HTML of {url}')
+                results[url] = (None, None)
+                continue
+            html, ttl = resp.text, self._crawl_ttl(resp)
+            html_digest = cache.digest(html)
+            try:
+                obj = self._crawl_record(url, html, ttl, fu=resp.url if final_url else None, html_digest=html_digest)
+                ops.append(pymongo.UpdateOne({'_id': url}, {"$set": obj}, upsert=True))
+            except Exception as e: tracer.warn(f'crawl_many: {url} {str(e)}')
+            self._cache_crawl(url, html, resp.url, ttl, 'web.archive.org/web' in url, html_digest=html_digest)
+            results[url] = (html, resp.url)
+        if len(ops) > 0:
+            try:
+                self.db.crawl.bulk_write(ops, ordered=False)
+            except Exception as e: tracer.warn(f'crawl_many: {str(e)}')
+        if len(stales) > 0:
+            try:
+                self.db.site_titles.delete_many({'_id': {'$in': list(stales)}})
+            except Exception as e: tracer.warn(f'crawl_many: {str(e)}')
+            for url in stales:
+                self.mem_cache.delete(('site_title', url))
+        
+        if not final_url:
+            return [results[url][0] for url in urls]
+        else:
+            return [results[url] for url in urls]
+
+    def _wayback_index_record(self, url, **kwargs):
+        """
+        Query wayback CDX for url's snapshots
+        Return: {url, ts, ts_nb, digest, length} or None if no snapshots
+            digest and length are aligned with ts_nb
+        """
+        param_dict = {
+            "filter": ['statuscode:[23][0-9]*', 'mimetype:text/html'],
+            "collapse": "timestamp:8"
+        }
+        cps, status = cdx_store.get_store().cdx(url, param_dict=param_dict, **kwargs)
+        tracer.debug('Wayback Index (tools.py): Get wayback query response')
+        if len(cps) == 0: # No snapshots
+            tracer.info(f"Wayback Index: No snapshots {status}")
+            return None
+        cps.sort(key=lambda x: x[1])
+        return {
+            'url': url,
+            'ts': [c[1] for c in cps if str(c[4])[0] == '2'],
+            'ts_nb': [c[1] for c in cps],
+            'digest': [c[5] for c in cps],
+            'length': [int(c[6]) if str(c[6]).isdigit() else -1 for c in cps]
+        }
+
+    def wayback_index_records(self, urls, fetch_missing=True, **kwargs):
+        """
+        Batch lookup of the snapshot index ({url, ts, ts_nb}) of urls. ts and ts_nb are sorted int arrays
+        Cached ones are looked up with one db query, the rest are queried concurrently
+        fetch_missing: Whether to query wayback for urls not in db
+
+        Return: [record or None] in the same order of urls
+        """
+        records = {}
+        misses = []
+        for url in dict.fromkeys(urls):
+            record = self.mem_cache.get(('wayback_index', url))
+            if record:
+                records[url] = record
+            else:
+                misses.append(url)
+        if len(misses) > 0:
+            for record in self.db.wayback_index.find({'_id': {'$in': misses}}):
+                records[record['_id']] = _compact_index(record)
+                self.mem_cache.set(('wayback_index', record['_id']), records[record['_id']])
+            misses = [u for u in misses if u not in records]
+        if fetch_missing and len(misses) > 0:
+            tracer.debug(f'memo.wayback_index_records: {len(misses)} to query')
+            fetched = crawl.map_concurrent(lambda u: self._wayback_index_record(u, **kwargs), misses)
+            ops = []
+            for url, record in zip(misses, fetched):
+                if record is None: continue
+                ops.append(pymongo.UpdateOne({"_id": url}, {'$set': record}, upsert=True))
+                records[url] = _compact_index(record)
+                self.mem_cache.set(('wayback_index', url), records[url])
+            if len(ops) > 0:
+                try:
+                    self.db.wayback_index.bulk_write(ops, ordered=False)
+                except: pass
+        return [records.get(url) for url in urls]
+
     def wayback_index(self, url, policy='latest-rep', ts=None, all_none_400=False, **kwargs):
         """
         Get most representative snapshot for a certain url
@@ -352,70 +846,138 @@ class Memoizer:
         assert(policy in {'latest-rep', 'closest-later', 'closest-earlier', 'earliest', 'latest', 'closest', 'all'})
         wayback_q = {"url": url, "policy": policy}
         if policy == 'latest-rep':
+            wayback_url = self.mem_cache.get(('wayback_rep', url))
+            if wayback_url:
+                return wayback_url
             wayback_url = self.db.wayback_rep.find_one(wayback_q)
             if wayback_url:
+                self.mem_cache.set(('wayback_rep', url), wayback_url['wayback_url'])
                 return wayback_url['wayback_url']
-        param_dict = {
-            "filter": ['statuscode:[23][0-9]*', 'mimetype:text/html'],
-            "collapse": "timestamp:8"
-        }
-        nb_map = {True: 'ts_nb', False: 'ts'}
-        cps = self.db.wayback_index.find_one({'_id': url})
+        cps = self.mem_cache.get(('wayback_index', url))
         if not cps:
-            cps, status = crawl.wayback_index(url, param_dict=param_dict, total_link=True, **kwargs)
-            tracer.debug('Wayback Index (tools.py): Get wayback query response')
-            if len(cps) == 0: # No snapshots
-                tracer.info(f"Wayback Index: No snapshots {status}")
+            cps = self.db.wayback_index.find_one({'_id': url})
+        if not cps:
+            cps = self._wayback_index_record(url, **kwargs)
+            if cps is None:
                 return None if policy not in ['all'] else []
-            cps.sort(key=lambda x: x[0])
-            update_dict = {
-                'url': url,
-                'ts': [c[0] for c in cps if str(c[2])[0] == '2'],
-                'ts_nb': [c[0] for c in cps]
-            }
             try:
-                self.db.wayback_index.update_one({"_id": url}, {'$set': update_dict}, upsert=True)
+                self.db.wayback_index.update_one({"_id": url}, {'$set': cps}, upsert=True)
             except: pass
-            cps = update_dict
         else:
             tracer.debug('Wayback Index (tools.py): db has wayback_index')
-        
-        cps = [(c, url_utils.constr_wayback(url, c)) for c in cps[nb_map[all_none_400]]]
-        if len(cps) == 0:
+        cps = _compact_index(cps)
+        self.mem_cache.set(('wayback_index', url), cps)
+        return self._apply_policy(url, cps, policy, ts=ts, all_none_400=all_none_400)
+
+    def wayback_index_many(self, urls, policy='latest-rep', ts=None, all_none_400=False, **kwargs):
+        """
+        Batch version of wayback_index. Arguments are the same, ts is shared by all urls
+        Return: [wayback_index(url)] in the same order of urls
+        """
+        assert(policy in {'latest-rep', 'closest-later', 'closest-earlier', 'earliest', 'latest', 'closest', 'all'})
+        results = {}
+        uniq_urls = list(dict.fromkeys(urls))
+        if policy == 'latest-rep':
+            for url in uniq_urls:
+                wayback_url = self.mem_cache.get(('wayback_rep', url))
+                if wayback_url:
+                    results[url] = wayback_url
+            misses = [u for u in uniq_urls if u not in results]
+            if len(misses) > 0:
+                for rep in self.db.wayback_rep.find({'url': {'$in': misses}, 'policy': policy}):
+                    results[rep['url']] = rep['wayback_url']
+                    self.mem_cache.set(('wayback_rep', rep['url']), rep['wayback_url'])
+        misses = [u for u in uniq_urls if u not in results]
+        records = self.wayback_index_records(misses, **kwargs)
+        empty = None if policy not in ['all'] else []
+        # * latest-rep needs to crawl snapshots for each url, run them concurrently
+        picked = crawl.map_concurrent(
+            lambda x: self._apply_policy(x[0], x[1], policy, ts=ts, all_none_400=all_none_400) if x[1] else empty,
+            list(zip(misses, records))
+        )
+        results.update(zip(misses, picked))
+        return [results[url] for url in urls]
+
+    def _representative_by_meta(self, record, cps_sample):
+        """
+        Pick the representative snapshot with CDX digest and length
+        Identical captures (same digest) are deduped, and the median by length is picked
+        Only the picked snapshot is crawled. If it fails, pick again from the rest
+        Return: (ts, wayback_url), None if metadata is missing or ambiguous (lengths tie)
+        """
+        metas = {ts: _snapshot_meta(record, ts) for ts, _ in cps_sample}
+        if not all(metas.values()):
+            return None
+        uniq = {}
+        for ts, wayback_url in cps_sample:
+            uniq[metas[ts][0]] = (ts, wayback_url) # * Keep the latest capture of each digest
+        cands = sorted(uniq.values(), key=lambda x: metas[x[0]][1])
+        lengths = [metas[c[0]][1] for c in cands]
+        if len(set(lengths)) < len(lengths):
+            return None
+        while len(cands) > 0:
+            rep = cands[int((len(cands)-1)/2)]
+            if self.crawl(rep[1], proxies=self.PS.select()) is not None:
+                return rep
+            cands.remove(rep)
+        return cps_sample[-1]
+
+    def _representative_by_content(self, cps_sample):
+        """Pick the representative snapshot by crawling all samples and take the median by content length"""
+        cps_dict = {}
+        for ts, wayback_url in cps_sample:
+            html = self.crawl(wayback_url, proxies=self.PS.select())
+            if html is None: continue
+            # TODO: Domditiller vs Boilerpipe --> Acc vs Speed?
+            content = text_utils.extract_body(html, version='boilerpipe')
+            # title = text_utils.extract_title(html, version='newspaper')
+            cps_dict[ts] = (ts, wayback_url, content)
+        if len(cps_dict) > 0:
+            rep = sorted(cps_dict.values(), key=lambda x: len(x[2].split()))[int((len(cps_dict)-1)/2)]
+            return rep[:2]
+        else:
+            return cps_sample[-1]
+
+    def _apply_policy(self, url, cps, policy, ts=None, all_none_400=False):
+        """Pick snapshot(s) from index record cps based on policy. See wayback_index"""
+        nb_map = {True: 'ts_nb', False: 'ts'}
+        tss = _ts_array(cps[nb_map[all_none_400]])
+        if len(tss) == 0:
             return None if policy not in ['all'] else []
 
+        if policy in ['closest', 'closest-later', 'closest-earlier']:
+            target = url_utils.ts_to_int(ts)
+            if target is None:
+                target = int(date_parse(str(ts)).strftime('%Y%m%d%H%M%S'))
         if policy == 'closest':
-            sec_diff = lambda x: (date_parse(str(x)) - date_parse(str(ts))).total_seconds()
-            cps_close = [(cp, abs(sec_diff(cp[0]))) for cp in cps]
-            return sorted(cps_close, key=lambda x: x[1])[0][0][1]
+            i = bisect.bisect_left(tss, target)
+            if i == 0 or i == len(tss):
+                chosen = tss[min(i, len(tss)-1)]
+            else:
+                # * Compare exact seconds of the two neighbors, earlier one wins ties
+                target_sec = url_utils.ts_to_seconds(target)
+                before, after = tss[i-1], tss[i]
+                chosen = before if target_sec - url_utils.ts_to_seconds(before) <= url_utils.ts_to_seconds(after) - target_sec else after
         elif policy == 'closest-later':
-            cps_later = [cp for cp in cps if int(cp[0]) >= int(ts)]
-            return cps_later[0][1] if len(cps_later) > 0 else cps[-1][1]
+            i = bisect.bisect_left(tss, target)
+            chosen = tss[i] if i < len(tss) else tss[-1]
         elif policy == 'closest-earlier':
-            cps_earlier = [cp for cp in cps if int(cp[0]) <= int(ts)]
-            return cps_earlier[-1][1] if len(cps_earlier) > 0 else cps[0][1]
+            i = bisect.bisect_right(tss, target)
+            chosen = tss[i-1] if i > 0 else tss[0]
         elif policy == 'earliest':
-            return cps[0][1]
+            chosen = tss[0]
         elif policy == 'latest':
-            return cps[-1][1]
+            chosen = tss[-1]
         elif policy == 'all':
-            return cps
+            return [(str(c), url_utils.constr_wayback(url, c)) for c in tss]
         elif policy == 'latest-rep':
             # Get latest 6 snapshots, and random sample 3 for finding representative results
-            cps_sample = cps[-3:] if len(cps) >= 3 else cps
-            cps_sample = [(cp[0], cp[1]) for cp in cps_sample if (date_parse(cps_sample[-1][0]) - date_parse(cp[0])).days <= 180]
-            cps_dict = {}
-            for ts, wayback_url in cps_sample:
-                html = self.crawl(wayback_url, proxies=self.PS.select())
-                if html is None: continue
-                # TODO: Domditiller vs Boilerpipe --> Acc vs Speed?
-                content = text_utils.extract_body(html, version='boilerpipe')
-                # title = text_utils.extract_title(html, version='newspaper')
-                cps_dict[ts] = (ts, wayback_url, content)
-            if len(cps_dict) > 0:
-                rep = sorted(cps_dict.values(), key=lambda x: len(x[2].split()))[int((len(cps_dict)-1)/2)]
-            else:
-                rep = cps_sample[-1]
+            cps_sample = [(str(c), url_utils.constr_wayback(url, c)) for c in tss[-3:]]
+            latest_sec = url_utils.ts_to_seconds(cps_sample[-1][0])
+            cps_sample = [(cp[0], cp[1]) for cp in cps_sample if (latest_sec - url_utils.ts_to_seconds(cp[0])) // (3600*24) <= 180]
+            rep = self._representative_by_meta(cps, cps_sample)
+            if rep is None:
+                rep = self._representative_by_content(cps_sample)
             try:
                 self.db.wayback_rep.insert_one({
                     "url": url,
@@ -424,27 +986,88 @@ class Memoizer:
                     'policy': 'latest-rep'
                 })
             except Exception as e: pass
+            self.mem_cache.set(('wayback_rep', url), rep[1])
             return rep[1]
         else:
             tracer.error(f'Wayback Index: Reach non existed policy')
             raise
+        return url_utils.constr_wayback(url, chosen)
     
+    def _get_extraction(self, html):
+        """
+        Look up cached extraction results of html by its digest
+        Return: (digest, {title/content: ...}), {} if nothing is cached
+        """
+        html_digest = cache.digest(html)
+        extraction = self.mem_cache.get(('extract', html_digest))
+        if extraction is None:
+            try:
+                extraction = self.db.extraction.find_one({'_id': html_digest}, {'_id': False})
+            except:
+                extraction = None
+            if not extraction:
+                return html_digest, {}
+            if 'content' in extraction and 'minhash' in extraction:
+                minhash.cache_signature(extraction['content'], extraction['minhash'])
+            self.mem_cache.set(('extract', html_digest), extraction)
+        if extraction.get('title'):
+            self._set_site_titles(html_digest, extraction)
+        return html_digest, extraction
+
+    def _set_extraction(self, html_digest, fields):
+        """
+        Save extraction results into mem_cache and extraction collection
+        Content's minhash signature is saved along with it
+        """
+        if fields.get('content'):
+            fields = {**fields, 'minhash': minhash.to_bytes(minhash.signature(fields['content']))}
+        extraction = self.mem_cache.get(('extract', html_digest)) or {}
+        extraction = {**extraction, **fields}
+        self.mem_cache.set(('extract', html_digest), extraction)
+        self.db.extraction.update_one({'_id': html_digest}, {"$set": fields}, upsert=True)
+        if extraction.get('title'):
+            self._set_site_titles(html_digest, extraction)
+
+    def _set_site_titles(self, html_digest, extraction):
+        """
+        Upsert title (and content signature) of crawled urls with html_digest into site_titles
+        Urls come from crawls in this process. Each url is only written again if its title/signature changes
+        """
+        site_fields = {k: extraction[k] for k in ['title', 'minhash'] if k in extraction}
+        stamp = (extraction['title'], 'minhash' in extraction)
+        urls = [u for u in self.mem_cache.get(('digest_urls', html_digest)) or () \
+                if self.mem_cache.get(('site_title', u)) != stamp]
+        if len(urls) == 0:
+            return
+        ops = []
+        for url in urls:
+            wayback = 'web.archive.org/web' in url
+            ops.append(pymongo.UpdateOne({'_id': url}, {'$set': {
+                'url': url,
+                'site': he.extract(url, wayback=wayback),
+                'wayback': wayback,
+                **site_fields
+            }}, upsert=True))
+        try:
+            self.db.site_titles.bulk_write(ops, ordered=False)
+        except Exception as e:
+            tracer.warn(f'site titles: {str(e)}')
+            return
+        for url in urls:
+            self.mem_cache.set(('site_title', url), stamp)
+
     def extract_content(self, html, **kwargs):
         if html is None:
             if kwargs.get('handle_exception', True):
                 return ''
             else:
                 raise
-        html_bin = brotli.compress(html.encode())
-        try:
-            content = self.db.crawl.find_one({'html': html_bin, 'content': {"$exists": True}})
-        except: 
-            content = None
-        if content:
-            return content['content']
+        html_digest, extraction = self._get_extraction(html)
+        if 'content' in extraction:
+            return extraction['content']
         content = text_utils.extract_body(html, **kwargs)
         try:
-            self.db.crawl.update_one({'html': html_bin}, {"$set": {'content': content}})
+            self._set_extraction(html_digest, {'content': content})
         except Exception as e: tracer.warn(f'extract content: {str(e)}')
         return content
     
@@ -454,19 +1077,15 @@ class Memoizer:
                 return ''
             else:
                 raise
-        html_bin = brotli.compress(html.encode())
-        try:
-            title = self.db.crawl.find_one({'html': html_bin, 'title': {"$exists": True}})
-        except: 
-            title = None
-        if title:
-            return title['title']
+        html_digest, extraction = self._get_extraction(html)
+        if 'title' in extraction:
+            return extraction['title']
         # Require to be extracted next time
         title = text_utils.extract_title(html, **kwargs)
         if title == "":
             return title
         try:
-            self.db.crawl.update_one({'html': html_bin}, {"$set": {'title': title}})
+            self._set_extraction(html_digest, {'title': title})
         except Exception as e: tracer.warn(f'extract title: {str(e)}')
         return title
     
@@ -476,22 +1095,44 @@ class Memoizer:
                 return ''
             else:
                 raise
-        html_bin = brotli.compress(html.encode())
-        try:
-            title_content = self.db.crawl.find_one({'html': html_bin, 'title': {"$exists": True}, 'content': {'$exists': True}})
-        except: 
-            title_content = None
-        if title_content:
-            return title_content['title'], title_content['content']
+        html_digest, extraction = self._get_extraction(html)
+        if 'title' in extraction and 'content' in extraction:
+            return extraction['title'], extraction['content']
         # Require to be extracted next time
         title, content = text_utils.extract_title_body(html, **kwargs)
         if title == "" or content == "":
             return title, content
         try:
-            self.db.crawl.update_one({'html': html_bin}, {"$set": {'title': title, 'content': content}})
+            self._set_extraction(html_digest, {'title': title, 'content': content})
         except Exception as e: tracer.warn(f'extract title content: {str(e)}')
         return title, content
     
+    def _crawl_samples(self, urls, seen_urls, src, need=2, batch_size=4):
+        """
+        Crawl urls in small concurrent batches until need samples are gathered
+        Return: [{url, html, title, content}]
+        """
+        new_crawls = []
+        for i in range(0, len(urls), batch_size):
+            batch = urls[i: i+batch_size]
+            for sample_url, sample_html in zip(batch, self.crawl_many(batch)):
+                try:
+                    sample_title = self.extract_title(sample_html, version='mine', handle_exception=False)
+                    sample_content = self.extract_content(sample_html, handle_exception=False)
+                except: continue
+                tracer.debug(f"get_more_crawls: Got new sample from {src}: {sample_url} {sample_title}")
+                new_crawls.append({
+                    'url': sample_url,
+                    'html': sample_html,
+                    'title': sample_title,
+                    'content': sample_content
+                })
+                seen_urls.add(sample_url)
+                # * Gather 2 data points should be sufficient
+                if len(new_crawls) >= need:
+                    return new_crawls
+        return new_crawls
+
     def get_more_crawls(self, url, html=None, year_range=None, wayback=False):
         """
         Getting more samples from the same netloc_dir with url
@@ -514,29 +1155,11 @@ class Memoizer:
 
         if html:
             outlinks = crawl.outgoing_links(url, html, wayback=wayback)
-            for outlink in outlinks:
-                ond = url_utils.netloc_dir(outlink)
-                if ond != nd or url_utils.url_match(outlink, url) or outlink in seen_urls:
-                    continue
-                if url_utils.na_url(outlink):
-                    continue
-                try:
-                    out_html = self.crawl(outlink)
-                    out_title = self.extract_title(out_html, version='mine', handle_exception=False)
-                    out_content = self.extract_content(out_html, handle_exception=False)
-                except: continue
-                tracer.debug(f"get_more_crawls: Got new sample from outlinks: {outlink} {out_title}")
-                new_crawl = {
-                    'url': outlink,
-                    'html': out_html,
-                    'title': out_title,
-                    'content': out_content
-                }
-                new_crawls.append(new_crawl)
-                seen_urls.add(outlink)
-                # * Gather 2 data points should be sufficient
-                if len(new_crawls) > 1:
-                    return new_crawls
+            outlinks = [o for o in dict.fromkeys(outlinks) if url_utils.netloc_dir(o) == nd \
+                        and not url_utils.url_match(o, url) and not url_utils.na_url(o)]
+            new_crawls += self._crawl_samples(outlinks, seen_urls, 'outlinks')
+            if len(new_crawls) > 1:
+                return new_crawls
         
         url_prefix = ''.join(nd)
         if not year_range:
@@ -557,66 +1180,145 @@ class Memoizer:
             'collapse': 'urlkey',
             'limit': 100
         }
-        wayback_urls, _ = crawl.wayback_index(url_prefix + '/*', param_dict=param, total_link=True)
+        wayback_urls, _ = cdx_store.wayback_index(url_prefix + '/*', param_dict=param, total_link=True)
         wayback_urls = [wu[1] for wu in wayback_urls if not url_utils.url_match(wu[1], url, wayback=wayback) and url_utils.netloc_dir(wu[1]) == nd]
         # * Also looking for its direct parent if no siblings is archived
         if len(wayback_urls) == 0:
-            wayback_urls, _ = crawl.wayback_index(url_prefix, param_dict=param, total_link=True)
+            wayback_urls, _ = cdx_store.wayback_index(url_prefix, param_dict=param, total_link=True)
             wayback_urls = [wu[1] for wu in wayback_urls if not url_utils.url_match(wu[1], url, wayback=wayback)]
         if wayback:
             cand_urls = sorted(wayback_urls, key=lambda x: int(url_utils.get_ts(x)))
         else:
             cand_urls = [url_utils.filter_wayback(wu) for wu in wayback_urls]
-        for cand_url in cand_urls:
-            if cand_url in seen_urls or url_utils.url_match(url, cand_url):
-                continue
-            try:
-                cand_html = self.crawl(cand_url)
-                cand_title = self.extract_title(cand_html, version='mine', handle_exception=False)
-                cand_content = self.extract_content(cand_html, handle_exception=False)
-            except: continue
-            tracer.debug(f"get_more_crawls: Got new sample from wayback")
-            new_crawl = {
-                'url': cand_url,
-                'html': cand_html,
-                'title': cand_title,
-                'content': cand_content
-            }
-            new_crawls.append(new_crawl)
-            seen_urls.add(cand_url)
-            # * Gather 2 data points should be sufficient
-            if len(new_crawls) > 1:
-                return new_crawls
+        cand_urls = [c for c in cand_urls if c not in seen_urls and not url_utils.url_match(url, c)]
+        new_crawls += self._crawl_samples(cand_urls, seen_urls, 'wayback', need=2-len(new_crawls))
         
         # TODO: Implement search if necessary
         return new_crawls
 
 
+def _sample_corpus(db, corpus_size):
+    corpus = db.corpus.aggregate([
+        {'$match':  {'$or': [{'src': 'realweb'}, {'usage': re.compile('represent')}]}},
+        {'$project': {'content': True}},
+        {'$sample': {'size': corpus_size}},
+    ], allowDiskUse=True)
+    return [c['content'] for c in list(corpus)]
+
+
+def _resolve_tfidf_model(model_path):
+    """model_path can be a single model dir, or a root with versioned builds and a LATEST pointer"""
+    latest = os.path.join(model_path, 'LATEST')
+    if os.path.exists(latest):
+        return os.path.join(model_path, open(latest, 'r').read().strip())
+    return model_path
+
+
+def build_tfidf_model(model_path=None, db=None, corpus=None, corpus_size=10000):
+    """
+    Fit TFIDF base model on sampled corpus and save it as a new version under model_path
+    LATEST is switched only after the build is complete, so running workers are not affected
+
+    Return: path of the built version
+    """
+    model_path = model_path if model_path else config.TFIDF_MODEL_PATH
+    if not model_path:
+        raise Exception("model_path is required if tfidf_model_path is not configured")
+    if corpus is None:
+        db = config.new_db() if not db else db
+        corpus = _sample_corpus(db, corpus_size)
+    tfidf = text_utils.TFidfStatic(corpus)
+    version = f"v{text_utils.TFIDF_MODEL_VERSION}-{int(time.time())}"
+    tfidf.save(os.path.join(model_path, version))
+    tmp_latest = os.path.join(model_path, 'LATEST.tmp')
+    open(tmp_latest, 'w+').write(version)
+    os.replace(tmp_latest, os.path.join(model_path, 'LATEST'))
+    tracer.info(f'build_tfidf_model: {version} with {tfidf.n_docs} docs, {len(tfidf.vocab)} terms')
+    return os.path.join(model_path, version)
+
+
+class SiteContext:
+    """Title index of one site (and the site it redirects to) used by Similar"""
+    FIELDS = ['site', 'lw_titles', 'wb_titles', 'lw_meta', 'wb_meta', 'lw_seen', 'wb_seen', 'lw_lsh', 'wb_lsh']
+
+    def __init__(self, site=None):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.site = site
+        self.loaded = time.time()
+
+    def ttl_left(self):
+        """Seconds before the context is too old to reuse (other workers keep updating db). None if never expires"""
+        if config.SITE_CONTEXT_TTL is None:
+            return None
+        return self.loaded + config.SITE_CONTEXT_TTL - time.time()
+
+    def expired(self):
+        ttl_left = self.ttl_left()
+        return ttl_left is not None and ttl_left <= 0
+
+    def sizeof(self):
+        """Approximate memory footprint. Crawls in *_meta are the same objects as in *_titles"""
+        size = 0
+        for titles in [self.lw_titles, self.wb_titles]:
+            for crawls in (titles or {}).values():
+                size += sum(cache.sizeof(c) for c in crawls)
+        return size
+
+
+def _site_context_attr(field):
+    """Similar's site state is kept in its current SiteContext"""
+    def getter(self):
+        return getattr(self.ctx, field)
+    def setter(self, value):
+        setattr(self.ctx, field, value)
+    return property(getter, setter)
+
+
 class Similar:
-    def __init__(self, use_db=True, db=None, corpus=[], threshold=0.8, short_threshold=None, corpus_size=10000):
+    def __init__(self, use_db=True, db=None, corpus=[], threshold=0.8, short_threshold=None, corpus_size=10000, model_path=None):
         """
         corpus_size: size of corpus to sample on: (0-250k)
+        model_path: Prebuilt TFIDF model (build_tfidf_model). Fall back to tfidf_model_path in config.
+                    Corpus is only sampled & fitted if neither is available
         """
-        if not use_db and len(corpus) == 0:
+        model_path = model_path if model_path else config.TFIDF_MODEL_PATH
+        if model_path and len(corpus) == 0 and os.path.exists(model_path):
+            model_path = _resolve_tfidf_model(model_path)
+        else:
+            if model_path and len(corpus) == 0:
+                tracer.warning(f'Similar: TFIDF model {model_path} not found, fitting on sampled corpus')
+            model_path = None
+        if not use_db and len(corpus) == 0 and not model_path:
             raise Exception("Corpus is requred for tfidf if db is not set")
         self.use_db = use_db
         self.threshold = threshold
         self.short_threshold = short_threshold if short_threshold else self.threshold - 0.1
         if use_db:
             self.db =  config.new_db() if not db else db
-            corpus = self.db.corpus.aggregate([
-                {'$match':  {'$or': [{'src': 'realweb'}, {'usage': re.compile('represent')}]}},
-                {'$project': {'content': True}},
-                {'$sample': {'size': corpus_size}},
-            ], allowDiskUse=True)
-            corpus = [c['content'] for c in list(corpus)]
+        if model_path:
+            self.tfidf = text_utils.TFidfStatic.load(model_path)
+        elif use_db:
+            corpus = _sample_corpus(self.db, corpus_size)
             # corpus = random.sample(corpus, 100000)
             self.tfidf = text_utils.TFidfStatic(corpus)
         else:
             self.tfidf = text_utils.TFidfStatic(corpus)
-        self.site = None
+        self.ctx = SiteContext()
+        # * Warm site contexts, so that alternating between sites does not rebuild title index
+        self.contexts = cache.LRUCache(max_bytes=config.SITE_CONTEXT_BYTES, default_ttl=config.SITE_CONTEXT_TTL)
         self.separable = None
 
+    site = _site_context_attr('site')
+    lw_titles = _site_context_attr('lw_titles')
+    wb_titles = _site_context_attr('wb_titles')
+    lw_meta = _site_context_attr('lw_meta')
+    wb_meta = _site_context_attr('wb_meta')
+    lw_seen = _site_context_attr('lw_seen')
+    wb_seen = _site_context_attr('wb_seen')
+    lw_lsh = _site_context_attr('lw_lsh')
+    wb_lsh = _site_context_attr('wb_lsh')
+
     def match_url_sig(self, old_linked_sig, new_sigs):
         """
         Calc similarities between wayback_sig and liveweb_sigs, for both anchor texts and sig texts
@@ -636,15 +1338,19 @@ class Similar:
             for s in sig:
                 if s != '': corpus.append(s)
         self.tfidf.add_corpus(corpus)
-        for lws in new_sigs:
+        # * Score all anchors, and all old x new sigs, at once
+        anchor_simi = self.tfidf.similar_many(old_linked_sig[1], [anchor for _, anchor, _ in new_sigs])
+        all_nsigs = [nsig for _, _, sig in new_sigs for nsig in sig]
+        osig_simi = self.tfidf.similar_matrix(old_linked_sig[2], all_nsigs) # * Empty sig has zero vector
+        start = 0
+        for lws, simi in zip(new_sigs, anchor_simi):
             link, anchor, sig = lws
             link = url_utils.filter_wayback(link)
-            simi = self.tfidf.similar(old_linked_sig[1], anchor)
             anchor_simis[link].append((link, anchor, simi))
             sig_simi = 0
-            for osig in old_linked_sig[2]:
-                for nsig in sig:
-                    sig_simi = max(self.tfidf.similar(osig, nsig), sig_simi)
+            if osig_simi.shape[0] > 0 and len(sig) > 0:
+                sig_simi = max(osig_simi[:, start: start+len(sig)].max(), 0)
+            start += len(sig)
             sig_simis[link].append((link, sig, sig_simi))
         simis["anchor"] = {k: max(v, key=lambda x: x[2]) for k, v in anchor_simis.items()}
         simis["sig"] = {k: max(v, key=lambda x: x[2]) for k, v in sig_simis.items()}
@@ -663,8 +1369,8 @@ class Similar:
         if init:
             self.tfidf._clear_workingset()
             self.tfidf.add_corpus([target_content] + candidates_contents)
-        for c in candidates_contents:
-            simi = self.tfidf.similar(target_content, c)
+        simis = self.tfidf.similar_many(target_content, candidates_contents)
+        for c, simi in zip(candidates_contents, simis):
             if simi > max_simi:
                 max_simi = simi
                 max_content = c
@@ -674,18 +1380,24 @@ class Similar:
         """
         Return: Bool (whether init_title is succeed)
         """
-        if self.site and site in self.site:
+        if self.site and site in self.site and not self.ctx.expired():
+            return True
+        ctx = self.contexts.get(site)
+        if ctx is not None and not ctx.expired():
+            self._switch_context(ctx)
+            tracer.info(f'_init_titles {self.site} (cached)')
             return True
         memo = Memoizer()
         site_urls = [f'http://{site}', f'http://www.{site}']
+        new_site = None
         for site_url in site_urls:
-            _, new_site = memo.crawl(site_url, final_url=True)
-            if new_site:
+            site_info = site_resolver.resolve(site_url)
+            if site_info is not None:
+                new_site = site_info.site
                 break
         if new_site is None:
             return False
-        new_site = he.extract(new_site)
-        self.site = (site, new_site)
+        self._switch_context(SiteContext((site, new_site)))
         tracer.info(f'_init_titles {self.site}')
         # self.lw_titles = defaultdict(set) # *{title: set(path)}
         # self.wb_titles = defaultdict(set)
@@ -694,16 +1406,13 @@ class Similar:
         lw_crawl = []
         start = time.time()
         for ssite in set(self.site):
-            lw_crawl += list(self.db.crawl.find({'site': ssite, 'url': re.compile('^((?!web\.archive\.org).)*$')}))
-        wb_crawl = list(self.db.crawl.find({'site': site, 'url': re.compile('\/\/web.archive.org')}))
-        # lw_crawl = [lw for lw in lw_crawl if 'title' in lw] + [lw for lw in lw_crawl if 'title' not in lw]
-        # wb_crawl = [wb for wb in wb_crawl if 'title' in wb] + [wb for wb in wb_crawl if 'title' not in wb]
-        lw_crawl = [lw for lw in lw_crawl if 'title' in lw]
-        wb_crawl = [wb for wb in wb_crawl if 'title' in wb]
+            lw_crawl += self._site_titles(ssite, wayback=False)
+        wb_crawl = self._site_titles(site, wayback=True)
         # lw_path, wb_path = defaultdict(int), defaultdict(int)
         tracer.debug(f'find crawls in db: {time.time() - start:.2f}')
 
         self.lw_seen = set()
+        self.lw_lsh = minhash.LSHIndex() # * Near duplicate content lookup within site, keyed by normed url
         start = time.time()
         # * Get more urls from search engine
         seen = set([lw['url'] for lw in lw_crawl])
@@ -733,6 +1442,7 @@ class Similar:
                 except:
                     continue
 
+        lw_crawl = [CrawlRecord.from_crawl(lw, memo=memo) for lw in lw_crawl]
         # * Guarantee every path has at lease one title
         for lw in lw_crawl:
             url = url_norm(lw['url'])
@@ -752,8 +1462,8 @@ class Similar:
             # lw_path[loc_dir] += 1
             # self.lw_titles[title].add(norm(lw['url']))
     
-            lw.update({'netloc_dir': loc_dir})
             self.lw_titles[lw['title']].append(lw)
+            self.lw_lsh.add(url, crawl_signature(lw))
         # * Prepare data structures for title prefix/suffix filteration
         # lw_crawl_title = [lw for lw in lw_crawl if 'title' in lw]
         self.lw_meta = title_prepare(lw_crawl, wayback=False)
@@ -762,34 +1472,58 @@ class Similar:
 
         start = time.time()
         self.wb_seen = set()
+        self.wb_lsh = minhash.LSHIndex()
+        wb_crawl = [CrawlRecord.from_crawl(wb, memo=memo) for wb in wb_crawl]
         for wb in wb_crawl:
-            url, wb_url = wb['url'], url_norm(url_utils.filter_wayback(wb['url']))
+            wb_url = url_norm(wb['url'])
             if wb_url in self.wb_seen: continue
             else: self.wb_seen.add(wb_url)
-            loc_dir = url_utils.netloc_dir(wb_url)
-            wb_title = wb.copy()
-            wb_title.update({
-                'url': wb_url, 
-                'ts': url_utils.get_ts(url),
-                'netloc_dir': loc_dir
-            })
-            self.wb_titles[wb_title['title']].append(wb_title)
+            self.wb_titles[wb['title']].append(wb)
+            self.wb_lsh.add(wb_url, crawl_signature(wb))
         # * Prepare data structures for title prefix/suffix filteration
         self.wb_meta = title_prepare(wb_crawl, wayback=True)
         end = time.time()
         tracer.info(f'wb_titles: {sum([len(v) for v in self.wb_titles.values()])} \n init_time: {end - start:.2f}')
+        self.contexts.set(site, self.ctx, ttl=self.ctx.ttl_left(), size=self.ctx.sizeof())
         return True
+
+    def _switch_context(self, ctx):
+        """Make ctx current. Previous context is re-cached with its size grown by _add_crawl, keeping its expiry"""
+        prev = self.ctx
+        if prev.site is not None and self.contexts.get(prev.site[0]) is prev:
+            self.contexts.set(prev.site[0], prev, ttl=prev.ttl_left(), size=prev.sizeof())
+        self.ctx = ctx
     
+    def _site_titles(self, site, wayback=False):
+        """
+        Titled crawls of site from site_titles: [{url, title, minhash}]
+        Site's existing titled crawls are backfilled into site_titles on first use
+        """
+        if not self.db.site_titles_backfill.find_one({'_id': site}):
+            ops = []
+            for doc in self.db.crawl.find({'site': site, 'title': {'$exists': True}}, \
+                                          {'url': True, 'title': True, 'content': True, 'minhash': True}):
+                sig = doc.get('minhash')
+                if sig is None:
+                    sig = minhash.to_bytes(minhash.signature(doc.get('content', '') or ''))
+                ops.append(pymongo.UpdateOne({'_id': doc['url']}, {'$set': {
+                    'url': doc['url'],
+                    'site': site,
+                    'wayback': 'web.archive.org/web' in doc['url'],
+                    'title': doc['title'],
+                    'minhash': sig
+                }}, upsert=True))
+            if len(ops) > 0:
+                self.db.site_titles.bulk_write(ops, ordered=False)
+            self.db.site_titles_backfill.update_one({'_id': site}, {'$set': {'ts': time.time()}}, upsert=True)
+        return list(self.db.site_titles.find({'site': site, 'wayback': wayback}, \
+                                             {'_id': False, 'url': True, 'title': True, 'minhash': True}))
+
     def clear_titles(self):
-        self.site = None
-        self.lw_titles = None
-        self.wb_titles = None
-        # self.lw_index = None
-        self.lw_meta = None
-        # self.wb_index = None
-        self.wb_meta = None
-        self.lw_seen = None
-        self.wb_seen = None
+        """Drop current site's title index, also from warm contexts"""
+        if self.site is not None:
+            self.contexts.delete(self.site[0])
+        self.ctx = SiteContext()
 
     def _add_crawl(self, url, title, content, html=None):
         """Add new crawls into similar comparison"""
@@ -800,43 +1534,26 @@ class Similar:
             return
         elif not title:
             return
+        # * html is not kept, CrawlRecord loads it by url if ever needed
+        toadd = CrawlRecord.from_crawl({'url': url, 'title': title, 'content': content})
+        url, nd = toadd.url, toadd.netloc_dir
+        lsh = self.wb_lsh if is_wayback else self.lw_lsh
+        lsh.add(url_norm(url), crawl_signature(toadd))
         if is_wayback:
-            ts, url = url_utils.get_ts(url), url_utils.filter_wayback(url)
-        nd = url_utils.netloc_dir(url)
-        toadd = {
-            'url': url,
-            'html': html,
-            'title': title,
-            'content': content,
-            'netloc_dir': nd
-        }
-        if is_wayback:
-            toadd.update({'ts': ts})
             self.wb_titles[title].append(toadd)
-            nd_idx = bisect.bisect_left(self.wb_meta, [nd, []])
-            if nd_idx >= len(self.wb_meta) or self.wb_meta[nd_idx][0] != nd:
-                self.wb_meta.insert(nd_idx, [nd, [toadd]])
-            else:
-                tss = [int(obj['ts']) for obj in self.wb_meta[nd_idx][1]]
-                ts_idx = bisect.bisect_right(tss, int(ts))
-                self.wb_meta[nd_idx][1].insert(ts_idx, toadd)
+            self.wb_meta.add(nd, toadd)
             self.wb_seen.add(url_norm(url))
         else:
             self.lw_titles[title].append(toadd)
-            nd_idx = bisect.bisect_left(self.lw_meta, [nd, []])
-            if nd_idx >= len(self.lw_meta) or self.lw_meta[nd_idx][0] != nd:
-                self.lw_meta.insert(nd_idx, [nd, [toadd]])
-            else:
-                titles = [obj['title'] for obj in self.lw_meta[nd_idx][1]]
-                title_idx = bisect.bisect_right(titles, toadd['title'])
-                self.lw_meta[nd_idx][1].insert(title_idx, toadd)
+            self.lw_meta.add(nd, toadd)
             self.lw_seen.add(url_norm(url))
 
-    def shorttext_match(self, text1, text2):
+    def shorttext_match(self, text1, text2, simi=None):
         """
         Func should only be called when self.tfidf is properly prepared
         Check whether one text is a subset of another + similar enough
         # TODO: Currently use TF-IDF for comparison, but other way may also apply
+        simi: tfidf similarity of text1 and text2, if already computed in batch
 
         Returns: 0 if not match. Actual similarity otherwise
         """
@@ -855,7 +1572,8 @@ class Similar:
             tracer.debug(f'shorttext_match: one text not a subset of another: "{text1}" vs. "{text2}"')
             return 0
        
-        simi = self.tfidf.similar(text1, text2)
+        if simi is None:
+            simi = self.tfidf.similar(text1, text2)
         # tracer.debug(f'shorttext_match: simi between "{text1}" vs. "{text2}": {simi}')
         return simi
         
@@ -873,22 +1591,27 @@ class Similar:
         lw_url = url_utils.filter_wayback(url)
         site_titles = self.wb_titles if wayback else self.lw_titles
         site_meta = self.wb_meta if wayback else self.lw_meta
+        site_lsh = self.wb_lsh if wayback else self.lw_lsh
         nd = url_utils.netloc_dir(lw_url)
         def check_titles():
             if title in site_titles:
+                content_sig = minhash.signature(content or '')
+                # * LSH hits are already verified (jaccard >= 0.9), only a shortcut for the common near-duplicate case
+                dups = site_lsh.query(content_sig, threshold=0.9)
                 for site_crawl in site_titles[title]:
                     # * title in site_titles is a child of url
                     if nd != site_crawl['netloc_dir'] and nd in site_crawl['netloc_dir']:
                         continue
-                    # TODO: Can actually also compare content to not consider canonical here
-                    if not url_utils.url_match(lw_url, site_crawl['url']) and \
-                            text_utils.k_shingling(content, site_crawl.get('content', '')) < 0.9:
+                    if url_utils.url_match(lw_url, site_crawl['url']) or url_norm(site_crawl['url']) in dups:
+                        continue
+                    # * LSH may miss near duplicates, compare every other crawl with the same title
+                    if minhash.similarity(content_sig, crawl_signature(site_crawl)) < 0.9:
                         tracer.debug(f"_is_title_unique: title {title} is not unique amoung site with {site_crawl['url']}")
                         return False
             return True
         # unique = check_titles()
         # if not unique: return unique
-        nd_idx = bisect.bisect_left(site_meta, [nd, []])
+        nd_idx = site_meta.bisect_left(nd)
         # * Get more samples if nd's URL is not enough
         if wayback and len(site_meta[nd_idx][1]) < 2:
             memo = Memoizer()
@@ -906,7 +1629,7 @@ class Similar:
         lw_url = url if not wayback else url_utils.filter_wayback(url)
         nd = url_utils.netloc_dir(lw_url)
         site_meta = self.wb_meta if wayback else self.lw_meta
-        nd_idx = bisect.bisect_left(site_meta, [nd, []])
+        nd_idx = site_meta.bisect_left(nd)
         if len(site_meta) <= nd_idx or len(site_meta[nd_idx][1]) < 2:
             memo = Memoizer()
             more_crawls = memo.get_more_crawls(url, wayback=wayback)
@@ -938,9 +1661,10 @@ class Similar:
         cand_uniq_titles = {url: unique_title(url, title, candidates_contents.get(url, ''), self.lw_meta, wayback=False) \
              for url, title in candidates_titles.items()}
         self.tfidf.add_corpus([tgt_uniq_title] + [ct for ct in cand_uniq_titles.values()])
+        tfidf_simis = self.tfidf.similar_many(tgt_uniq_title, cand_uniq_titles.values())
 
         simi_cand = []
-        for url in cand_uniq_titles:
+        for url, tfidf_simi in zip(cand_uniq_titles, tfidf_simis):
             c, uniq_c = candidates_titles[url], cand_uniq_titles[url]
             site = he.extract(url)
             if site not in self.site and not fixed:
@@ -949,9 +1673,9 @@ class Similar:
                 tracer.debug(f"title_similar: cand_url's title '{c}' is not unique")
                 continue
             if shorttext:
-                simi = self.shorttext_match(tgt_uniq_title, uniq_c)
+                simi = self.shorttext_match(tgt_uniq_title, uniq_c, simi=tfidf_simi)
             else:
-                simi = self.tfidf.similar(tgt_uniq_title, uniq_c)
+                simi = tfidf_simi
             tracer.debug(f'similarity title, (value/url): ({simi}/{url})')
             simi_cand.append((url, simi))
         
@@ -968,9 +1692,9 @@ class Similar:
         """
         self.tfidf._clear_workingset()
         self.tfidf.add_corpus([target_content] + list(candidates_contents.values()))
+        simis = self.tfidf.similar_many(target_content, candidates_contents.values())
         simi_cand = []
-        for url, c in candidates_contents.items():
-            simi = self.tfidf.similar(target_content, c)
+        for url, simi in zip(candidates_contents, simis):
             tracer.debug(f'similarity content, (value/url): ({simi}/{url})')
             simi_cand.append((url, simi))
         
@@ -991,9 +1715,8 @@ class Similar:
                     more_crawls = memo.get_more_crawls(cand, html, year_range=('20210101', '20211231'))
                     more_contents = {c['url']: c['content'] for c in more_crawls}
                     self.tfidf.add_corpus([target_content] + list(more_contents.values()))
-                    for u, c in more_contents.items():
-                        u_simi = self.tfidf.similar(target_content, c)
-                        simi_cand.append((u, u_simi))
+                    u_simis = self.tfidf.similar_many(target_content, more_contents.values())
+                    simi_cand += list(zip(more_contents, u_simis))
         
         return sorted(simi_cand, key=lambda x: x[1], reverse=True)
     
@@ -1010,14 +1733,16 @@ class Similar:
             all_tokens += tokens
         self.tfidf._clear_workingset()
         self.tfidf.add_corpus(all_tokens)
+        tfidf_simis = iter(self.tfidf.similar_many(target_token, all_tokens[1:]))
         simi_cand = []
         for can, tokens in candidates_tokens.items():
             max_token = (can, 0, '')
             for t in tokens:
+                tfidf_simi = next(tfidf_simis)
                 if shorttext:
-                    simi = self.shorttext_match(target_token, t)
+                    simi = self.shorttext_match(target_token, t, simi=tfidf_simi)
                 else:
-                    simi = self.tfidf.similar(target_token, t)
+                    simi = tfidf_simi
                 tracer.debug(f'similarity title, (value/url): ({simi}/{target_token} vs. {t})')
                 if simi > max_token[1]:
                     max_token = (can, simi, t)
@@ -1122,7 +1847,7 @@ def is_canonical(url1, url2, resp1=None, resp2=None):
         content2 = soup2.get_text(separator=' ')
     except:
         content2 = resp2.text
-    if text_utils.k_shingling(text_norm(content1), text_norm(content2)) >= 0.95:
+    if minhash.text_similarity(text_norm(content1), text_norm(content2)) >= 0.95:
         return True
     return False
 
@@ -1199,9 +1924,19 @@ def get_unique_token(url, fuzzy=False):
         sub_path = '/'.join(path[:i+1])
         sub_us = us._replace(path=sub_path + '*', query='', fragment='')
         sub_url = urlunsplit(sub_us)
-        wayback_index, _ = crawl.wayback_index(sub_url, param_dict=params)
+        if len(query):
+            wayback_index, _ = cdx_store.wayback_index(sub_url, param_dict=params)
+            wayback_index = _collapse_index([w[1] for w in wayback_index])
+        else:
+            # * Only need to know whether sub_url has more than one url, stop streaming once found
+            wayback_index = set()
+            try:
+                for w in cdx_store.iter_wayback_index(sub_url, param_dict=params):
+                    wayback_index |= _collapse_index([w[1]])
+                    if len(wayback_index) > 1:
+                        break
+            except crawl.CDXError: pass
         # print(sub_url)
-        wayback_index = _collapse_index([w[1] for w in wayback_index])
         tracer.debug(f'get_unique_token: {sub_url}, {len(wayback_index)}')
         if len(query):
             available_tokens += _unique_query(wayback_index, query)
@@ -0,0 +1,123 @@
+"""
+In-process caches sitting in front of the db
+Used to avoid repeated db round trips + decompression within one process
+"""
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def sizeof(obj):
+    """Approximate memory footprint (bytes) of a cached value"""
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, str):
+        return len(obj) + 49
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(sizeof(o) for o in obj)
+    nbytes = getattr(obj, 'nbytes', None) # * numpy arrays, array.array has no nbytes
+    if isinstance(nbytes, int):
+        return nbytes + 96
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """
+    Bounded LRU cache with optional per-entry TTL
+    Eviction is based on the (approximate) byte size of the cached values
+    """
+    def __init__(self, max_bytes=256*1024*1024, default_ttl=None):
+        """
+        max_bytes: Upper bound of total size of cached values
+        default_ttl: Seconds an entry stays valid if ttl is not specified on set. None means no expiration
+        """
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._data = OrderedDict() # * {key: (value, expire_ts, size)}
+        self._lock = threading.RLock()
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _pop(self, key):
+        _, _, size = self._data.pop(key)
+        self.cur_bytes -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expire, _ = entry
+            if expire is not None and expire <= time.time():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=None):
+        """
+        ttl: Seconds the entry is valid. Fall back to default_ttl if not set
+        size: Size of the value if known, otherwise estimated
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            return
+        size = sizeof(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        expire = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, expire, size)
+            self.cur_bytes += size
+            while self.cur_bytes > self.max_bytes and len(self._data) > 0:
+                oldest = next(iter(self._data))
+                self._pop(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data = OrderedDict()
+            self.cur_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self.cur_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+def digest(text):
+    """Fast content digest of a str/bytes, used as a compact cache key instead of the content itself"""
+    if isinstance(text, str):
+        text = text.encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(text, digest_size=16).hexdigest()
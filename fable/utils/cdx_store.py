@@ -0,0 +1,402 @@
+"""
+Local store of wayback CDX records
+Prefix/domain dumps are ingested once, and later wayback_index queries
+    covered by a dump are answered from local disk instead of the CDX server
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+from .. import config
+from . import crawl, url_utils
+
+import logging
+logger = logging.getLogger('logger')
+
+WAYBACK_HOME = "http://web.archive.org/web/"
+DEFAULT_FROM, DEFAULT_TO = 19700101, 20221231
+CDX_FIELDS = ['urlkey', 'timestamp', 'original', 'mimetype', 'statuscode', 'digest', 'length']
+# * Bumped when stored records can't be read by the current version. Older stores are rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cdx (
+    urlkey TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    original TEXT NOT NULL,
+    mimetype TEXT,
+    statuscode TEXT,
+    digest TEXT,
+    length INTEGER,
+    ingested REAL NOT NULL,
+    PRIMARY KEY (urlkey, ts, original)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cdx_ingested ON cdx (ingested);
+CREATE TABLE IF NOT EXISTS coverage (
+    key TEXT NOT NULL,
+    match TEXT NOT NULL,
+    filters TEXT NOT NULL,
+    collapse TEXT NOT NULL,
+    from_ts INTEGER NOT NULL,
+    to_ts INTEGER NOT NULL,
+    ingested REAL NOT NULL,
+    PRIMARY KEY (key, match, filters, collapse, from_ts, to_ts)
+) WITHOUT ROWID;
+"""
+
+
+def _pad_ts(ts, fill):
+    """Expand (partial) timestamp into 14 digits int. fill: '0' for lower bound, '9' for upper bound"""
+    ts = re.sub(r'[^0-9]', '', str(ts))[:14]
+    return int(ts.ljust(14, fill))
+
+
+def _as_list(v):
+    if v is None:
+        return []
+    return [v] if isinstance(v, str) else list(v)
+
+
+def parse_query(url, param_dict={}):
+    """
+    Normalize a CDX query into the range of urlkey to scan and the constraints on records
+    Return: {key, match (exact/prefix/domain), filters, collapse, from_ts, to_ts, limit}
+    """
+    url = param_dict.get('url', url)
+    match = param_dict.get('matchType', 'exact')
+    if url.startswith('*.'):
+        match, url = 'domain', url[2:]
+    if url.endswith('*'):
+        match = 'domain' if match == 'domain' else 'prefix'
+        url = url[:-1]
+    if match == 'domain':
+        key = url_utils.surt(url).split(')')[0]
+    else:
+        key = url_utils.surt(url, trailing_slash=match == 'prefix')
+        if match == 'host':
+            match, key = 'prefix', key.split(')')[0] + ')'
+    collapse = _as_list(param_dict.get('collapse'))
+    return {
+        'key': key,
+        'match': match,
+        'filters': sorted(set(_as_list(param_dict.get('filter')))),
+        'collapse': collapse[0] if len(collapse) else '',
+        'from_ts': _pad_ts(param_dict.get('from', DEFAULT_FROM), '0'),
+        'to_ts': _pad_ts(param_dict.get('to', DEFAULT_TO), '9'),
+        'limit': int(param_dict['limit']) if param_dict.get('limit') else None
+    }
+
+
+def _compile_filter(f):
+    """CDX filter "[!]field:regex" --> func(record) -> bool"""
+    neg = f.startswith('!')
+    field, pattern = f.lstrip('!').split(':', 1)
+    idx = CDX_FIELDS.index(field)
+    pattern = re.compile(pattern)
+    return lambda r: (pattern.fullmatch(str(r[idx])) is not None) != neg
+
+
+def _collapse_key(collapse):
+    """CDX collapse "field[:N]" --> func(record) -> key. Adjacent records with same key are collapsed"""
+    field, _, n = collapse.partition(':')
+    idx = CDX_FIELDS.index(field)
+    n = int(n) if n else None
+    return lambda r: str(r[idx])[:n]
+
+
+class CDXStore:
+    """
+    Sqlite backed CDX records sorted by (urlkey, ts)
+    Coverage records which dumps have been fully ingested, so that only covered queries are answered locally
+    Records are stamped when ingested, and pruned together with the coverage once older than ttl
+    The sqlite file is shared by all processes using the same tmp_path
+    """
+    def __init__(self, path=None, ttl=-1):
+        """
+        path: sqlite file. Default as cdx_store.sqlite under tmp_path
+        ttl: Seconds a dump covers queries after ingested. None: never expire. Default as config cdx_store_ttl
+        """
+        if path is None:
+            path = os.path.join(config.TMP_PATH, 'cdx_store.sqlite')
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = config.CDX_STORE_TTL if ttl == -1 else ttl
+        self._local = threading.local()
+        conn = self._conn()
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # * v1: records not stamped with their dump, and keyed with trailing slashes unlike CDX urlkey
+            conn.executescript(f"DROP TABLE IF EXISTS cdx; DROP TABLE IF EXISTS coverage; PRAGMA user_version = {SCHEMA_VERSION};")
+        conn.executescript(SCHEMA)
+        self.prune()
+
+    def _conn(self):
+        """Sqlite connections can't be shared across threads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _covered_by(self, q, c):
+        """Whether query q can be answered from dump c"""
+        key, match = c['key'], c['match']
+        if match == 'exact':
+            in_range = q['match'] == 'exact' and q['key'] == key
+        elif match == 'prefix':
+            in_range = q['match'] != 'domain' and q['key'].startswith(key)
+        else:
+            qhost = q['key'] if q['match'] == 'domain' else q['key'].split(')')[0]
+            in_range = qhost == key or qhost.startswith(key + ',')
+        if not in_range:
+            return False
+        if c['collapse']:
+            # * Collapsed dump only has the first record of each group, any narrower query may pick a dropped one
+            return q['collapse'] == c['collapse'] and q['filters'] == c['filters'] \
+                and q['from_ts'] == c['from_ts'] and q['to_ts'] == c['to_ts']
+        return set(c['filters']) <= set(q['filters']) \
+            and c['from_ts'] <= q['from_ts'] and q['to_ts'] <= c['to_ts']
+
+    def coverage(self, url, param_dict={}):
+        """Return the dump (coverage row) that covers the query, None if not covered or expired"""
+        q = parse_query(url, param_dict)
+        host = q['key'].split(')')[0]
+        host_parts = host.split(',')
+        keys = [q['key'][:i] for i in range(len(host) + 1, len(q['key']) + 1)]
+        keys += [','.join(host_parts[:i]) for i in range(1, len(host_parts) + 1)]
+        min_ingested = time.time() - self.ttl if self.ttl is not None else 0
+        rows = self._conn().execute(
+            f"SELECT key, match, filters, collapse, from_ts, to_ts, ingested FROM coverage "
+            f"WHERE key IN ({','.join('?'*len(keys))}) AND ingested >= ?",
+            keys + [min_ingested]).fetchall()
+        for row in rows:
+            c = dict(zip(['key', 'match', 'filters', 'collapse', 'from_ts', 'to_ts', 'ingested'], row))
+            c['filters'] = json.loads(c['filters'])
+            if self._covered_by(q, c):
+                return c
+        return None
+
+    def prune(self):
+        """
+        Delete expired coverage and the records ingested with it
+        Coverage is stamped with the start of its dump, so records of live dumps are never older than the cutoff
+        Records refreshed by a later dump are kept
+        Return: #records deleted
+        """
+        if self.ttl is None:
+            return 0
+        min_ingested = time.time() - self.ttl
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM coverage WHERE ingested < ?", (min_ingested,))
+            return conn.execute("DELETE FROM cdx WHERE ingested < ?", (min_ingested,)).rowcount
+
+    def _insert(self, records, ingested=None):
+        ingested = time.time() if ingested is None else ingested
+        rows = []
+        for r in records:
+            try:
+                length = int(r[6]) if r[6] not in ('-', '') else None
+            except (ValueError, IndexError):
+                length = None
+            urlkey = r[0] or url_utils.surt(r[2]) # * Key on the server's urlkey, which lookups (surt) match
+            rows.append((urlkey, int(r[1]), r[2], r[3], r[4], r[5], length, ingested))
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO cdx VALUES (?,?,?,?,?,?,?,?)", rows)
+
+    @staticmethod
+    def _key_range(q):
+        """SQL condition (and args) on urlkey of query q"""
+        if q['match'] == 'exact':
+            return "urlkey = ?", [q['key']]
+        elif q['match'] == 'prefix':
+            return "urlkey >= ? AND urlkey < ?", [q['key'], q['key'] + '\uffff']
+        return "((urlkey >= ? AND urlkey < ?) OR (urlkey >= ? AND urlkey < ?))", \
+            [q['key'] + ')', q['key'] + ')\uffff', q['key'] + ',', q['key'] + ',\uffff']
+
+    def _drop_stale(self, q, started):
+        """
+        Delete records a complete dump of q should have returned but didn't (gone from the CDX server)
+        Collapsed dumps only return one record of each group, so they can't tell
+        Return: #records deleted
+        """
+        if q['collapse']:
+            return 0
+        where, args = self._key_range(q)
+        filters = [_compile_filter(f) for f in q['filters']]
+        conn = self._conn()
+        stale = []
+        for r in conn.execute(
+                f"SELECT urlkey, ts, original, mimetype, statuscode, digest, length FROM cdx "
+                f"WHERE {where} AND ts >= ? AND ts <= ? AND ingested < ?",
+                args + [q['from_ts'], q['to_ts'], started]):
+            record = [r[0], str(r[1]), r[2], r[3], r[4], r[5], '-' if r[6] is None else str(r[6])]
+            if all(f(record) for f in filters):
+                stale.append(r[:3])
+        with conn:
+            conn.executemany("DELETE FROM cdx WHERE urlkey = ? AND ts = ? AND original = ?", stale)
+        return len(stale)
+
+    def _cover(self, url, param_dict, started):
+        """
+        Record a complete dump, which replaces the older records in its range. started: time the dump started being ingested
+        """
+        q = parse_query(url, param_dict)
+        self._drop_stale(q, started)
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO coverage VALUES (?,?,?,?,?,?,?)", (
+                q['key'], q['match'], json.dumps(q['filters']), q['collapse'],
+                q['from_ts'], q['to_ts'], started))
+        self.prune()
+
+    def ingest(self, url, param_dict, records, complete=True):
+        """
+        Save CDX records of a query
+        records: [[urlkey, timestamp, original, mimetype, statuscode, digest, length]] as returned by crawl.wayback_cdx
+        complete: Whether records are all results of the query (not truncated by limit).
+            Only complete dumps are used to answer later queries
+        """
+        started = time.time()
+        self._insert(records, ingested=started)
+        if complete:
+            self._cover(url, param_dict, started)
+
+    def iter_query(self, url, param_dict={}):
+        """
+        Answer the query from local records, regardless of coverage
+        yield: [urlkey, timestamp, original, mimetype, statuscode, digest, length] in CDX order
+        """
+        q = parse_query(url, param_dict)
+        where, args = self._key_range(q)
+        if q['limit'] and q['limit'] < 0:
+            yield from self.query(url, param_dict)
+            return
+        cursor = self._conn().execute(
+            f"SELECT urlkey, ts, original, mimetype, statuscode, digest, length FROM cdx "
+            f"WHERE {where} AND ts >= ? AND ts <= ? ORDER BY urlkey, ts",
+            args + [q['from_ts'], q['to_ts']])
+        filters = [_compile_filter(f) for f in q['filters']]
+        collapse_key = _collapse_key(q['collapse']) if q['collapse'] else None
+        count, last_key = 0, None
+        for r in cursor:
+            r = [r[0], str(r[1]), r[2], r[3], r[4], r[5], '-' if r[6] is None else str(r[6])]
+            if not all(f(r) for f in filters):
+                continue
+            if collapse_key:
+                k = collapse_key(r)
+                if k == last_key:
+                    continue
+                last_key = k
+            yield r
+            count += 1
+            if q['limit'] and count >= q['limit']:
+                break
+
+    def query(self, url, param_dict={}):
+        """
+        Answer the query from local records, regardless of coverage
+        Return: [[urlkey, timestamp, original, mimetype, statuscode, digest, length]] in CDX order
+        """
+        limit = parse_query(url, param_dict)['limit']
+        if limit and limit < 0:
+            params = {k: v for k, v in param_dict.items() if k != 'limit'}
+            return list(self.iter_query(url, params))[limit:]
+        return list(self.iter_query(url, param_dict))
+
+    def iter_cdx(self, url, param_dict={}, chunk_size=crawl.CDX_PAGE_SIZE, **kwargs):
+        """
+        Stream the records of a CDX query. Answered from local records if covered
+        Otherwise stream from the CDX server, and ingest records on the fly
+        Coverage is only saved if the stream is fully consumed
+        kwargs: Arguments for crawl.iter_wayback_cdx
+
+        yield: [urlkey, timestamp, original, mimetype, statuscode, digest, length]
+        raise: crawl.CDXError
+        """
+        if self.coverage(url, param_dict) is not None:
+            yield from self.iter_query(url, param_dict)
+            return
+        limit = parse_query(url, param_dict)['limit']
+        buf, count, exhausted = [], 0, False
+        started = time.time()
+        try:
+            for r in crawl.iter_wayback_cdx(url, param_dict=param_dict, **kwargs):
+                buf.append(r)
+                count += 1
+                if len(buf) >= chunk_size:
+                    self._insert(buf, ingested=started)
+                    buf = []
+                yield r
+            exhausted = True
+        finally:
+            try:
+                self._insert(buf, ingested=started)
+                if exhausted and (not limit or count < abs(limit)):
+                    self._cover(url, param_dict, started)
+            except Exception as e:
+                logger.warn(f'CDXStore ingest: {url} {str(e)}')
+
+    def cdx(self, url, param_dict={}, **kwargs):
+        """Same as crawl.wayback_cdx, but answer from local records if the query is covered"""
+        try:
+            records = list(self.iter_cdx(url, param_dict=param_dict, **kwargs))
+        except crawl.CDXError as e:
+            return [], str(e)
+        return records, "Success" if len(records) else "Empty"
+
+    def wayback_index(self, url, param_dict={}, total_link=False, **kwargs):
+        """Same as crawl.wayback_index, but answered from local records if covered"""
+        records, status = self.cdx(url, param_dict=param_dict, **kwargs)
+        if total_link:
+            return [(r[1], f"{WAYBACK_HOME}{r[1]}/{r[2]}", r[4]) for r in records], status
+        return [(r[1], r[2], r[4]) for r in records], status
+
+    def ingest_prefix(self, prefix, param_dict={}, **kwargs):
+        """
+        Dump all records under prefix (e.g. example.com/dir/* or *.example.com) from the CDX server
+        Only mimetype filter is applied by default, so that the dump can answer most of later queries
+        Return: (#records, status)
+        """
+        params = {'filter': ['mimetype:text/html']}
+        params.update(param_dict)
+        count = 0
+        try:
+            for _ in self.iter_cdx(prefix, param_dict=params, **kwargs):
+                count += 1
+        except crawl.CDXError as e:
+            return count, str(e)
+        return count, "Success" if count else "Empty"
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Process-wide CDXStore under tmp_path"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CDXStore()
+        return _store
+
+
+def wayback_index(url, param_dict={}, total_link=False, **kwargs):
+    """Drop-in replacement of crawl.wayback_index backed by the process-wide store"""
+    return get_store().wayback_index(url, param_dict=param_dict, total_link=total_link, **kwargs)
+
+
+def iter_wayback_index(url, param_dict={}, total_link=False, **kwargs):
+    """
+    Streaming version of wayback_index backed by the process-wide store. Stop iterating to stop fetching
+    yield: (timestamp, url, status_code)
+    raise: crawl.CDXError
+    """
+    for r in get_store().iter_cdx(url, param_dict=param_dict, **kwargs):
+        yield (r[1], f"{WAYBACK_HOME}{r[1]}/{r[2]}" if total_link else r[2], r[4])
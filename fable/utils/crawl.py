@@ -5,12 +5,17 @@ Utilities for crawling a page
 from ftplib import error_temp
 from subprocess import call, check_output
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent import futures
 from urllib.request import urlopen, Request
 import os
 import time
 from os.path import abspath, dirname, join
 import base64
 import threading, queue
+from contextlib import contextmanager
+import atexit
+import http.cookiejar
 import itertools
 from urllib.parse import urlparse, urljoin
 import json
@@ -30,7 +35,7 @@ import sys
 sys.path.append("../")
 from .. import config
 from .. import tracer
-from .url_utils import filter_wayback, is_prefix
+from .url_utils import filter_wayback, is_prefix, get_ts, constr_wayback
 
 import logging
 
@@ -41,6 +46,122 @@ logging.setLoggerClass(logging.Logger)
 
 requests_header = {"user-agent": config.config("user_agent")}
 CRAWL_DELAY = 3
+CDX_PAGE_SIZE = 5000  # * Max #records of each CDX request when paginating
+MAX_CONCURRENCY = 16  # Max number of concurrent requests in the process
+MAX_HOST_CONCURRENCY = 4  # Max number of concurrent requests to the same host in the process
+POOL_HOSTS = 100  # Number of hosts whose keep-alive connections are pooled by the session
+POOL_MAXSIZE = 2 * MAX_CONCURRENCY  # Keep-alive connections kept per host, enough for all concurrent workers
+REDIRECT_BODY_LIMIT = 64 * 1024  # Max bytes of final body read by resolve_redirects
+
+class HostLimiter:
+    """
+    Bound the number of concurrent requests to the same host
+    """
+
+    def __init__(self, per_host=MAX_HOST_CONCURRENCY):
+        self.per_host = per_host
+        self._sems = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        """Return the semaphore of url's host, to be used as context manager"""
+        host = urlparse(filter_wayback(url)).netloc.split(":")[0].lower()
+        if "web.archive.org/web" in url:
+            host = "web.archive.org"
+        with self._lock:
+            if host not in self._sems:
+                self._sems[host] = threading.BoundedSemaphore(self.per_host)
+            return self._sems[host]
+
+
+# * Process-wide bounds, shared by every thread (map_concurrent, SnapshotProber, callers' own threads...)
+host_limiter = HostLimiter(MAX_HOST_CONCURRENCY)
+global_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+
+@contextmanager
+def request_slot(url):
+    """Hold one of url's host slots and one of the global slots"""
+    with host_limiter(url):
+        with global_slots:
+            yield
+
+
+class LimitedSession(requests.Session):
+    """
+    Session whose requests each hold a request_slot while being sent (redirects included)
+    Slots are taken per request instead of per task, so nested/concurrent batches can't deadlock on them
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        with request_slot(url):
+            return super().request(method, url, *args, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Process-wide LimitedSession shared by all threads, with keep-alive connection pools per host
+    Connections outlive the worker threads of map_concurrent, so they are reused across batches
+    Cookies are never persisted so that each request is as stateless as requests.get
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = LimitedSession()
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _session = session
+        return _session
+
+
+def close_session():
+    """Close pooled connections. A new session is created on next get_session"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+atexit.register(close_session)
+
+
+def map_concurrent(func, items, max_workers=MAX_CONCURRENCY):
+    """
+    Run func over items concurrently
+    Requests sent through get_session() are bounded by the process-wide global and per-host slots
+
+    Return: [func(item)] in the same order of items
+    """
+    if len(items) == 0:
+        return []
+    max_workers = max(1, min(max_workers, len(items)))
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as e:
+        return list(e.map(func, items))
+
+
+def crawl_many(urls, max_workers=MAX_CONCURRENCY, **kwargs):
+    """
+    Crawl urls concurrently. Duplicated urls are only fetched once
+    kwargs: Arguments for requests_crawl. raw is always set to True
+
+    Return: [requests_crawl(url, raw=True)] in the same order of urls
+    """
+    kwargs.update({"raw": True})
+    uniq_urls = list(dict.fromkeys(urls))
+    results = map_concurrent(
+        lambda u: requests_crawl(u, **kwargs),
+        uniq_urls,
+        max_workers=max_workers,
+    )
+    url_result = dict(zip(uniq_urls, results))
+    return [url_result[u] for u in urls]
 
 
 class ProxySelector:
@@ -107,7 +228,7 @@ class RobotParser:
         # reppy consider 403, 500 as disallow_all. Overwriting this rule
         if robot_url not in self.req_status:
             try:
-                r = requests.get(
+                r = get_session().get(
                     robot_url, timeout=5, headers={"user-agent": useragent}
                 )
                 self.req_status[robot_url] = r.status_code
@@ -176,62 +297,142 @@ def chrome_crawl(url, timeout=120, screenshot=False, ID="", proxy=None):
     return html, url_file + "jpg"
 
 
-def wayback_index(url, param_dict={}, wait=True, total_link=False, proxies={}):
-    """
-    Get the wayback machine index of certain url by querying the CDX
-    wait: wait unitl not getting block
-    total_link: Returned url are in full(wayback) links
+class CDXError(Exception):
+    pass
 
-    return: ( [(timestamp, url, stauts_code)], SUCCESS/EMPTY/ERROR_MSG)
-    """
-    wayback_home = "http://web.archive.org/web/"
-    params = {
-        "output": "json",
-        "url": url,
-        "from": 19700101,
-        "to": 20221231,
-    }
-    params.update(param_dict)
+
+def _cdx_request(params, wait=True, proxies={}):
+    """Send one (streamed) request to the CDX server, retry if getting blocked"""
     count = 0
-    r = None
     while True:
+        r = None
         try:
-            r = requests.get(
+            r = get_session().get(
                 "http://web.archive.org/cdx/search/cdx",
                 headers=requests_header,
                 params=params,
                 proxies=proxies,
                 timeout=120,
+                stream=True,
             )
-            r = r.json()
-            time.sleep(0.5)
-            break
+            if r.status_code != 200:
+                r.close()
+                raise CDXError(f"CDX status code {r.status_code}")
+            r.encoding = "utf-8"
+            return r
         except requests.exceptions.ConnectionError as e:
             logger.warn(f"Wayback index: unable to connect to wayback")
             time.sleep(20)
             continue
         except Exception as e:
             error_msg = str(e).split("\n")[0]
-            logger.warn(f"Wayback index: {url} {error_msg}")
-            if not r or not wait or r.status_code not in [429, 445, 501, 503]:
-                return [], str(e)
+            logger.warn(f"Wayback index: {params.get('url')} {error_msg}")
+            if r is None or not wait or r.status_code not in [429, 445, 501, 503]:
+                raise CDXError(str(e))
             if count > 3:
-                return [], str(e)
+                raise CDXError(str(e))
             count += 1
             time.sleep(10)
-    if total_link:
-        r = [(i[1], f"{wayback_home}{i[1]}/{i[2]}", i[4]) for i in r[1:]]
-    else:
-        r = [(i[1], i[2], i[4]) for i in r[1:]]
-    if len(r) != 0:
-        return (
-            r,
-            "Success",
-        )
+
+
+def iter_wayback_cdx(url, param_dict={}, wait=True, proxies={}, page_size=CDX_PAGE_SIZE):
+    """
+    Stream the records of a CDX query with plain text output
+    Large queries are fetched page by page with resume key, so memory stays constant,
+        and callers can stop early (e.g. with itertools.islice)
+    page_size: Max #records of each request
+
+    yield: [urlkey, timestamp, original, mimetype, statuscode, digest, length]
+    raise: CDXError if not able to query the CDX server
+    """
+    params = {
+        "url": url,
+        "from": 19700101,
+        "to": 20221231,
+    }
+    params.update(param_dict)
+    params.pop("output", None)
+    limit = int(params.pop("limit", 0) or 0)
+    if limit < 0:  # * Last N records can't be paginated
+        params["limit"], page_size = limit, None
+    collapse = params.get("collapse")
+    collapse = collapse[0] if isinstance(collapse, list) and len(collapse) else collapse
+    collapse_idx, collapse_n = None, None
+    if collapse:
+        field, _, n = collapse.partition(":")
+        collapse_idx = ["urlkey", "timestamp", "original", "mimetype", "statuscode", "digest", "length"].index(field)
+        collapse_n = int(n) if n else None
+
+    total, last_key, resume_key = 0, None, None
+    while True:
+        page_params = dict(params)
+        if page_size:
+            page_params.update({
+                "limit": min(page_size, limit - total) if limit else page_size,
+                "showResumeKey": "true",
+            })
+        if resume_key:
+            page_params["resumeKey"] = resume_key
+        r = _cdx_request(page_params, wait=wait, proxies=proxies)
+        resume_key, end_of_records = None, False
+        try:
+            for line in r.iter_lines(decode_unicode=True):
+                if end_of_records:
+                    resume_key = line.strip() or resume_key
+                    continue
+                if not line.strip():  # * Resume key comes after an empty line
+                    end_of_records = True
+                    continue
+                record = line.split(" ")
+                # * Collapse is done per request, dedup groups across pages
+                if collapse_idx is not None:
+                    key = record[collapse_idx][:collapse_n]
+                    if key == last_key:
+                        continue
+                    last_key = key
+                yield record
+                total += 1
+        finally:
+            r.close()
+        time.sleep(0.5)
+        if not resume_key or (limit > 0 and total >= limit):
+            break
+
+
+def wayback_cdx(url, param_dict={}, wait=True, proxies={}):
+    """
+    Query the CDX server of wayback machine
+    wait: wait unitl not getting block
+
+    return: ( [[urlkey, timestamp, original, mimetype, statuscode, digest, length]], SUCCESS/EMPTY/ERROR_MSG)
+    """
+    try:
+        r = list(iter_wayback_cdx(url, param_dict=param_dict, wait=wait, proxies=proxies))
+    except CDXError as e:
+        return [], str(e)
+    if len(r) > 0:
+        return r, "Success"
     else:
         return [], "Empty"
 
 
+def wayback_index(url, param_dict={}, wait=True, total_link=False, proxies={}):
+    """
+    Get the wayback machine index of certain url by querying the CDX
+    wait: wait unitl not getting block
+    total_link: Returned url are in full(wayback) links
+
+    return: ( [(timestamp, url, stauts_code)], SUCCESS/EMPTY/ERROR_MSG)
+    """
+    wayback_home = "http://web.archive.org/web/"
+    r, status = wayback_cdx(url, param_dict=param_dict, wait=wait, proxies=proxies)
+    if total_link:
+        r = [(i[1], f"{wayback_home}{i[1]}/{i[2]}", i[4]) for i in r]
+    else:
+        r = [(i[1], i[2], i[4]) for i in r]
+    return r, status
+
+
 def wayback_year_links(
     prefix, years, NUM_THREADS=3, max_limit=0, param_dict={}, proxies={}
 ):
@@ -239,75 +440,44 @@ def wayback_year_links(
     Get the result of links in certain years
     prefix: some string of url e.g: *.a.b.com/*
     years: list of years which would be query
-    max_limit: Maximum #records in one retrieval
+    max_limit: Maximum #records in one year. 0 means no limit
     params: Any customized params, except time range
 
     Should be add in try catch. In case of connection error
     """
-    total_r = {}
-    cur_limit = 100000 if max_limit == 0 else max_limit
-    wayback_home = "http://web.archive.org/web/"
     params = {
-        "output": "json",
         "url": prefix,
-        "limit": str(cur_limit),
         "collapse": "urlkey",
         "filter": ["statuscode:200", "mimetype:text/html"],
     }
     params.update(param_dict)
-    l = threading.Lock()
-
-    def get_year_links(q_in):
-        nonlocal total_r, cur_limit, max_limit
-        while not q_in.empty():
-            year = q_in.get()
-            total_r.setdefault(year, set())
-            params.update(
-                {
-                    "from": "{}0101".format(year),
-                    "to": "{}1231".format(year),
-                    # 'collapse': 'timestamp:4',
-                }
-            )
 
-            while True:
-                try:
-                    r = requests.get(
-                        "http://web.archive.org/cdx/search/cdx",
-                        params=params,
-                        proxies=proxies,
-                    )
-                    r = r.json()
-                    r = [u[2] for u in r[1:]]
-                except Exception as e:
-                    print("1", str(e))
-                    time.sleep(10)
-                    continue
-                try:
-                    assert len(r) < cur_limit or cur_limit >= max_limit
-                    break
-                except Exception as e:
-                    print("2", str(e))
-                    cur_limit *= 2
-                    params.update({"limit": str(cur_limit)})
-                    continue
-            print((year, len(r)))
-            l.acquire()
-            for url in r:
-                total_r[year].add(url)
-            l.release()
-
-    t = []
-    q_in = queue.Queue(maxsize=len(years) + 1)
-    for year in years:
-        q_in.put(year)
-    for _ in range(NUM_THREADS):
-        t.append(threading.Thread(target=get_year_links, args=(q_in,)))
-        t[-1].start()
-    for tt in t:
-        tt.join()
+    def get_year_links(year):
+        year_params = dict(params)
+        year_params.update(
+            {
+                "from": "{}0101".format(year),
+                "to": "{}1231".format(year),
+                # 'collapse': 'timestamp:4',
+            }
+        )
+        while True:
+            try:
+                records = iter_wayback_cdx(prefix, param_dict=year_params, proxies=proxies)
+                if max_limit > 0:
+                    records = itertools.islice(records, max_limit)
+                r = set(u[2] for u in records)
+                break
+            except Exception as e:
+                print("1", str(e))
+                time.sleep(10)
+                continue
+        print((year, len(r)))
+        return r
 
-    return {k: list(v) for k, v in total_r.items()}
+    years = list(years)
+    total_r = map_concurrent(get_year_links, years, max_workers=NUM_THREADS)
+    return {year: list(r) for year, r in zip(years, total_r)}
 
 
 def alternative_request(url, timeout=15):
@@ -324,29 +494,29 @@ def alternative_request(url, timeout=15):
         return r
 
 
-def requests_crawl(url, timeout=20, wait=True, html=True, proxies={}, raw=False):
+def _is_dns_error(exc):
+    msg = str(exc)
+    return any(m in msg for m in ["NameResolutionError", "Name or service not known", "getaddrinfo failed",
+                                  "nodename nor servname", "No address associated", "Temporary failure in name resolution"])
+
+
+def requests_crawl_status(url, timeout=20, wait=True, html=True, proxies={}, raw=False):
     """
-    Use requests to get the page
-    Return None if fails to get the content
-    html: Only return html if set to true
-    wait: Will wait if get block
-    raw: Return raw response instead of html if set to True
+    Same as requests_crawl, but also return why the crawl fails
+    Failure classes: filtered_ext, robots, dns, timeout, connection, http_404, http_4xx, http_transient (408/425/429), http_5xx, not_html, error
 
-    Return:
-        If good crawl: str/response
-        Elif bad crawl: None
-        Else (not applicable): (None, Reason)
+    Return: (str/response, None) if good crawl, else (None, failure class)
     """
     requests_header = {"user-agent": config.config("user_agent")}
     filter_ext = [".pdf"]
     if os.path.splitext(url)[1] in filter_ext:
-        return None, "Filtered ext"
+        return None, "filtered_ext"
     count = 0
     if not rp.allowed(url, requests_header["user-agent"]):
-        return None, "Not Allowed by Robot.txt"
+        return None, "robots"
     while True:
         try:
-            r = requests.get(
+            r = get_session().get(
                 url,
                 timeout=timeout,
                 proxies=proxies,
@@ -357,6 +527,7 @@ def requests_crawl(url, timeout=20, wait=True, html=True, proxies={}, raw=False)
                 wait and (r.status_code == 429 or r.status_code == 504) and count < 3
             ):  # Requests limit
                 logger.debug(f"requests_crawl: {url} get status code {r.status_code}")
+                r.close()
                 count += 1
                 time.sleep(10)
                 continue
@@ -371,27 +542,35 @@ def requests_crawl(url, timeout=20, wait=True, html=True, proxies={}, raw=False)
                 logger.warn(
                     f"There is an ConnectionError exception with requests_crawl"
                 )
-                return
+                if isinstance(exc, requests.exceptions.Timeout):
+                    return None, "timeout"
+                return None, "dns" if _is_dns_error(exc) else "connection"
         except requests.exceptions.TooManyRedirects:
             logger.warn(f"requests too many redirects, try alternative crawl")
             try:
                 r = alternative_request(url, timeout=timeout)
                 break
             except Exception as e:
-                return
+                return None, "error"
         except Exception as e:
             logger.warn(f"There is an exception with requests_crawl: {str(e)}")
-            return
+            return None, "timeout" if isinstance(e, requests.exceptions.Timeout) else "error"
     if r.status_code >= 400:
         if r.status_code in [401, 403, 404]:
             logger.debug(f"requests_crawl: {url} Get status code {r.status_code}")
-        return
+        r.close()
+        if r.status_code in [404, 410]:
+            return None, "http_404"
+        if r.status_code in [408, 425, 429]:  # Timeout / rate limited, likely to work soon
+            return None, "http_transient"
+        return None, "http_5xx" if r.status_code >= 500 else "http_4xx"
     logger.debug(f"requests_crawl: got response {url}")
     headers = {k.lower(): v.lower() for k, v in r.headers.items()}
     content_type = headers["content-type"] if "content-type" in headers else ""
     if html and "html" not in content_type:
         logger.debug("requests_crawl: No html in content-type")
-        return
+        r.close()
+        return None, "not_html"
     try:
         r.encoding = r.apparent_encoding
         _ = r.content
@@ -399,9 +578,94 @@ def requests_crawl(url, timeout=20, wait=True, html=True, proxies={}, raw=False)
         pass
         # logger.debug('requests_crawl: Fail to decode the content of response')
     if raw:
-        return r
+        return r, None
     else:
-        return r.text
+        return r.text, None
+
+
+class RedirectChain:
+    """
+    Redirect chain fetched by resolve_redirects. url, history, status_code, headers are the same as requests.Response
+    Final body is not downloaded unless text is accessed, which reads (and decodes) at most body_limit bytes
+    """
+    def __init__(self, response, body_limit=REDIRECT_BODY_LIMIT):
+        self._response = response
+        self.body_limit = body_limit
+        self.url = response.url
+        self.history = response.history
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            try:
+                body = self._response.raw.read(self.body_limit, decode_content=True)
+            except Exception:
+                body = b""
+            self.close()
+            self._text = body.decode(self._response.encoding or "utf-8", errors="replace")
+        return self._text
+
+    def close(self):
+        self._response.close()
+
+
+def resolve_redirects(url, timeout=20, wait=True, html=True, proxies={}, body_limit=REDIRECT_BODY_LIMIT):
+    """
+    Follow url's redirections (Location headers) without downloading the final body
+    Use it instead of requests_crawl(raw=True) if only the final url / history (and maybe a prefix of body) is needed
+    Caller should close() the chain if text is not read
+
+    Return: RedirectChain if final response is good (< 400 & html if html is True), else None
+    """
+    if not rp.allowed(url, requests_header["user-agent"]):
+        return None
+    count = 0
+    while True:
+        try:
+            r = get_session().get(url, timeout=timeout, proxies=proxies, headers=requests_header, stream=True)
+        except requests.exceptions.ConnectionError as exc:
+            if len(proxies):
+                proxies = {}
+                continue
+            return None
+        except Exception as e:
+            logger.debug(f"resolve_redirects: {url} {str(e)}")
+            return None
+        if wait and r.status_code in [429, 504] and count < 3:  # Requests limit
+            r.close()
+            count += 1
+            time.sleep(10)
+            continue
+        break
+    content_type = r.headers.get("content-type", "").lower()
+    if r.status_code >= 400 or (html and "html" not in content_type):
+        r.close()
+        return None
+    return RedirectChain(r, body_limit=body_limit)
+
+
+def requests_crawl(url, timeout=20, wait=True, html=True, proxies={}, raw=False):
+    """
+    Use requests to get the page
+    Return None if fails to get the content
+    html: Only return html if set to true
+    wait: Will wait if get block
+    raw: Return raw response instead of html if set to True
+
+    Return:
+        If good crawl: str/response
+        Elif bad crawl: None
+        Else (not applicable): (None, Reason)
+    """
+    r, failure = requests_crawl_status(url, timeout=timeout, wait=wait, html=html, proxies=proxies, raw=raw)
+    if failure == "filtered_ext":
+        return None, "Filtered ext"
+    elif failure == "robots":
+        return None, "Not Allowed by Robot.txt"
+    return r
 
 
 def get_sitemaps(hostname):
@@ -503,6 +767,28 @@ def wappalyzer_analyze(url, timeout=None):
     return tech
 
 
+WAYBACK_REWRITE_MARKERS = ["wm-ipp-base", "Wayback Rewrite JS Include", "web.archive.org/_static/", "__wm.init"]
+
+
+def is_wayback_rewritten(html):
+    """Whether wayback html comes with toolbar and rewritten links. False for original captures (id_)"""
+    return any(m in html for m in WAYBACK_REWRITE_MARKERS)
+
+
+def _link_joiner(url, html, wayback, rewritten_join):
+    """
+    Return (base url, func(base_url, link) --> absolute link)
+    For original captures, links are joined against the original URL and wrapped back into wayback form
+    rewritten_join: join func for wayback pages with rewritten links
+    """
+    if not wayback:
+        return url, urljoin
+    if is_wayback_rewritten(html):
+        return url, rewritten_join
+    ts = get_ts(url)
+    return filter_wayback(url), lambda base_url, link: constr_wayback(urljoin(base_url, link), ts)
+
+
 def outgoing_links(url, html, wayback=False):
     """
     Given the html, return all the outgoing links
@@ -532,8 +818,9 @@ def outgoing_links(url, html, wayback=False):
         if len(donato) > 0:
             donato[0].decompose()
 
+    page_url, join = _link_joiner(url, html, wayback, wayback_join)
     base = soup.find("base")
-    base_url = url if base is None else urljoin(url, base.get("href"))
+    base_url = page_url if base is None else urljoin(page_url, base.get("href"))
 
     for a_tag in soup.find_all("a"):
         if "href" not in a_tag.attrs or a_tag.text.strip() == "":
@@ -541,10 +828,7 @@ def outgoing_links(url, html, wayback=False):
         link = a_tag.attrs["href"]
         if len(link) == 0 or link[0] == "#":  # Anchor ignore
             continue
-        if wayback:
-            link = wayback_join(base_url, link)
-        else:
-            link = urljoin(base_url, link)
+        link = join(base_url, link)
         if urlparse(filter_wayback(link)).scheme not in {"http", "https"}:
             continue
         outlinks.add(link)
@@ -584,8 +868,9 @@ def outgoing_links_sig(url, html, wayback=False):
         if len(donato) > 0:
             donato[0].decompose()
 
+    page_url, join = _link_joiner(url, html, wayback, wayback_join)
     base = soup.find("base")
-    base_url = url if base is None else urljoin(url, base.get("href"))
+    base_url = page_url if base is None else urljoin(page_url, base.get("href"))
 
     for a_tag in soup.find_all("a"):
         if "href" not in a_tag.attrs or a_tag.text.strip() == "":
@@ -595,10 +880,7 @@ def outgoing_links_sig(url, html, wayback=False):
         if len(link) == 0 or link[0] == "#":  # Anchor ignore
             continue
         try:
-            if wayback:
-                link = wayback_join(base_url, link)
-            else:
-                link = urljoin(base_url, link)
+            link = join(base_url, link)
         except:
             continue
         if urlparse(filter_wayback(link)).scheme not in {"http", "https"}:
@@ -681,7 +963,7 @@ def __extract_breadcrumb(tag):
     return
 
 
-def __breadcrumb_tolinks(tbc, base_url, wayback):
+def __breadcrumb_tolinks(tbc, base_url, join):
     links = []
     for a_tag in tbc.find_all("a"):
         if "href" not in a_tag.attrs or a_tag.text.strip() == "":
@@ -691,10 +973,7 @@ def __breadcrumb_tolinks(tbc, base_url, wayback):
         if len(link) == 0 or link[0] == "#":  # Anchor ignore
             continue
         try:
-            if wayback:
-                link = wayback_join(base_url, link)
-            else:
-                link = urljoin(base_url, link)
+            link = join(base_url, link)
         except:
             continue
         if urlparse(filter_wayback(link)).scheme not in {"http", "https"}:
@@ -723,9 +1002,10 @@ def _breadcrumb_vague(url, html, wayback):
     except:
         return []
     atags = []
+    page_url, join = _link_joiner(url, html, wayback, wayback_join)
     for ancestor in ancestors:
         base = soup.find("base")
-        base_url = url if base is None else urljoin(url, base.get("href"))
+        base_url = page_url if base is None else urljoin(page_url, base.get("href"))
         q = filter_wayback(ancestor)
         q = _norm_scheme(q).replace("http://", "")
         q = re.escape(q)
@@ -743,7 +1023,7 @@ def _breadcrumb_vague(url, html, wayback):
         breadcrumb_tag = __extract_breadcrumb(a_tag)
         if breadcrumb_tag is None:
             continue
-        links = __breadcrumb_tolinks(breadcrumb_tag, base_url, wayback=wayback)
+        links = __breadcrumb_tolinks(breadcrumb_tag, base_url, join)
         # print(links)
         if len(links) > 0 and len(links) <= pathlen:
             breadcrumb.append(links)
@@ -760,8 +1040,9 @@ def _breadcrumb(url, html, wayback):
     except:
         logger.warn("Failed to construct soup")
         return []
+    page_url, join = _link_joiner(url, html, wayback, wayback_join)
     base = soup.find("base")
-    base_url = url if base is None else urljoin(url, base.get("href"))
+    base_url = page_url if base is None else urljoin(page_url, base.get("href"))
     identifiler = "class"
     breadcrumb_tags = soup.find_all(None, {identifiler: re.compile("breadcrumb")})
     if len(breadcrumb_tags) == 0:
@@ -776,7 +1057,7 @@ def _breadcrumb(url, html, wayback):
         top_breadcrumb_tags.append(bc)
     breadcrumb = []
     for tbc in top_breadcrumb_tags:
-        links = __breadcrumb_tolinks(tbc, base_url, wayback=wayback)
+        links = __breadcrumb_tolinks(tbc, base_url, join)
         if len(links) > 0:
             breadcrumb.append(links)
     # TODO: Is this OK?
@@ -8,9 +8,11 @@ from fable import config
 
 db = config.DB
 
-db.crawl.create_index([('html', pymongo.HASHED)])
+db.crawl.create_index([('html_digest', pymongo.ASCENDING)])
 db.crawl.create_index([('site', pymongo.ASCENDING), ('url', pymongo.ASCENDING)], unique=True)
 
+db.site_titles.create_index([('site', pymongo.ASCENDING), ('wayback', pymongo.ASCENDING)])
+
 
 db.searched.create_index([('query', pymongo.ASCENDING), ('engine', pymongo.ASCENDING)])
 db.searched.create_index([('query', pymongo.ASCENDING), ('engine', pymongo.ASCENDING), ('site', pymongo.ASCENDING)])
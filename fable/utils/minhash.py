@@ -0,0 +1,141 @@
+"""
+MinHash signatures and LSH index for near-duplicate content detection
+Signature estimates the jaccard similarity of k-token shingles (same shingles as text_utils.k_shingling),
+so it is computed once per content and compared in O(NUM_PERM) instead of re-tokenizing both texts
+"""
+import hashlib
+import functools
+from collections import defaultdict
+import numpy as np
+
+from . import tokenizer, cache
+
+NUM_PERM = 128
+SHINGLE_K = 5
+# * 16 bands x 8 rows: pairs with jaccard >= 0.9 collide in some band with probability > 0.999
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+SIGNATURE_CACHE_BYTES = 32*1024*1024
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_SHINGLE_BASE = np.uint64(1000003)
+_CHUNK = 4096 # * #shingles hashed at once, bounds the (CHUNK, NUM_PERM) intermediate
+
+_rand = np.random.RandomState(1)
+_PERM_A = _rand.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rand.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+_signature_cache = cache.LRUCache(max_bytes=SIGNATURE_CACHE_BYTES)
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def _token_hash(token):
+    """Stable (across processes) 32 bits hash of a token"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8', 'surrogatepass'), digest_size=4).digest(), 'little')
+
+
+def _shingle_hashes(tokens, k):
+    """32 bits hash of each k-token shingle. Texts shorter than k are one shingle"""
+    h = np.fromiter((_token_hash(t) for t in tokens), dtype=np.uint64, count=len(tokens))
+    n = max(len(tokens) - k + 1, 1)
+    shingles = np.zeros(n, dtype=np.uint64)
+    for j in range(min(k, len(tokens))):
+        shingles = shingles * _SHINGLE_BASE + h[j: j+n] # * Wraps around 2^64
+    return np.unique(shingles & _MAX_HASH)
+
+
+def signature_of_tokens(tokens, k=SHINGLE_K):
+    shingles = _shingle_hashes(tokens, k)
+    sig = np.full(NUM_PERM, _MAX_HASH, dtype=np.uint64)
+    for i in range(0, len(shingles), _CHUNK):
+        chunk = shingles[i: i+_CHUNK, None]
+        phv = ((chunk * _PERM_A + _PERM_B) % _MERSENNE_PRIME) & _MAX_HASH
+        sig = np.minimum(sig, phv.min(axis=0))
+    return sig.astype(np.uint32)
+
+
+def signature(text):
+    """MinHash signature (uint32 array of NUM_PERM) of text. Cached by text digest"""
+    key = cache.digest(text)
+    sig = _signature_cache.get(key)
+    if sig is None:
+        sig = signature_of_tokens(tokenizer.tokenize(text))
+        _signature_cache.set(key, sig)
+    return sig
+
+
+def signature_many(texts):
+    return [signature(text) for text in texts]
+
+
+def cache_signature(text, sig):
+    """Seed the signature cache with a persisted signature (see to_bytes) of text"""
+    if isinstance(sig, (bytes, bytearray)):
+        sig = from_bytes(sig)
+    _signature_cache.set(cache.digest(text), sig)
+
+
+def to_bytes(sig):
+    return np.asarray(sig, dtype='<u4').tobytes()
+
+
+def from_bytes(b):
+    return np.frombuffer(b, dtype='<u4').astype(np.uint32)
+
+
+def similarity(sig1, sig2):
+    """Estimated jaccard similarity of two signatures"""
+    return float(np.count_nonzero(sig1 == sig2)) / NUM_PERM
+
+
+def similarity_many(sig, sigs):
+    """Estimated jaccard similarity of sig with each of sigs. Return: np array"""
+    if len(sigs) == 0:
+        return np.zeros(0)
+    return (np.vstack(sigs) == sig).sum(axis=1) / NUM_PERM
+
+
+def text_similarity(text1, text2):
+    """Drop-in for text_utils.k_shingling"""
+    return similarity(signature(text1), signature(text2))
+
+
+class LSHIndex:
+    """
+    Banded LSH over MinHash signatures
+    Answers "which added keys have ~same content" with a bucket lookup + signature check on collided keys only
+    """
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS):
+        assert(bands * rows <= NUM_PERM)
+        self.bands, self.rows = bands, rows
+        self.buckets = [defaultdict(set) for _ in range(bands)]
+        self.sigs = {}
+
+    def _band_keys(self, sig):
+        return [sig[b*self.rows: (b+1)*self.rows].tobytes() for b in range(self.bands)]
+
+    def add(self, key, sig):
+        if key in self.sigs:
+            return
+        self.sigs[key] = sig
+        for bucket, band in zip(self.buckets, self._band_keys(sig)):
+            bucket[band].add(key)
+
+    def candidates(self, sig):
+        cands = set()
+        for bucket, band in zip(self.buckets, self._band_keys(sig)):
+            cands.update(bucket.get(band, ()))
+        return cands
+
+    def query(self, sig, threshold=0.9):
+        """Return: {key: estimated similarity} of added keys with similarity >= threshold"""
+        cands = list(self.candidates(sig))
+        simis = similarity_many(sig, [self.sigs[c] for c in cands])
+        return {c: float(s) for c, s in zip(cands, simis) if s >= threshold}
+
+    def __contains__(self, key):
+        return key in self.sigs
+
+    def __len__(self):
+        return len(self.sigs)
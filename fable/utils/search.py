@@ -4,12 +4,13 @@ Utils library for search
 import requests
 import json
 import sys, time
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
 from pymongo import MongoClient
 
 
 from fable import config
-from . import text_utils, crawl, url_utils
+from . import text_utils, crawl, url_utils, site_resolver
 
 
 requests_header = {'user-agent': config.config('user_agent')}
@@ -71,12 +72,12 @@ def google_search(query, end=0, param_dict={}, site_spec_url=None, use_db=False)
     }
     google_query_dict['q'] = query
     if site_spec_url:
-        try:
-            if '://' not in site_spec_url: site_spec_url = f'http://{site_spec_url}'
-            r = requests.get(site_spec_url, headers=crawl.requests_header, timeout=10, proxies=bypass_proxy)
-            site = host_extractor.extract(r.url)
-            param_dict.update({'siteSearch': site})
-        except: site = ""
+        if '://' not in site_spec_url: site_spec_url = f'http://{site_spec_url}'
+        site_info = site_resolver.resolve(site_spec_url)
+        # * Homepage not working (error status, non html, robots...): still restrict the search to the given site
+        site = site_info.site if site_info is not None else host_extractor.extract(site_spec_url)
+        if not site: site = urlsplit(site_spec_url).netloc
+        param_dict.update({'siteSearch': site})
     else: site = ""
     google_query_dict.update(param_dict)
     count = 0
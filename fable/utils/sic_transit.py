@@ -13,7 +13,7 @@ from math import ceil
 from bs4 import BeautifulSoup
 
 from fable import config
-from . import text_utils, url_utils, crawl
+from . import text_utils, url_utils, crawl, minhash
 from .crawl import rp 
 import logging
 logger = logging.getLogger('logger')
@@ -43,7 +43,7 @@ def send_request(url, timeout=15):
     if not rp.allowed(url, requests_header['user-agent']):
         return None, 'Not Allowed'
     try:
-        resp = requests.get(url, headers=requests_header, timeout=timeout, stream=True)
+        resp = crawl.get_session().get(url, headers=requests_header, timeout=timeout, stream=True)
         # resp = requests.get(url, headers=requests_header, timeout=timeout, stream=True, verify=False)
         headers = {k.lower(): v.lower() for k, v in resp.headers.items()}
         content_type = headers['content-type'] if 'content-type' in headers else ''
@@ -322,7 +322,7 @@ def broken(url, html=False, ignore_soft_404=False, ignore_soft_404_content=False
             try:
                 random_content = BeautifulSoup(random_resp.text, 'lxml').get_text(separator=' ')
             except: random_content = random_resp.text
-            if text_utils.k_shingling(text_norm(url_content), text_norm(random_content)) >= 0.9:
+            if minhash.text_similarity(text_norm(url_content), text_norm(random_content)) >= 0.9:
                 # print(text_norm(url_content), text_norm(random_content))
                 broken_decision.append(True)
                 reasons.append("Similar soft 404 content")
@@ -0,0 +1,115 @@
+"""
+Site resolution: where does http://host lead to today
+Homepage final-URL lookups repeated across the pipeline share one TTL cache,
+and concurrent lookups of the same host wait for a single fetch
+"""
+import threading
+from collections import namedtuple
+
+from . import crawl, url_utils, cache
+
+import logging
+logger = logging.getLogger('logger')
+
+SITE_TTL = 24*3600 # * Seconds a resolved site is reused
+NEGATIVE_TTL = 3600 # * Seconds an unresolvable host is remembered
+CACHE_BYTES = 16*1024*1024
+RESOLVE_TIMEOUT = 10
+
+he = url_utils.HostExtractor()
+
+# * final_url: live URL http://host ends up at. site: registered site (HostExtractor) of final_url
+SiteInfo = namedtuple('SiteInfo', ['host', 'final_url', 'site'])
+
+_FAILED = 'failed'
+
+
+def fetch_final_url(url):
+    """Follow url's redirections without downloading the page. Return: final url, None if not working"""
+    chain = crawl.resolve_redirects(url, timeout=RESOLVE_TIMEOUT)
+    if chain is None:
+        return None
+    chain.close()
+    return chain.url
+
+
+class SiteResolver:
+    """TTL cache of host --> SiteInfo with single-flight fetching"""
+    def __init__(self, fetch=fetch_final_url, ttl=SITE_TTL, negative_ttl=NEGATIVE_TTL, max_bytes=CACHE_BYTES):
+        """fetch: func(url) -> final url or None"""
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = cache.LRUCache(max_bytes=max_bytes, default_ttl=ttl)
+        self._inflight = {} # * {url: threading.Event} of fetches in progress
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host):
+        url = host if '://' in host else f'http://{host}'
+        return url_utils.url_norm(url, ignore_scheme=True)
+
+    def _cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return False, None
+        return True, None if entry == _FAILED else entry
+
+    def resolve(self, host):
+        """
+        host: host or URL of the site's homepage (e.g. example.com, http://example.com)
+        Return: SiteInfo, None if http://host is not working
+        """
+        url = host if '://' in host else f'http://{host}'
+        key = self._key(host)
+        while True:
+            hit, info = self._cached(key)
+            if hit:
+                return info
+            with self._lock:
+                event = self._inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self._inflight[key] = threading.Event()
+            if not leader:
+                event.wait()
+                continue # * Leader's result is cached, unless its ttl is 0 or fetch raised
+            try:
+                return self._resolve(url, key)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                event.set()
+
+    def _resolve(self, url, key):
+        try:
+            final_url = self.fetch(url)
+        except Exception as e:
+            logger.debug(f'SiteResolver: {url} {str(e)}')
+            final_url = None
+        if final_url is None:
+            self.cache.set(key, _FAILED, ttl=self.negative_ttl)
+            return None
+        info = SiteInfo(url, final_url, he.extract(final_url))
+        self.cache.set(key, info)
+        return info
+
+    def clear(self):
+        self.cache.clear()
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def get_resolver():
+    """Process-wide SiteResolver"""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = SiteResolver()
+        return _resolver
+
+
+def resolve(host):
+    """SiteResolver.resolve with the process-wide resolver"""
+    return get_resolver().resolve(host)
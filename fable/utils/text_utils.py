@@ -3,7 +3,7 @@ Utils for text
 """
 from os.path import join, dirname, abspath, splitext
 from subprocess import call
-import re, os, time
+import re, os, time, json
 import sys, copy
 import multiprocessing as mp
 from multiprocessing import Process
@@ -38,6 +38,7 @@ from nltk.stem.snowball import SnowballStemmer
 from nltk.stem import WordNetLemmatizer
 
 from .. import config
+from . import cache, tokenizer
 
 sys.setrecursionlimit(1500)
 tmp_path = config.TMP_PATH
@@ -56,37 +57,29 @@ prepare_nltk()
 stemmer = SnowballStemmer('english')
 lemmatizer = WordNetLemmatizer()
 
-stem_cache = {}
 def tokenize(texts):
     """
-    Simple function for tokenizing a text. Extracted from sklearn src code
+    Simple function for tokenizing a text (english stop words removed, stemmed)
     
     Returns: list of features in the original order
     """
-    texts = texts.replace('_', ' ')
-    # # ? Tokenize: Scikit-Learn version
-    cv = CountVectorizer(stop_words='english', token_pattern=r"(?u)\b\w+\b") # TODO: Not necessary english
-    analyze = cv.build_analyzer()
-    texts = analyze(texts)
-    # ? Tokenize: nltk version
-    # texts = nltk.word_tokenize(texts)
-    def cached_transform(t, func, cache):
-        if t in cache:
-            return cache[t]
-        tt = func(t)
-        cache[t] = tt
-        return tt
-    # * Stemming
-    texts = [cached_transform(t, stemmer.stem, stem_cache) for t in texts]
-    # * Lemmatization
-    # texts = [lemmatizer.lemmatize(t) for t in texts]
-    return texts
+    return tokenizer.tokenize(texts)
+
+OVERLAY_DIM = 1 << 24 # * Max #terms unseen in base corpus within one working set
+TERM_COUNTS_CACHE_BYTES = 64*1024*1024
 
 vectorizer_kwargs = {
     # 'stop_words': [stemmer.stem(s) for s in stopwords.words('english')], 
-    'stop_words': 'english', 
-    'tokenizer': tokenize, 
-    'token_pattern': None
+    # * Same as stop_words='english' + tokenizer=tokenize, without sklearn's per-doc preprocessing overhead
+    'analyzer': tokenizer.analyze
+}
+# * Persisted base model format. Bump on layout change, or on any change that alters tokens of tokenize
+TFIDF_MODEL_VERSION = 1
+TOKENIZER_CONFIG = {
+    'tokenizer': 'text_utils.tokenize',
+    'token_pattern': r"(?u)\b\w+\b",
+    'stop_words': 'english',
+    'stemmer': 'snowball-english',
 }
 class TFidfDynamic:
     def re_init(self):
@@ -152,92 +145,196 @@ class TFidfDynamic:
         return [(self.corpus[i], array[i]) for i in reversed(idxes) if i != idx]
 
 class TFidfStatic:
+    """
+    TFIDF with a fixed base model fitted on corpus
+    Similarities are computed within a working set of texts (add_corpus).
+    Terms unseen in the corpus are put into an overlay, with idf computed from their df in the working set
+    Only raw term counts are cached. idf is applied when vectors are built, so growing the working set invalidates nothing
+    """
     def __init__(self, corpus):
         corpus = list(set(corpus))
-        self.corpus = corpus
         self.vectorizer = TfidfVectorizer(**vectorizer_kwargs)
         self.vectorizer.fit(corpus)
-        self.tfidf = self.vectorizer.transform(corpus)
-        self.workingset_vec = None
-        self.workingset_tfidf = None
-        self.idx = None
-    
+        self._init_base(self.vectorizer.vocabulary_, self.vectorizer.idf_, len(corpus))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load base model saved by save(). idf is memory mapped, so workers loading the same path share pages
+        Raise exception if the model is built with another format or tokenizer
+        """
+        meta = json.load(open(os.path.join(path, 'meta.json'), 'r'))
+        if meta.get('version') != TFIDF_MODEL_VERSION:
+            raise Exception(f"TFIDF model version mismatch: {meta.get('version')} (expect {TFIDF_MODEL_VERSION})")
+        if meta.get('tokenizer') != TOKENIZER_CONFIG:
+            raise Exception(f"TFIDF model tokenizer mismatch: {meta.get('tokenizer')}")
+        terms = np.load(os.path.join(path, 'vocab.npy'))
+        idf = np.load(os.path.join(path, 'idf.npy'), mmap_mode='r')
+        tfidf = cls.__new__(cls)
+        tfidf.vectorizer = TfidfVectorizer(**vectorizer_kwargs) # * Only used for its analyzer
+        tfidf._init_base({str(t): i for i, t in enumerate(terms)}, idf, meta['n_docs'])
+        return tfidf
+
+    def save(self, path):
+        """
+        Save base model (vocab, idf, tokenizer config) under directory path
+        meta.json is written last, so a partially written model is never loaded
+        """
+        os.makedirs(path, exist_ok=True)
+        terms = np.empty(len(self.vocab), dtype=object)
+        for term, idx in self.vocab.items():
+            terms[idx] = term
+        np.save(os.path.join(path, 'vocab.npy'), terms.astype(str))
+        np.save(os.path.join(path, 'idf.npy'), np.asarray(self.idf, dtype=np.float64))
+        meta = {
+            'version': TFIDF_MODEL_VERSION,
+            'tokenizer': TOKENIZER_CONFIG,
+            'n_docs': self.n_docs,
+            'n_terms': len(self.vocab),
+            'built': int(time.time())
+        }
+        tmp_meta = os.path.join(path, 'meta.json.tmp')
+        json.dump(meta, open(tmp_meta, 'w+'))
+        os.replace(tmp_meta, os.path.join(path, 'meta.json'))
+
+    def _init_base(self, vocab, idf, n_docs):
+        """Base model is immutable after init"""
+        self.vocab = vocab
+        self.idf = idf
+        self.n_docs = n_docs
+        self.dim = len(vocab) + OVERLAY_DIM
+        self.analyzer = tokenizer.analyze
+        self.counts_cache = cache.LRUCache(max_bytes=TERM_COUNTS_CACHE_BYTES)
+        self._clear_workingset()
+
+    def _counts(self, text):
+        """
+        Raw term counts of text, cached by text digest across working sets
+        Return: (base term indices (sorted), their counts, overlay terms, their counts)
+        """
+        key = cache.digest(text)
+        counts = self.counts_cache.get(key)
+        if counts is None:
+            tf = defaultdict(int)
+            for term in self.analyzer(text):
+                tf[term] += 1
+            base = sorted((self.vocab[term], c) for term, c in tf.items() if term in self.vocab)
+            overlay = [(term, c) for term, c in tf.items() if term not in self.vocab]
+            counts = (
+                np.array([i for i, _ in base], dtype=np.int64),
+                np.array([c for _, c in base], dtype=np.float64),
+                tuple(term for term, _ in overlay),
+                np.array([c for _, c in overlay], dtype=np.float64)
+            )
+            self.counts_cache.set(key, counts)
+        return counts
+
     def _init_workingset(self, inputs):
         """
         Get tfidf within inputs. 
         TFIDF value will be based on the previous corpus instead of the input
         """
-        inputs = list(set(inputs))
-        self.idx = {i: c for c, i in enumerate(inputs)}
-        # Get vocabulary from inputs
-        idf = self.vectorizer.idf_
-        # vocab = defaultdict(None, self.vectorizer.vocabulary_)
-        vocab = self.vectorizer.vocabulary_.copy()
-        vsize = len(vocab)
-        # vocab.default_factory = vocab.__len__
-        inputs_tfidf = TfidfVectorizer(**vectorizer_kwargs)
-        inputs_matrix = inputs_tfidf.fit_transform(inputs)
-        # Add unseen vocab to existed corpus
-        num_docs = inputs_matrix.shape[0]
-        inputs_idf = inputs_tfidf.idf_
-        inputs_vocab = inputs_tfidf.vocabulary_
-        for word in inputs_vocab.keys():
-            # Added with proper index if not in vocabulary
-            if word not in vocab:
-                vocab[word] = vsize
-                vsize += 1
-                df = (num_docs + 1) / np.exp(inputs_idf[inputs_vocab[word]] - 1) - 1
-                df = np.log((self.tfidf.shape[0] + 1) / (df + 1)) + 1
-                idf = np.append(idf, [df])
-        # Construct workingset
-        self.workingset_vec = TfidfVectorizer(vocabulary=vocab, **vectorizer_kwargs)
-        def my_validate_vocab(self):
-            self.vocabulary_ = self.vocabulary
-        self.workingset_vec._validate_vocabulary = functools.partial(my_validate_vocab, self.workingset_vec)
-        self.fixed_vocabulary_ = True       
-        self.workingset_vec.idf_ = idf
-        # self.workingset_vec._idf_diag = sp.diags(idf, offsets=0,
-        #                                 shape=(idf.shape[0], idf.shape[0]),
-        #                                 format='csr',
-        #                                 dtype=np.float64)
-        self.workingset_tfidf = self.workingset_vec.transform(inputs)
-    
+        self._clear_workingset()
+        self._add_workingset(inputs)
+
+    def _add_workingset(self, inputs):
+        """Add texts into working set. Only overlay terms' df changes, which costs O(#overlay terms of text)"""
+        for text in inputs:
+            if text in self.idx:
+                continue
+            self.idx[text] = len(self.idx)
+            for term in self._counts(text)[2]:
+                if term not in self.overlay_idx:
+                    self.overlay_idx[term] = len(self.overlay_terms)
+                    self.overlay_terms.append(term)
+                self.overlay_df[term] += 1
+
     def _clear_workingset(self):
-        self.idx = None
-        self.workingset_vec = None
-        self.workingset_tfidf = None
-    
+        self.idx = {}
+        self.overlay_idx = {}
+        self.overlay_terms = []
+        self.overlay_df = defaultdict(int)
+
+    def _overlay_idf(self, term):
+        return np.log((self.n_docs + 1) / (self.overlay_df[term] + 1)) + 1
+
+    def _rows(self, texts):
+        """L2 normalized tfidf rows of texts in the working set, weighted with the current idf"""
+        indices, data, indptr = [], [], [0]
+        for text in texts:
+            base_idx, base_tf, overlay_terms, overlay_tf = self._counts(text)
+            overlay_idx = np.array([self.overlay_idx[term] for term in overlay_terms], dtype=np.int64) + len(self.vocab)
+            overlay_idf = np.array([self._overlay_idf(term) for term in overlay_terms], dtype=np.float64)
+            indices += [base_idx, overlay_idx]
+            data += [base_tf * self.idf[base_idx], overlay_tf * overlay_idf]
+            indptr.append(indptr[-1] + len(base_idx) + len(overlay_idx))
+        mat = sp.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(len(texts), self.dim))
+        mat.sort_indices()
+        norms = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sp.csr_matrix(sp.diags(1 / norms).dot(mat))
+
+    def _vector(self, text):
+        """L2 normalized tfidf row vector of text in the working set"""
+        if text not in self.idx:
+            self._add_workingset([text])
+        return self._rows([text])
+
+    def _feature_name(self, i):
+        if i < len(self.vocab):
+            if not hasattr(self, '_base_names'):
+                self._base_names = np.empty(len(self.vocab), dtype=object)
+                for term, idx in self.vocab.items():
+                    self._base_names[idx] = term
+            return self._base_names[i]
+        return self.overlay_terms[i - len(self.vocab)]
+
     def similar(self, text1, text2):
         if text1 == "" or text2 == "": return 0
-        if self.workingset_vec is None:
-            inputs_tfidf = TfidfVectorizer(**vectorizer_kwargs)
-            try:
-                _ = inputs_tfidf.fit_transform([text1, text2])
-            except: return 0
+        if len(self.idx) == 0:
             self._init_workingset([text1, text2])
-        idx1, idx2 = self.idx[text1], self.idx[text2]
-        return cosine_similarity(self.workingset_tfidf[idx1], self.workingset_tfidf[idx2])[0,0]
-    
+        vec1, vec2 = self._vector(text1), self._vector(text2)
+        return vec1.multiply(vec2).sum()
+
+    def _matrix(self, texts):
+        """Stacked L2 normalized rows of texts. All texts are added into working set first, so that rows share df"""
+        self._add_workingset(texts)
+        return self._rows(texts)
+
+    def similar_many(self, text, texts):
+        """
+        Similarity of text with each of texts, in one sparse matrix-vector product
+        Return: np array in the order of texts
+        """
+        texts = list(texts)
+        if text == "" or len(texts) == 0:
+            return np.zeros(len(texts))
+        if len(self.idx) == 0:
+            self._init_workingset([text] + texts)
+        mat = self._matrix([text] + texts)
+        return mat[1:].dot(mat[0].T).toarray().ravel()
+
+    def similar_matrix(self, texts1, texts2):
+        """
+        Pairwise similarity between texts1 and texts2
+        Return: np array of shape (len(texts1), len(texts2))
+        """
+        texts1, texts2 = list(texts1), list(texts2)
+        if len(texts1) == 0 or len(texts2) == 0:
+            return np.zeros((len(texts1), len(texts2)))
+        if len(self.idx) == 0:
+            self._init_workingset(texts1 + texts2)
+        mat = self._matrix(texts1 + texts2)
+        return mat[:len(texts1)].dot(mat[len(texts1):].T).toarray()
+
     def topN(self, text, N=7):
-        if self.workingset_vec is None:
-            inputs_tfidf = TfidfVectorizer(**vectorizer_kwargs)
-            try:
-                _ = inputs_tfidf.fit_transform([text])
-            except: return ''
-            self._init_workingset([text])
-        array = self.workingset_tfidf[self.idx[text]].toarray()[0]
-        idxes = array.argsort()[-N:]
-        words = self.workingset_vec.get_feature_names()
-        return [words[i] for i in reversed(idxes)]
+        """Highest weighted (at most) N terms of text"""
+        vec = self._vector(text)
+        order = np.argsort(-vec.data, kind='stable')[:N]
+        return [self._feature_name(vec.indices[i]) for i in order]
 
     def add_corpus(self, inputs):
-        if self.workingset_vec is not None:
-            self._clear_workingset()
-        inputs_tfidf = TfidfVectorizer(**vectorizer_kwargs)
-        try:
-            _ = inputs_tfidf.fit_transform(inputs)
-        except: return
-        self._init_workingset(inputs)
+        self._init_workingset(list(set(inputs)))
 
 
 def find_complement_string(A, B):
@@ -815,8 +912,7 @@ def extract_title_body(html, handle_exception=True):
 
 
 def k_shingling(text1, text2, k=5):
-    text1 = tokenize(text1)
-    text2 = tokenize(text2)
+    text1, text2 = tokenizer.tokenize_many([text1, text2])
     if len(text1) < k:
         shingle1 = [tuple(text1)]
     else:
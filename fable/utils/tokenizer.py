@@ -0,0 +1,76 @@
+"""
+Precompiled word tokenizer shared by text_utils and url_utils
+Produces the same tokens as sklearn's analyzer (token_pattern (?u)\\b\\w+\\b, lowercase, stop words) + snowball stemming,
+without building a CountVectorizer on every call
+"""
+import re
+import functools
+
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS as _SKLEARN_STOP_WORDS
+from nltk.stem.snowball import SnowballStemmer
+
+TOKEN_RE = re.compile(r"(?u)\b\w+\b")
+ENGLISH_STOP_WORDS = frozenset(_SKLEARN_STOP_WORDS)
+STEM_CACHE_SIZE = 1 << 18
+
+stemmer = SnowballStemmer('english')
+
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(token):
+    return stemmer.stem(token)
+
+
+@functools.lru_cache(maxsize=64)
+def _stop_set(stop_words):
+    if stop_words == 'english':
+        return ENGLISH_STOP_WORDS
+    if not stop_words:
+        return None
+    return frozenset(stop_words)
+
+
+def _hashable(stop_words):
+    if stop_words is None or isinstance(stop_words, (str, frozenset)):
+        return stop_words
+    return frozenset(stop_words)
+
+
+def tokenize(text, stop_words='english', nonstop_words=(), stemming=True):
+    """
+    stop_words: 'english', None, or collection of words to drop (before stemming)
+    nonstop_words: substrings removed from text before tokenizing
+
+    Returns: list of features in the original order
+    """
+    return _tokenize(text, _stop_set(_hashable(stop_words)), nonstop_words, stemming)
+
+
+def _tokenize(text, stop_set, nonstop_words, stemming):
+    text = text.replace('_', ' ')
+    for nsw in nonstop_words:
+        text = text.replace(nsw, '')
+    tokens = TOKEN_RE.findall(text.lower())
+    if stop_set:
+        tokens = [t for t in tokens if t not in stop_set]
+    if stemming:
+        tokens = [stem(t) for t in tokens]
+    return tokens
+
+
+def tokenize_many(texts, stop_words='english', nonstop_words=(), stemming=True):
+    """Batch version of tokenize. Stop word set is resolved once for all texts"""
+    stop_set = _stop_set(_hashable(stop_words))
+    return [_tokenize(text, stop_set, nonstop_words, stemming) for text in texts]
+
+
+def analyze(text):
+    """
+    Analyzer of TFIDF vectorizers. Same as TfidfVectorizer(tokenizer=tokenize, stop_words='english')'s:
+    lowercase, tokenize, then drop stemmed tokens that are stop words
+    """
+    return [t for t in _tokenize(text.lower(), ENGLISH_STOP_WORDS, (), True) if t not in ENGLISH_STOP_WORDS]
+
+
+def analyze_many(texts):
+    return [analyze(text) for text in texts]
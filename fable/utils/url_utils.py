@@ -13,12 +13,46 @@ import regex
 import difflib
 import datetime
 
-from sklearn.feature_extraction.text import CountVectorizer
-from nltk.corpus import stopwords
-from nltk.stem.snowball import SnowballStemmer
-from nltk.stem import WordNetLemmatizer
+from . import tokenizer
+
+TS_PAD = '00000101000000' # * Minimal valid value of each component of a 14-digit wayback timestamp
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def ts_norm(ts):
+    """
+    Normalize a (partial) wayback timestamp into 14 digits str, padding missing components with minimal valid values
+    e.g. 201501 --> 20150101000000
+    Return None if ts is not a wayback timestamp
+    """
+    ts = str(ts)
+    if not ts.isdigit() or len(ts) % 2 or not 4 <= len(ts) <= 14:
+        return None
+    return ts + TS_PAD[len(ts):]
+
+def ts_to_datetime(ts):
+    """Fast parse of wayback timestamp. None if not valid"""
+    ts = ts_norm(ts)
+    if ts is None:
+        return None
+    try:
+        return datetime.datetime(int(ts[:4]), int(ts[4:6]), int(ts[6:8]), int(ts[8:10]), int(ts[10:12]), int(ts[12:14]))
+    except ValueError:
+        return None
+
+def ts_to_int(ts):
+    """Wayback timestamp as 14 digits int (comparable by value). None if not valid"""
+    ts = ts_norm(ts)
+    return int(ts) if ts is not None else None
+
+def ts_to_seconds(ts):
+    """Seconds since epoch of wayback timestamp, for timestamp arithmetic. None if not valid"""
+    d = ts_to_datetime(ts)
+    return int((d - EPOCH).total_seconds()) if d is not None else None
 
 def _safe_dparse(ts):
+    d = ts_to_datetime(ts)
+    if d is not None:
+        return d
     try:
         return dparser.parse(ts)
     except:
@@ -37,10 +71,11 @@ def filter_wayback(url):
     url = url.replace('https:///', 'https://')
     return url
 
-def constr_wayback(url, ts):
+def constr_wayback(url, ts, raw=False):
+    """raw: Construct URL of the original capture (id_), without wayback toolbar and link rewriting"""
     if 'web.archive.org/web' in url:
         return url
-    return f"http://web.archive.org/web/{ts}/{url}"
+    return f"http://web.archive.org/web/{ts}{'id_' if raw else ''}/{url}"
 
 def get_ts(wayback_url):
     if 'web.archive.org/web' not in wayback_url:
@@ -49,7 +84,42 @@ def get_ts(wayback_url):
     url = wayback_url.replace('https://web.archive.org/web/', '')
     slash = url.find('/')
     ts = url[:slash]
-    return ts
+    return re.match(r'\d*', ts).group() # * Strip modifier (e.g. id_)
+
+def wayback_raw(wayback_url):
+    """Wayback URL --> URL of its original capture (id_)"""
+    return re.sub(r'(web\.archive\.org/web/\d+)(?:[a-z]{2}_)?/', r'\1id_/', wayback_url, count=1)
+
+def wayback_canonical(wayback_url):
+    """Wayback URL with modifier (e.g. id_) --> canonical wayback URL"""
+    return re.sub(r'(web\.archive\.org/web/\d+)[a-z]{2}_/', r'\1/', wayback_url, count=1)
+
+def surt(url, trailing_slash=False):
+    """
+    Sort-friendly URI Reordering Transform of url, matching urlkey of wayback CDX on host, port, path and query
+    e.g. http://www.Example.com:80/a/b/?y=1&x=2 --> com,example)/a/b?x=2&y=1
+    trailing_slash: Keep the trailing slash of path (CDX strips it), as the CDX server does for prefix queries
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url
+    us = urlsplit(url)
+    host = (us.hostname or '').strip('.')
+    host = re.sub(r'^www\d*\.', '', host)
+    key = ','.join(reversed(host.split('.')))
+    try:
+        port = us.port
+    except ValueError:
+        port = None
+    if port and port != {'http': 80, 'https': 443}.get(us.scheme.lower()):
+        key += f':{port}'
+    path = us.path if us.path else '/'
+    if not trailing_slash and len(path) > 1:
+        path = path.rstrip('/') or '/'
+    key += ')' + path
+    if us.query:
+        key += '?' + '&'.join(sorted(us.query.split('&')))
+    return key.lower()
 
 def my_parse_qs(query):
     """Add case handler where the query string is not standard"""
@@ -551,42 +621,13 @@ def netloc_dir(url, nondigit=True, nondate=False, exclude_index=False):
         p = nondate_pathname(p)
     return ('.'.join(hosts), p.lower())
 
-stemmer = None 
-lemmatizer = None
-stem_cache = {}
-
 def tokenize(texts, stop_words='english', nonstop_words=[], stemming=True):
     """
-    Simple function for tokenizing a text. Extracted from sklearn src code
+    Simple function for tokenizing a text
     
     Returns: list of features in the original order
     """
-    global stemmer, lemmatizer, stem_cache
-    if stemmer is None:
-        stemmer = SnowballStemmer('english')
-        lemmatizer = WordNetLemmatizer()
-    texts = texts.replace('_', ' ')
-    # * Merge nonstop words
-    for nsw in nonstop_words:
-        texts = texts.replace(nsw, '')
-    # # ? Tokenize: Scikit-Learn version
-    cv = CountVectorizer(stop_words=stop_words, token_pattern=r"(?u)\b\w+\b") # TODO: Not necessary english
-    analyze = cv.build_analyzer()
-    texts = analyze(texts)
-    # ? Tokenize: nltk version
-    # texts = nltk.word_tokenize(texts)
-    def cached_transform(t, func, cache):
-        if t in cache:
-            return cache[t]
-        tt = func(t)
-        cache[t] = tt
-        return tt
-    # * Stemming
-    if stemming:
-        texts = [cached_transform(t, stemmer.stem, stem_cache) for t in texts]
-    # * Lemmatization
-    # texts = [lemmatizer.lemmatize(t) for t in texts]
-    return texts
+    return tokenizer.tokenize(texts, stop_words=stop_words, nonstop_words=nonstop_words, stemming=stemming)
 
 def tokenize_url(url, include_all=False, process=False):
     """
@@ -290,14 +290,11 @@ class Verifier:
         cands_titles = {}
         cands = [c[1] for c in url_cand if url_utils.url_match(target_url, c[0])]
         cands_htmls = {}
-        for cand in cands:
-            if cand in alias_match and 'fuzzy_search' not in alias_match[cand]:
-                continue
-        
+        cands = [c for c in cands if c not in alias_match or 'fuzzy_search' in alias_match[c]]
+        for cand, cand_html in zip(cands, self.memo.crawl_many(cands)):
             # # * Sanity check (SE could also got broken pages)
             # if sic_transit.broken(cand, html=True)[0] != False:
             #     continue
-            cand_html = self.memo.crawl(cand)
             if cand_html is None: continue
             cands_htmls[cand] = cand_html
             cands_contents[cand] = self.memo.extract_content(cand_html)
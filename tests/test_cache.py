@@ -0,0 +1,26 @@
+import pytest
+import time
+
+from fable.utils import cache
+
+def test_lru_evict_by_size():
+    c = cache.LRUCache(max_bytes=300)
+    c.set('a', b'a'*100)
+    c.set('b', b'b'*100)
+    assert(c.get('a') == b'a'*100) # * a is now most recent
+    c.set('c', b'c'*150)
+    assert('b' not in c)
+    assert('a' in c and 'c' in c)
+    assert(c.cur_bytes <= 300)
+    assert(c.evictions == 1)
+
+def test_lru_ttl():
+    c = cache.LRUCache(max_bytes=1000)
+    c.set('a', 'value', ttl=0.05)
+    c.set('b', 'value', ttl=0)
+    assert(c.get('a') == 'value')
+    assert(c.get('b') is None)
+    time.sleep(0.1)
+    assert(c.get('a') is None)
+    stats = c.stats()
+    assert(stats['hits'] == 1 and stats['misses'] == 2)
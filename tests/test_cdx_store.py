@@ -0,0 +1,118 @@
+import pytest
+
+from fable.utils import cdx_store, url_utils
+
+def _record(url, ts, status='200', mime='text/html', digest='D', length='100'):
+    return [url_utils.surt(url), ts, url, mime, status, digest, length]
+
+def test_surt():
+    # * urlkey as returned by the CDX server
+    server_keys = {
+        'http://www.Example.com/a/b?y=1&x=2': 'com,example)/a/b?x=2&y=1',
+        'https://example.com': 'com,example)/',
+        'http://www2.example.com/': 'com,example)/',
+        'http://example.com/A/B/': 'com,example)/a/b',
+        'http://example.com/a?': 'com,example)/a',
+        'http://example.com:80/a': 'com,example)/a',
+        'https://example.com:443/a': 'com,example)/a',
+        'https://example.com:80/a': 'com,example:80)/a',
+        'example.com:8080/a/': 'com,example:8080)/a',
+        'http://sub.example.co.uk/index.html?b=2&a=1&a=0': 'uk,co,example,sub)/index.html?a=0&a=1&b=2',
+    }
+    for url, key in server_keys.items():
+        assert(url_utils.surt(url) == key)
+    assert(url_utils.surt('example.com/dir/', trailing_slash=True) == 'com,example)/dir/')
+
+def test_cdx_store_urlkey(tmp_path):
+    store = cdx_store.CDXStore(path=str(tmp_path / 'cdx.sqlite'))
+    # * Records are keyed on the server's urlkey
+    store.ingest('http://www.example.com/dir/', {}, [['com,example)/dir', '20100101000000', 'http://www.example.com/dir/', 'text/html', '200', 'D', '100']])
+    for url in ['example.com/dir', 'http://example.com/dir/', 'https://www.example.com:443/dir']:
+        assert(store.coverage(url, {}) is not None)
+        assert(len(store.query(url)) == 1)
+    store.ingest('example.com/dir/*', {}, [_record('http://example.com/dir/a.html', '20100101000000'), _record('http://example.com/directory', '20100101000000')])
+    assert([r[2] for r in store.query('example.com/dir/*')] == ['http://example.com/dir/a.html'])
+    assert(store.coverage('example.com/directory', {}) is None)
+
+def test_cdx_store_coverage(tmp_path):
+    store = cdx_store.CDXStore(path=str(tmp_path / 'cdx.sqlite'))
+    records = [
+        _record('http://example.com/dir/a.html', '20100101000000'),
+        _record('http://example.com/dir/a.html', '20100101120000'),
+        _record('http://example.com/dir/a.html', '20150101000000', status='301'),
+        _record('http://example.com/dir/b.html', '20120101000000', status='404'),
+        _record('http://example.com/other.html', '20120101000000'),
+    ]
+    store.ingest('example.com/dir/*', {'filter': ['mimetype:text/html']}, records[:4])
+    # * Narrower url, more filters, and collapse can be answered locally
+    params = {'filter': ['mimetype:text/html', 'statuscode:[23][0-9]*'], 'collapse': 'timestamp:8'}
+    assert(store.coverage('http://example.com/dir/a.html', params) is not None)
+    r, status = store.wayback_index('http://example.com/dir/a.html', param_dict=params)
+    assert(status == 'Success')
+    assert([w[0] for w in r] == ['20100101000000', '20150101000000'])
+    r, _ = store.wayback_index('example.com/dir/*', param_dict={'filter': ['mimetype:text/html'], 'collapse': 'urlkey'})
+    assert([w[1] for w in r] == ['http://example.com/dir/a.html', 'http://example.com/dir/b.html'])
+    # * Fewer filters or outside prefix are not covered
+    assert(store.coverage('http://example.com/dir/a.html', {}) is None)
+    assert(store.coverage('http://example.com/other.html', {'filter': ['mimetype:text/html']}) is None)
+    # * Collapsed dumps only answer the same query
+    store.ingest('example.com/*', {'collapse': 'urlkey'}, [records[0], records[4]])
+    assert(store.coverage('example.com/*', {'collapse': 'urlkey'}) is not None)
+    assert(store.coverage('example.com/*', {'collapse': 'urlkey', 'filter': 'statuscode:200'}) is None)
+
+def test_cdx_store_ttl(tmp_path):
+    path = str(tmp_path / 'cdx.sqlite')
+    store = cdx_store.CDXStore(path=path, ttl=3600)
+    store.ingest('example.com/dir/*', {'filter': ['mimetype:text/html']}, [_record('http://example.com/dir/a.html', '20100101000000', status='404')])
+    params = {'filter': ['mimetype:text/html', 'statuscode:[4][0-9]*']}
+    assert(store.coverage('http://example.com/dir/a.html', params) is not None)
+    # * Same file opened by another worker shares the dump, until it expires
+    assert(cdx_store.CDXStore(path=path, ttl=3600).coverage('http://example.com/dir/a.html', params) is not None)
+    assert(cdx_store.CDXStore(path=path, ttl=None).coverage('http://example.com/dir/a.html', params) is not None)
+    assert(cdx_store.CDXStore(path=path, ttl=0).coverage('http://example.com/dir/a.html', params) is None)
+
+def test_cdx_store_prune(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cdx.sqlite')
+    now = [1e9]
+    monkeypatch.setattr(cdx_store.time, 'time', lambda: now[0])
+    store = cdx_store.CDXStore(path=path, ttl=3600)
+    old = [_record('http://example.com/a.html', '20100101000000'), _record('http://example.com/b.html', '20100101000000')]
+    store.ingest('example.com/*', {'filter': ['mimetype:text/html']}, old)
+    now[0] += 3000
+    # * A later dump refreshes a.html only
+    store.ingest('http://example.com/a.html', {}, old[:1])
+    now[0] += 1000
+    # * Ingesting prunes the expired prefix dump and the records only it owned
+    store.ingest('http://example.com/c.html', {}, [_record('http://example.com/c.html', '20100101000000')])
+    assert(store.coverage('example.com/*', {'filter': ['mimetype:text/html']}) is None)
+    assert(store.coverage('http://example.com/a.html', {}) is not None)
+    assert([r[2] for r in store.query('example.com/*')] == ['http://example.com/a.html', 'http://example.com/c.html'])
+    # * So does opening the store
+    now[0] += 3000
+    cdx_store.CDXStore(path=path, ttl=3600)
+    assert(store.coverage('http://example.com/a.html', {}) is None)
+    assert([r[2] for r in store.query('example.com/*')] == ['http://example.com/c.html'])
+    assert(store.prune() == 0)
+
+def test_cdx_store_refresh(tmp_path, monkeypatch):
+    now = [1e9]
+    monkeypatch.setattr(cdx_store.time, 'time', lambda: now[0])
+    store = cdx_store.CDXStore(path=str(tmp_path / 'cdx.sqlite'), ttl=3600)
+    params = {'filter': ['mimetype:text/html']}
+    a, b = _record('http://example.com/dir/a.html', '20100101000000'), _record('http://example.com/dir/b.html', '20100101000000')
+    image = _record('http://example.com/dir/c.png', '20100101000000', mime='image/png')
+    store.ingest('example.com/dir/*', params, [a, b])
+    store.ingest('http://example.com/dir/c.png', {}, [image])
+    now[0] += 10
+    # * Refreshed prefix dump (e.g. by _index_prefix) replaces the records it no longer returns
+    store.ingest('example.com/dir/*', params, [a])
+    assert([r[2] for r in store.query('example.com/dir/*', params)] == ['http://example.com/dir/a.html'])
+    r, _ = store.wayback_index('http://example.com/dir/b.html', param_dict=params)
+    assert(r == [])
+    # * Records outside its filters are not its to replace
+    assert(len(store.query('http://example.com/dir/c.png')) == 1)
+    # * Incomplete and collapsed dumps replace nothing
+    now[0] += 10
+    store.ingest('example.com/dir/*', params, [], complete=False)
+    store.ingest('example.com/dir/*', {'filter': ['mimetype:text/html'], 'collapse': 'urlkey'}, [])
+    assert(len(store.query('example.com/dir/*', params)) == 1)
@@ -0,0 +1,179 @@
+import threading
+import time
+import http.server
+from concurrent import futures
+
+import pytest
+
+from fable.utils import crawl
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Test site. Routes are set per test on server.routes: {path: func(handler)}"""
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            server.paths.append(self.path)
+        try:
+            route = server.routes.get(self.path.split('?')[0], _html_page)
+            route(self)
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+def _html_page(handler, body=b'<html><title>page</title></html>', delay=0):
+    time.sleep(delay)
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/html')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    srv.daemon_threads = True
+    srv.lock = threading.Lock()
+    srv.inflight, srv.max_inflight, srv.paths, srv.routes = 0, 0, [], {}
+    srv.url = f'http://127.0.0.1:{srv.server_port}'
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    monkeypatch.setattr(crawl.rp, 'allowed', lambda *args, **kwargs: True)
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_host_limit_across_batches(server):
+    """Per host cap holds across concurrent crawl_many calls, not only within one batch"""
+    server.routes['/slow'] = lambda h: _html_page(h, delay=0.2)
+    batches = [[f'{server.url}/slow?b={b}&i={i}' for i in range(12)] for b in range(2)]
+    with futures.ThreadPoolExecutor(max_workers=2) as e:
+        results = list(e.map(crawl.crawl_many, batches))
+    assert(all(r is not None for rs in results for r in rs))
+    assert(len(server.paths) == 24)
+    assert(0 < server.max_inflight <= crawl.MAX_HOST_CONCURRENCY)
+
+
+def test_shared_session(server):
+    def set_cookie(h):
+        h.send_response(302)
+        h.send_header('Location', '/echo')
+        h.send_header('Set-Cookie', 'k=v; Path=/')
+        h.end_headers()
+    def echo_cookie(h):
+        _html_page(h, body=(h.headers.get('Cookie') or 'none').encode())
+    server.routes.update({'/cookie': set_cookie, '/echo': echo_cookie})
+    session = crawl.get_session()
+    assert(crawl.get_session() is session)
+    # * Cookies still follow the redirects of one request, but are never persisted
+    assert(session.get(f'{server.url}/cookie').text == 'k=v')
+    assert(len(session.cookies) == 0)
+    assert(session.get(f'{server.url}/echo').text == 'none')
+    crawl.close_session()
+    assert(crawl.get_session() is not session)
+
+
+def test_failure_classes(server, monkeypatch):
+    def status(code, content_type='text/html'):
+        def route(h):
+            h.send_response(code)
+            h.send_header('Content-Type', content_type)
+            h.send_header('Content-Length', '0')
+            h.end_headers()
+        return route
+    codes = {404: 'http_404', 410: 'http_404', 403: 'http_4xx', 408: 'http_transient', 425: 'http_transient',
+             429: 'http_transient', 500: 'http_5xx', 503: 'http_5xx'}
+    server.routes.update({f'/{code}': status(code) for code in codes})
+    server.routes['/json'] = status(200, content_type='application/json')
+    monkeypatch.setattr(crawl.time, 'sleep', lambda s: None)
+    for code, failure in codes.items():
+        assert(crawl.requests_crawl_status(f'{server.url}/{code}') == (None, failure))
+    # * 429 is retried before giving up
+    assert(server.paths.count('/429') == 4)
+    assert(crawl.requests_crawl_status(f'{server.url}/json') == (None, 'not_html'))
+    assert(crawl.requests_crawl_status(f'{server.url}/doc.pdf') == (None, 'filtered_ext'))
+    resp, failure = crawl.requests_crawl_status(f'{server.url}/page', raw=True)
+    assert(failure is None and resp.status_code == 200)
+    monkeypatch.setattr(crawl.rp, 'allowed', lambda *args, **kwargs: False)
+    assert(crawl.requests_crawl_status(f'{server.url}/page') == (None, 'robots'))
+
+
+class FakeCDX:
+    """CDX server paging records with resume keys. Collapse is applied per request, as the server does"""
+    def __init__(self, records):
+        self.records, self.requests = records, []
+
+    def __call__(self, params, **kwargs):
+        self.requests.append(params)
+        start = int(params.get('resumeKey', 0))
+        end = start + int(params['limit']) if 'limit' in params else len(self.records)
+        lines, last_key = [], None
+        for r in self.records[start:end]:
+            if params.get('collapse'):
+                key = r[1][:8]
+                if key == last_key:
+                    continue
+                last_key = key
+            lines.append(' '.join(r))
+        if params.get('showResumeKey') and end < len(self.records):
+            lines += ['', str(end)]
+        resp = type('Resp', (), {})()
+        resp.iter_lines = lambda decode_unicode=True: iter(lines)
+        resp.close = lambda: None
+        return resp
+
+
+def test_iter_wayback_cdx_paging(monkeypatch):
+    records = [['com,a)/', f'2010010{d}{h}0000', 'http://a.com/', 'text/html', '200', 'D', '100']
+               for d, h in [(1, '00'), (1, '12'), (2, '00'), (2, '06'), (2, '12'), (3, '00'), (4, '00')]]
+    fake = FakeCDX(records)
+    monkeypatch.setattr(crawl, '_cdx_request', fake)
+    monkeypatch.setattr(crawl.time, 'sleep', lambda s: None)
+    assert(list(crawl.iter_wayback_cdx('a.com', page_size=3)) == records)
+    assert([p.get('resumeKey') for p in fake.requests] == [None, '3', '6'])
+    # * Groups split across pages are collapsed once
+    fake.requests = []
+    collapsed = list(crawl.iter_wayback_cdx('a.com', {'collapse': 'timestamp:8'}, page_size=3))
+    assert([r[1] for r in collapsed] == ['20100101000000', '20100102000000', '20100103000000', '20100104000000'])
+    assert(len(fake.requests) == 3)
+    # * Limit and early stop don't fetch the following pages
+    fake.requests = []
+    assert(list(crawl.iter_wayback_cdx('a.com', {'limit': 4}, page_size=3)) == records[:4])
+    assert([p['limit'] for p in fake.requests] == [3, 1])
+    fake.requests = []
+    assert(next(crawl.iter_wayback_cdx('a.com', page_size=3)) == records[0])
+    assert(len(fake.requests) == 1)
+
+
+def test_resolve_redirects(server):
+    def redirect(location):
+        def route(h):
+            h.send_response(302)
+            h.send_header('Location', location)
+            h.send_header('Content-Length', '0')
+            h.end_headers()
+        return route
+    big = b'<html>' + b'a' * (4 * crawl.REDIRECT_BODY_LIMIT) + b'</html>'
+    server.routes.update({
+        '/r1': redirect('/r2'), '/r2': redirect('/big'), '/big': lambda h: _html_page(h, body=big),
+        '/loop': redirect('/loop'),
+    })
+    chain = crawl.resolve_redirects(f'{server.url}/r1')
+    assert(chain.url == f'{server.url}/big' and chain.status_code == 200)
+    assert([r.url for r in chain.history] == [f'{server.url}/r1', f'{server.url}/r2'])
+    # * Body is only read up to the cap
+    assert(len(chain.text) == crawl.REDIRECT_BODY_LIMIT and chain.text.startswith('<html>aaa'))
+    chain = crawl.resolve_redirects(f'{server.url}/big', body_limit=10)
+    assert(chain.text == '<html>aaaa')
+    # * Redirect loops (TooManyRedirects) and bad final responses are None
+    assert(crawl.resolve_redirects(f'{server.url}/loop') is None)
+    assert(server.paths.count('/loop') > 1)
+    server.routes['/missing'] = lambda h: h.send_error(404)
+    assert(crawl.resolve_redirects(f'{server.url}/missing') is None)
@@ -0,0 +1,241 @@
+import copy
+import time
+
+import brotli
+import pytest
+
+from fable import tools
+from fable.utils import cache, text_utils
+
+
+class FakeCollection:
+    """In-memory stand-in of the subset of pymongo Collection used by Memoizer. calls records each call"""
+    def __init__(self):
+        self.docs = {}
+        self.calls = []
+
+    @staticmethod
+    def _match(doc, q):
+        for k, v in q.items():
+            if isinstance(v, dict):
+                for op, arg in v.items():
+                    if op == '$in' and doc.get(k) not in arg: return False
+                    if op == '$gt' and not (k in doc and doc[k] > arg): return False
+                    if op == '$exists' and (k in doc) != arg: return False
+            elif doc.get(k) != v:
+                return False
+        return True
+
+    def find(self, q={}, projection=None):
+        self.calls.append('find')
+        return [copy.deepcopy(d) for d in self.docs.values() if self._match(d, q)]
+
+    def find_one(self, q={}, projection=None):
+        self.calls.append('find_one')
+        docs = [copy.deepcopy(d) for d in self.docs.values() if self._match(d, q)]
+        if len(docs) == 0:
+            return None
+        if projection and projection.get('_id') is False:
+            docs[0].pop('_id')
+        return docs[0]
+
+    def _update(self, q, update, upsert=False, many=False):
+        matched = [d for d in self.docs.values() if self._match(d, q)]
+        if len(matched) == 0 and upsert:
+            doc = {k: v for k, v in q.items() if not isinstance(v, dict)}
+            doc.update(update.get('$setOnInsert', {}))
+            self.docs[doc['_id']] = matched = doc
+            matched = [doc]
+        for doc in matched[:None if many else 1]:
+            doc.update(update.get('$set', {}))
+            for k in update.get('$unset', {}):
+                doc.pop(k, None)
+
+    def update_one(self, q, update, upsert=False):
+        self.calls.append('update_one')
+        self._update(q, update, upsert=upsert)
+
+    def update_many(self, q, update, upsert=False):
+        self.calls.append('update_many')
+        self._update(q, update, upsert=upsert, many=True)
+
+    def bulk_write(self, ops, ordered=True):
+        self.calls.append('bulk_write')
+        for op in ops:
+            self._update(op._filter, op._doc, upsert=op._upsert)
+
+    def delete_one(self, q):
+        self.calls.append('delete_one')
+        for d in [d for d in self.docs.values() if self._match(d, q)][:1]:
+            del self.docs[d['_id']]
+
+    def delete_many(self, q):
+        self.calls.append('delete_many')
+        for d in [d for d in self.docs.values() if self._match(d, q)]:
+            del self.docs[d['_id']]
+
+
+class FakeDB:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def memo_factory():
+    """Memoizers sharing one fake db, each with its own in-process cache (like separate workers)"""
+    db = FakeDB()
+    return (lambda: tools.Memoizer(db=db, mem_cache=cache.LRUCache())), db
+
+
+def _crawl_doc(url, html, **fields):
+    return {'_id': url, 'url': url, 'site': 'a.com', 'html': brotli.compress(html.encode()), 'ttl': time.time() + 3600, **fields}
+
+
+def test_extraction_digest_hit(memo_factory, monkeypatch):
+    new_memo, db = memo_factory
+    html = '<html><title>Same Page</title><body>same</body></html>'
+    for url in ['http://a.com/1', 'http://a.com/2']:
+        db.crawl.docs[url] = _crawl_doc(url, html, html_digest=cache.digest(html))
+    extracted = []
+    monkeypatch.setattr(text_utils, 'extract_title', lambda html, **kwargs: extracted.append(html) or 'Same Page')
+    memo = new_memo()
+    assert(memo.extract_title(memo.crawl('http://a.com/1')) == 'Same Page')
+    # * Another url (and another worker) with the same html hits the extraction by digest
+    assert(memo.extract_title(memo.crawl('http://a.com/2')) == 'Same Page')
+    assert(memo.extract_title(memo.crawl('http://a.com/2')) == 'Same Page')
+    # * site_titles written once per newly seen url, not on every extraction hit
+    assert(db.site_titles.calls.count('bulk_write') == 2)
+    other = new_memo()
+    assert(other.extract_title(other.crawl('http://a.com/1')) == 'Same Page')
+    assert(len(extracted) == 1)
+    # * Extraction only writes extraction (+ site_titles), never crawl docs
+    assert([c for c in db.crawl.calls if c != 'find_one'] == [])
+    assert(db.extraction.calls.count('update_one') == 1)
+    assert(set(db.site_titles.docs) == {'http://a.com/1', 'http://a.com/2'})
+
+
+def test_extraction_legacy_backfill(memo_factory, monkeypatch):
+    new_memo, db = memo_factory
+    html = '<html><title>Legacy</title></html>'
+    db.crawl.docs['http://a.com/old'] = _crawl_doc('http://a.com/old', html, title='Legacy Title', content='legacy')
+    monkeypatch.setattr(text_utils, 'extract_title', lambda html, **kwargs: pytest.fail('should hit extraction'))
+    memo = new_memo()
+    html = memo.crawl('http://a.com/old')
+    assert(db.crawl.docs['http://a.com/old']['html_digest'] == cache.digest(html))
+    assert(db.extraction.docs[cache.digest(html)]['title'] == 'Legacy Title')
+    assert(memo.extract_title(html) == 'Legacy Title')
+    assert(new_memo().extract_title(html) == 'Legacy Title')
+
+
+class FakeResponse:
+    def __init__(self, url, text):
+        self.url, self.text, self.headers = url, text, {}
+
+
+def test_crawl_many(memo_factory):
+    new_memo, db = memo_factory
+    db.crawl.docs['http://a.com/db'] = _crawl_doc('http://a.com/db', 'db html', html_digest=cache.digest('db html'))
+    memo = new_memo()
+    memo.mem_cache.set(('crawl', 'http://a.com/mem'), {'html': 'mem html', 'final_url': 'http://a.com/mem'})
+    fetched = []
+    def fetch(url, **kwargs):
+        fetched.append(url)
+        if url == 'http://a.com/down':
+            return None, 'http_5xx'
+        return FakeResponse(url, f'{url} html'), None
+    memo._fetch = fetch
+    urls = ['http://a.com/new', 'http://a.com/db', 'http://a.com/down', 'http://a.com/new', 'http://a.com/mem']
+    htmls = memo.crawl_many(urls)
+    # * Same order as urls, duplicates answered from one fetch
+    assert(htmls == ['http://a.com/new html', 'db html', None, 'http://a.com/new html', 'mem html'])
+    assert(sorted(fetched) == ['http://a.com/down', 'http://a.com/new'])
+    # * One failure doesn't affect the others, and is cached as negative
+    assert(db.crawl_negative.docs['http://a.com/down']['failure'] == 'http_5xx')
+    assert('http://a.com/new' in db.crawl.docs and 'http://a.com/down' not in db.crawl.docs)
+    assert(db.crawl.calls.count('bulk_write') == 1)
+    # * Everything is cached now, no more fetches
+    assert(memo.crawl_many(urls) == htmls)
+    other = new_memo()
+    other._fetch = fetch
+    assert(other.crawl_many(urls[:4]) == htmls[:4])
+    assert(len(fetched) == 2)
+
+
+def test_wayback_index_many(memo_factory, monkeypatch):
+    new_memo, db = memo_factory
+    db.wayback_index.docs['a.com/db'] = {'_id': 'a.com/db', 'url': 'a.com/db', 'ts': [20100101000000], 'ts_nb': [20100101000000]}
+    queried = []
+    def index_record(url, **kwargs):
+        queried.append(url)
+        if url == 'a.com/none':
+            return None
+        return {'url': url, 'ts': [20120101000000, 20110101000000], 'ts_nb': [20120101000000, 20110101000000]}
+    memo = new_memo()
+    memo._wayback_index_record = index_record
+    urls = ['a.com/new', 'a.com/db', 'a.com/none', 'a.com/new']
+    earliest = memo.wayback_index_many(urls, policy='earliest')
+    assert(earliest == [
+        'http://web.archive.org/web/20110101000000/a.com/new',
+        'http://web.archive.org/web/20100101000000/a.com/db',
+        None,
+        'http://web.archive.org/web/20110101000000/a.com/new',
+    ])
+    assert(sorted(queried) == ['a.com/new', 'a.com/none'])
+    assert(memo.wayback_index_many(urls, policy='all')[2] == [])
+    # * Same answers as the single url version, no more queries for cached records
+    assert(earliest == [memo.wayback_index(u, policy='earliest') for u in urls])
+    assert(sorted(queried) == ['a.com/new', 'a.com/none', 'a.com/none', 'a.com/none'])
+
+
+def test_negative_ttl(memo_factory):
+    new_memo, db = memo_factory
+    memo = new_memo()
+    failures = {'http://a.com/404': 'http_404', 'http://a.com/429': 'http_transient',
+                'http://a.com/500': 'http_5xx', 'http://a.com/other': 'unknown'}
+    fetched = []
+    memo._fetch = lambda url, **kwargs: fetched.append(url) or (None, failures[url])
+    now = time.time()
+    for url in failures:
+        assert(memo.crawl(url) is None)
+    for url, failure in failures.items():
+        ttl = db.crawl_negative.docs[url]['ttl'] - now
+        assert(abs(ttl - tools.NEGATIVE_TTL.get(failure, tools.NEGATIVE_TTL['error'])) < 60)
+    # * Rate limited urls are retried much sooner than missing pages
+    assert(tools.NEGATIVE_TTL['http_transient'] < tools.NEGATIVE_TTL['http_5xx'] < tools.NEGATIVE_TTL['http_404'])
+    # * Recent failures are not fetched again, by this or another worker, until they expire
+    assert(memo.crawl_many(list(failures)) == [None] * 4)
+    other = new_memo()
+    other._fetch = memo._fetch
+    assert(other.crawl('http://a.com/404') is None)
+    assert(len(fetched) == 4)
+    db.crawl_negative.docs['http://a.com/429']['ttl'] = time.time() - 1
+    assert(other.crawl('http://a.com/429') is None)
+    assert(fetched[-1] == 'http://a.com/429' and len(fetched) == 5)
+
+
+def test_representative_by_meta(memo_factory):
+    new_memo, _ = memo_factory
+    memo = new_memo()
+    tss = [20100101000000, 20110101000000, 20120101000000, 20130101000000, 20140101000000]
+    record = tools._compact_index({'url': 'a.com', 'ts': tss, 'ts_nb': tss,
+                                   'digest': ['A', 'B', 'A', 'C', 'D'], 'length': [100, 300, 100, 200, 400]})
+    sample = [(ts, f'http://web.archive.org/web/{ts}/a.com') for ts in tss]
+    crawled, down = [], set()
+    memo.crawl = lambda url, **kwargs: crawled.append(url) or (None if url in down else 'html')
+    # * Same digest counted once (latest kept), median by length picked, and only it is crawled
+    assert(memo._representative_by_meta(record, sample) == sample[3])
+    assert(crawled == [sample[3][1]])
+    # * Picked snapshot not crawlable, pick again from the rest
+    crawled.clear()
+    down.add(sample[3][1])
+    assert(memo._representative_by_meta(record, sample) == sample[1])
+    assert(crawled == [sample[3][1], sample[1][1]])
+    # * Ambiguous (length tie) or missing metadata, fall back to crawling contents
+    tie = tools._compact_index({'url': 'a.com', 'ts': tss[:2], 'ts_nb': tss[:2], 'digest': ['A', 'B'], 'length': [100, 100]})
+    assert(memo._representative_by_meta(tie, sample[:2]) is None)
+    no_meta = tools._compact_index({'url': 'a.com', 'ts': tss[:2], 'ts_nb': tss[:2], 'digest': ['A', '-'], 'length': [100, 200]})
+    assert(memo._representative_by_meta(no_meta, sample[:2]) is None)
+    assert(tools._snapshot_meta(tools._compact_index({'url': 'a.com', 'ts': tss, 'ts_nb': tss}), tss[0]) is None)
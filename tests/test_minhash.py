@@ -0,0 +1,27 @@
+import random
+
+from fable.utils import minhash, text_utils
+
+def test_minhash_similarity():
+    rnd = random.Random(0)
+    vocab = [f'word{i}' for i in range(2000)]
+    base = [rnd.choice(vocab) for _ in range(400)]
+    near = list(base)
+    for i in range(0, len(near), 100):
+        near[i] = rnd.choice(vocab)
+    text, near, other = ' '.join(base), ' '.join(near), ' '.join(rnd.choice(vocab) for _ in range(400))
+    assert(minhash.text_similarity(text, text) == 1)
+    assert(minhash.text_similarity('', '') == text_utils.k_shingling('', ''))
+    assert(abs(minhash.text_similarity(text, near) - text_utils.k_shingling(text, near)) < 0.1)
+    assert(minhash.text_similarity(text, other) < 0.1)
+    sig = minhash.signature(text)
+    assert((minhash.from_bytes(minhash.to_bytes(sig)) == sig).all())
+
+def test_lsh_index():
+    rnd = random.Random(1)
+    vocab = [f'word{i}' for i in range(2000)]
+    texts = {i: ' '.join(rnd.choice(vocab) for _ in range(300)) for i in range(50)}
+    lsh = minhash.LSHIndex()
+    for i, text in texts.items():
+        lsh.add(i, minhash.signature(text))
+    assert(set(lsh.query(minhash.signature(texts[7]), threshold=0.9)) == {7})
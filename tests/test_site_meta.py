@@ -0,0 +1,74 @@
+from fable import tools
+from fable.utils import url_utils
+
+def test_site_meta_order():
+    site_meta = tools.SiteMeta(wayback=False)
+    crawls = [
+        ('http://a.com/news/1', 'News B'), ('http://a.com/blog/1', 'Blog'),
+        ('http://a.com/news/2', 'News A'), ('http://a.com/news/3', 'News A'),
+    ]
+    for url, title in crawls:
+        site_meta.add(url_utils.netloc_dir(url), {'url': url, 'title': title})
+    assert([nd for nd, _ in site_meta] == sorted(set(url_utils.netloc_dir(u) for u, _ in crawls)))
+    news = site_meta.get(url_utils.netloc_dir('http://a.com/news/1'))
+    assert([c['url'] for c in news] == ['http://a.com/news/2', 'http://a.com/news/3', 'http://a.com/news/1'])
+    nd_idx = site_meta.bisect_left(url_utils.netloc_dir('http://a.com/news/1'))
+    assert(site_meta[nd_idx][1] is news)
+
+def test_site_meta_wayback():
+    site_meta = tools.SiteMeta(wayback=True)
+    nd = url_utils.netloc_dir('http://a.com/news/1')
+    for ts in ['20200101000000', '20190101000000', '20210101000000']:
+        site_meta.add(nd, {'url': 'http://a.com/news/1', 'ts': ts, 'title': ts})
+    assert([c['ts'] for c in site_meta[0][1]] == ['20190101000000', '20200101000000', '20210101000000'])
+
+def test_title_template():
+    site_meta = tools.SiteMeta(wayback=False)
+    for i, topic in enumerate(['Budget', 'Election', 'Weather', 'Sports']):
+        url = f'http://a.com/news/{i}'
+        site_meta.add(url_utils.netloc_dir(url), {'url': url, 'title': f'{topic} | A News', 'content': topic})
+    nd = url_utils.netloc_dir('http://a.com/news/0')
+    assert(site_meta.title_template(nd) == {'A News'})
+    assert(tools.unique_title('http://a.com/news/0', 'Budget | A News', 'Budget', site_meta) == 'Budget')
+    site_meta.add(nd, {'url': 'http://a.com/news/9', 'title': 'Traffic - A News', 'content': 'Traffic'})
+    assert(site_meta.title_template(nd) == {'A News'}) # * Relearned after add
+
+def test_site_context_ttl(monkeypatch):
+    monkeypatch.setattr(tools.config, 'SITE_CONTEXT_TTL', 60)
+    ctx = tools.SiteContext(('example.com', 'example.com'))
+    assert(not ctx.expired() and 0 < ctx.ttl_left() <= 60)
+    ctx.loaded -= 61
+    assert(ctx.expired())
+    monkeypatch.setattr(tools.config, 'SITE_CONTEXT_TTL', None)
+    assert(not ctx.expired())
+
+def test_title_unique_exact_check(monkeypatch):
+    monkeypatch.setattr(tools, 'Memoizer', lambda *args, **kwargs: type('Memo', (), {'get_more_crawls': lambda self, url, wayback: []})())
+    similar = tools.Similar(use_db=False, corpus=['city council budget', 'football league title'])
+    content = ' '.join(f'word{i}' for i in range(200))
+    def check(other_content, lsh_misses):
+        similar.ctx = tools.SiteContext(('a.com', 'a.com'))
+        similar.wb_titles, similar.wb_meta = tools.defaultdict(list), tools.SiteMeta(wayback=True)
+        similar.wb_seen, similar.wb_lsh = set(), tools.minhash.LSHIndex()
+        similar._add_crawl('http://web.archive.org/web/20100101000000/http://a.com/x/other', 'Home', other_content)
+        if lsh_misses:
+            monkeypatch.setattr(similar.wb_lsh, 'query', lambda sig, threshold=0.9: {})
+        return similar._is_title_unique('http://web.archive.org/web/20110101000000/http://a.com/y/page', 'Home', content, wayback=True)
+    assert(check(content, lsh_misses=False))
+    # * Same content is still recognized when LSH misses it
+    assert(check(content, lsh_misses=True))
+    assert(not check('other page ' * 50, lsh_misses=True))
+
+def test_title_template_incremental(monkeypatch):
+    site_meta = tools.SiteMeta(wayback=False)
+    segmented = []
+    title_segments = tools.title_segments
+    monkeypatch.setattr(tools, 'title_segments', lambda title: segmented.append(title) or title_segments(title))
+    nd = url_utils.netloc_dir('http://a.com/news/0')
+    for i in range(50):
+        site_meta.add(nd, {'url': f'http://a.com/news/{i}', 'title': f'Story {i} | A News'})
+        assert(site_meta.title_template(nd) == (frozenset({'A News'}) if i >= 2 else None))
+    # * Each new title is split once per key (netloc_dir, host), never again when templates are asked for
+    assert(len(segmented) == 100)
+    site_meta.add(nd, {'url': 'http://a.com/news/0?again', 'title': 'Story 0 | A News'})
+    assert(len(segmented) == 100)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from fable.utils import site_resolver
+
+def test_site_resolver_cache():
+    calls = []
+    def fetch(url):
+        calls.append(url)
+        return {'http://example.com': 'https://www.example.com/home'}.get(url)
+    resolver = site_resolver.SiteResolver(fetch=fetch)
+    info = resolver.resolve('example.com')
+    assert(info.final_url == 'https://www.example.com/home')
+    assert(info.site == 'example.com')
+    assert(resolver.resolve('http://example.com') == info)
+    # * Failures are cached too
+    assert(resolver.resolve('broken.com') is None)
+    assert(resolver.resolve('broken.com') is None)
+    assert(calls == ['http://example.com', 'http://broken.com'])
+
+def test_site_resolver_single_flight():
+    calls = []
+    def fetch(url):
+        calls.append(url)
+        time.sleep(0.2)
+        return url
+    resolver = site_resolver.SiteResolver(fetch=fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve('example.com'))) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert(len(calls) == 1)
+    assert(len(set(results)) == 1 and results[0].site == 'example.com')
+
+def test_google_search_keeps_site(monkeypatch):
+    from fable.utils import search
+    sent = []
+    class Response:
+        status_code = 200
+        def json(self): return {'items': [{'link': 'http://example.com/a'}]}
+    def get(url, params=None, **kwargs):
+        sent.append(dict(params))
+        return Response()
+    monkeypatch.setattr(search.requests, 'get', get)
+    monkeypatch.setattr(search.time, 'sleep', lambda _: None)
+    monkeypatch.setattr(search.config, 'GOOGLE_SEARCH_KEY', 'key', raising=False)
+    monkeypatch.setattr(search.config, 'GOOGLE_SEARCH_CX', 'cx', raising=False)
+    # * Homepage can't be resolved (e.g. 403): search is still restricted to the site
+    monkeypatch.setattr(site_resolver, 'resolve', lambda host: None)
+    search.google_search('query', param_dict={}, site_spec_url='www.example.com')
+    assert(sent[-1]['siteSearch'] == 'example.com')
+    monkeypatch.setattr(site_resolver, 'resolve', lambda host: site_resolver.SiteInfo(host, 'https://example.org/', 'example.org'))
+    search.google_search('query', param_dict={}, site_spec_url='example.com')
+    assert(sent[-1]['siteSearch'] == 'example.org')
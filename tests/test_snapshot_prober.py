@@ -0,0 +1,69 @@
+import datetime
+import threading
+import time
+
+from fable import histredirector
+from fable.utils import cdx_store, url_utils
+
+def _record(url, ts, status, digest):
+    return [url_utils.surt(url), ts, url, 'text/html', status, digest, '100']
+
+def test_snapshot_dedup(tmp_path, monkeypatch):
+    url = 'http://example.com/old.html'
+    monkeypatch.setattr(cdx_store, '_store', cdx_store.CDXStore(path=str(tmp_path / 'cdx.sqlite')))
+    wayback_ts = ['20100101000000', '20110101000000', '20120101000000', '20130101000000']
+    cdx_store.get_store().ingest(url, {}, [
+        _record(url, wayback_ts[0], '200', 'PAGE'), _record(url, wayback_ts[1], '200', 'PAGE'),
+        # * Stock "301 Moved Permanently" body, but different Location
+        _record(url, wayback_ts[2], '301', 'MOVED'), _record(url, wayback_ts[3], '301', 'MOVED'),
+    ])
+    keys = histredirector.HistRedirector._snapshot_keys(url, wayback_ts)
+    assert(keys[0] == keys[1] and keys[0] is not None)
+    assert(keys[2] is None and keys[3] is None)
+
+    targets = {wayback_ts[2]: 'http://example.com/new1.html', wayback_ts[3]: 'http://example.com/new2.html'}
+    probed = []
+    def probe(wayback_url):
+        ts = url_utils.get_ts(wayback_url)
+        probed.append(ts)
+        return targets.get(ts, url)
+    ts_urls = [(datetime.datetime.strptime(ts, '%Y%m%d%H%M%S'), url_utils.constr_wayback(url, ts)) for ts in wayback_ts]
+    prober = histredirector.SnapshotProber(probe, ts_urls, concurrency=1, keys=keys)
+    last_ts = ts_urls[-1][0] + histredirector.SNAPSHOT_SPACING
+    results = [prober.get(i, last_ts) for i in reversed(range(len(ts_urls)))]
+    prober.close()
+    assert(results == [targets[wayback_ts[3]], targets[wayback_ts[2]], url, url])
+    assert(sorted(probed) == wayback_ts[1:])
+
+def test_prober_close(monkeypatch):
+    monkeypatch.setattr(histredirector, '_probe_executor', histredirector.futures.ThreadPoolExecutor(max_workers=2))
+    url = 'http://example.com/old.html'
+    ts_urls = [(datetime.datetime(2000 + i, 1, 1), url_utils.constr_wayback(url, f'{2000 + i}0101000000')) for i in range(10)]
+    release = threading.Event()
+    lock, started, running = threading.Lock(), [], [0]
+    def probe(wayback_url):
+        with lock:
+            started.append(url_utils.get_ts(wayback_url))
+            running[0] += 1
+        if wayback_url != ts_urls[-1][1]:
+            release.wait()
+        with lock:
+            running[0] -= 1
+        return url
+    prober = histredirector.SnapshotProber(probe, ts_urls, concurrency=4)
+    assert(prober.get(9, ts_urls[-1][0] + histredirector.SNAPSHOT_SPACING) == url)
+    # * 4 snapshots prefetched on the shared executor of 2 threads: 9 is done, 8 and 7 running, 6 queued
+    while len(started) < 3:
+        time.sleep(0.01)
+    closer = threading.Thread(target=prober.close)
+    closer.start()
+    closer.join(0.2)
+    assert(closer.is_alive()) # * Waiting for the running probe
+    release.set()
+    closer.join()
+    assert(running[0] == 0)
+    assert(sorted(started) == ['20070101000000', '20080101000000', '20090101000000'])
+    # * Queued snapshots were cancelled, and nothing is fetched ahead after close
+    assert(prober.get(5, ts_urls[-1][0]) == url)
+    histredirector.get_probe_executor().shutdown(wait=True)
+    assert(sorted(started) == ['20050101000000', '20070101000000', '20080101000000', '20090101000000'])
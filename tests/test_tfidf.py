@@ -0,0 +1,78 @@
+import pytest
+from sklearn.metrics.pairwise import cosine_similarity
+
+from fable.utils import text_utils
+
+corpus = [
+    'city council votes on the new budget',
+    'football team wins the league title',
+    'stock market prices fall as investors sell',
+    'new park opens in the city center',
+]
+
+def test_tfidf_base_terms():
+    tfidf = text_utils.TFidfStatic(corpus)
+    text1, text2 = 'city council budget', 'city park budget'
+    tfidf.add_corpus([text1, text2])
+    base = tfidf.vectorizer.transform([text1, text2])
+    expected = cosine_similarity(base[0], base[1])[0, 0]
+    assert(abs(tfidf.similar(text1, text2) - expected) < 1e-9)
+    assert(abs(tfidf.similar(text1, text1) - 1) < 1e-9)
+
+def test_tfidf_overlay_terms():
+    tfidf = text_utils.TFidfStatic(corpus)
+    text1, text2, text3 = 'zebra quokka city', 'zebra quokka park', 'wombat'
+    tfidf.add_corpus([text1, text2, text3])
+    assert(0 < tfidf.similar(text1, text2) < 1)
+    assert(tfidf.similar(text1, text3) == 0)
+    assert(len(tfidf.vocab) == len(tfidf.vectorizer.vocabulary_)) # * Base vocab untouched
+    tfidf._clear_workingset()
+    assert(set(tfidf.topN('zebra city')) == {'zebra', 'citi'})
+
+def test_tfidf_save_load(tmp_path):
+    tfidf = text_utils.TFidfStatic(corpus)
+    tfidf.save(str(tmp_path))
+    loaded = text_utils.TFidfStatic.load(str(tmp_path))
+    assert(loaded.vocab == tfidf.vocab)
+    assert(loaded.n_docs == tfidf.n_docs)
+    text1, text2 = 'city council zebra', 'city park zebra budget'
+    tfidf.add_corpus([text1, text2])
+    loaded.add_corpus([text1, text2])
+    assert(abs(loaded.similar(text1, text2) - tfidf.similar(text1, text2)) < 1e-9)
+
+def test_tokenizer_matches_sklearn():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from fable.utils import tokenizer
+    analyzer = TfidfVectorizer(stop_words='english', tokenizer=text_utils.tokenize, token_pattern=None).build_analyzer()
+    texts = corpus + ["It's_the Running CITIES, whereas ALSO naïve café"]
+    assert([analyzer(t) for t in texts] == tokenizer.analyze_many(texts))
+    assert(tokenizer.tokenize_many(texts) == [text_utils.tokenize(t) for t in texts])
+
+def test_tfidf_similar_many():
+    tfidf = text_utils.TFidfStatic(corpus)
+    texts = ['city council budget', 'zebra city', '', 'football league title', 'quokka']
+    tfidf.add_corpus(texts)
+    simis = tfidf.similar_many(texts[0], texts)
+    assert([round(s, 9) for s in simis] == [round(tfidf.similar(texts[0], t), 9) for t in texts])
+    matrix = tfidf.similar_matrix(texts[:2], texts)
+    assert(matrix.shape == (2, len(texts)))
+    assert(abs(matrix[1, 0] - tfidf.similar(texts[1], texts[0])) < 1e-9)
+
+def test_tfidf_counts_reused():
+    tfidf = text_utils.TFidfStatic(corpus)
+    analyzed = []
+    analyzer = tfidf.analyzer
+    tfidf.analyzer = lambda text: analyzed.append(text) or analyzer(text)
+    texts = ['zebra city council', 'zebra park', 'quokka budget']
+    tfidf.add_corpus(texts)
+    tfidf.similar_many(texts[0], texts)
+    # * Growing the working set changes overlay df, but only the new text is analyzed
+    tfidf._add_workingset(['zebra quokka'])
+    simis = tfidf.similar_many(texts[0], texts + ['zebra quokka'])
+    tfidf.add_corpus(texts + ['zebra quokka'])
+    assert(list(tfidf.similar_many(texts[0], texts + ['zebra quokka'])) == list(simis))
+    assert(sorted(analyzed) == sorted(texts + ['zebra quokka']))
+    # * Same as vectors built from scratch with the final working set
+    fresh = text_utils.TFidfStatic(corpus)
+    fresh.add_corpus(texts + ['zebra quokka'])
+    assert(max(abs(fresh.similar_many(texts[0], texts + ['zebra quokka']) - simis)) < 1e-9)
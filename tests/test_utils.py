@@ -31,6 +31,26 @@ def test_url_token_diffs():
             if diffs is None: diffs = diff
             assert(diffs == diff)
 
+def test_wayback_ts():
+    assert(url_utils.ts_norm('201501') == '20150101000000')
+    assert(url_utils.ts_norm('20151') is None)
+    assert(url_utils.ts_to_int('2015') == 20150101000000)
+    assert(url_utils.ts_to_seconds('20150102000000') - url_utils.ts_to_seconds('20150101') == 3600*24)
+    assert(url_utils.ts_to_datetime('20151301') is None)
+    assert(url_utils._safe_dparse('20150102').day == 2)
+
+def test_wayback_raw():
+    wayback_url = 'http://web.archive.org/web/20150101000000/http://a.com/dir/x.html'
+    raw_url = url_utils.wayback_raw(wayback_url)
+    assert(raw_url == 'http://web.archive.org/web/20150101000000id_/http://a.com/dir/x.html')
+    assert(url_utils.wayback_canonical(raw_url) == wayback_url)
+    assert(url_utils.get_ts(raw_url) == '20150101000000')
+    html = '<html><body><a href="y.html">y</a><a href="http://b.com/z">z</a></body></html>'
+    assert(sorted(crawl.outgoing_links(wayback_url, html, wayback=True)) == [
+        'http://web.archive.org/web/20150101000000/http://a.com/dir/y.html',
+        'http://web.archive.org/web/20150101000000/http://b.com/z'
+    ])
+
 def test_lang_detect():
     def get_lang(i, url):
         print(i, url)